@@ -1,11 +1,20 @@
 import sys
 import os
-import shutil
 import re
+import glob
+import json
+import time
 import subprocess
+import threading
 import datetime
-import pickle
-import ruamel_yaml as yaml
+# The modules which aren't always needed (asyncio, ruamel_yaml, the pandoc
+# servers, the label index, the images, ...) are imported where they're used,
+# to keep the startup short (see the startup benchmarks in
+# benchmarks/bench.py).
+from cache import BuildCache, hash_bytes, hash_file
+from output import get_tmp_path, replace_if_changed, remove_if_exists
+from lyx_parser import build_inset_tree_from_file, unquote, read_first_ert
+from profiling import Profiler
 
 
 class FrontMatters:
@@ -14,9 +23,19 @@ class FrontMatters:
         self.our_fm = our_fm
         self.jekyll_fm = jekyll_fm
 
+        if not isinstance(our_fm, dict) or not isinstance(jekyll_fm, dict):
+            raise Exception('Malformed front matter!')
+
         if 'html_file_name' not in our_fm:
             raise Exception('Front matter: the "html_file_name" attribute is '
                             'required!')
+        # It's the name of a file in _posts.
+        html_file_name = our_fm['html_file_name']
+        if (not isinstance(html_file_name, str) or not html_file_name or
+                re.search(r'[/\\]', html_file_name) or
+                html_file_name.lower().endswith('.html')):
+            raise Exception('Front matter: invalid "html_file_name" (it must '
+                            'be a file name without the extension)!')
 
         # Extracts the date
         if ('date' not in jekyll_fm or
@@ -24,9 +43,13 @@ class FrontMatters:
             raise Exception('Missing or invalid "date" attribute in Jekyll\'s '
                             'front matter!')
 
-    def dump_jekyll_fm(self):
+    def dump_jekyll_fm(self, defaults=None):
+        import ruamel_yaml as yaml
+        # `defaults` are added to Jekyll's front matter, unless it has them.
+        jekyll_fm = dict(defaults or {})
+        jekyll_fm.update(self.jekyll_fm)
         return ('---\n' +
-                yaml.safe_dump(self.jekyll_fm, default_flow_style=False,
+                yaml.safe_dump(jekyll_fm, default_flow_style=False,
                                allow_unicode=True) +
                 '---\n')
 
@@ -64,20 +87,41 @@ class FrontMatters:
         return (start, end, start - len(begin_comment_str),
                 end + len(end_comment_str))
 
+    @staticmethod
+    def _from_yaml(data):
+        import ruamel_yaml as yaml
+        try:
+            # The last '---' produces a third empty "document".
+            our_fm, jekyll_fm, _ = yaml.safe_load_all(data)
+        except Exception:
+            raise Exception("Something went wrong while parsing the "
+                            "front matter!")
+
+        return FrontMatters(our_fm, jekyll_fm)
+
     @staticmethod
     def from_file(tex_path):
         with open(tex_path, 'r', encoding='utf-8') as f:
             data = f.read()
             start, end, _, _ = FrontMatters._get_fm_limits(data)
+            return FrontMatters._from_yaml(data[start: end])
 
-            try:
-                # The last '---' produces a third empty "document".
-                our_fm, jekyll_fm, _ = yaml.safe_load_all(data[start: end])
-            except Exception:
-                raise Exception("Something went wrong while parsing the "
-                                "front matter!")
-
-            return FrontMatters(our_fm, jekyll_fm)
+    @staticmethod
+    def from_lyx(lyx_path):
+        """
+        Reads the front matter directly from the LyX file, where it's the
+        first ERT inset. Returns None if it isn't there in the expected form,
+        in which case it must be read from the TeX file.
+        """
+        with open(lyx_path, 'r', encoding='utf-8') as f:
+            ert = read_first_ert(f)
+        if ert is None:
+            return None
+        m = re.fullmatch(r'\s*\\begin{comment}(.*?)\\end{comment}\s*', ert,
+                         flags=re.S)
+        if m is None:
+            return None
+        return FrontMatters._from_yaml(m[1])
 
     @staticmethod
     def remove_from_file(latex):
@@ -86,133 +130,194 @@ class FrontMatters:
         return latex[:before] + latex[after:]
 
 
-def handle_images(lyx_path, blog_dir, assets_rel_dir, front_matters,
-                  update=True):
+def iter_graphics(node):
+    """
+    Yields the Graphics insets in the tree rooted at `node` in document order.
     """
-    Copies the images into the assets directory and returns the correct path
-    to use in the HTML file as image src.
+    for child in node.children:
+        if child.type.startswith('Graphics'):
+            yield child
+        yield from iter_graphics(child)
 
-    NOTE: when a LyX file is converted into a TeX file, the extensions of the
-    image filenames are lost (e.g. picture.svg becomes picture).
+
+def get_figures(tree):
+    """
+    Returns a list with an item `(graphics, label)` for each image in the
+    order in which they appear in the HTML file (i.e. the order in which they
+    end in the LyX file), where `graphics` is the Graphics inset and `label`
+    the name of its label, or None.
+
+    `tree` is the tree of the 'Float figure', 'Graphics' and
+    'CommandInset label' insets (see build_inset_tree). Labels are only
+    considered in float figures. A float figure with subfigures (i.e. other
+    float figures) only counts as an image if it also contains a Graphics
+    inset directly.
     """
+    figures = []
+
+    def visit(node, figure):
+        # `figure` is the [graphics, label, has_subfigures] of the innermost
+        # float figure we're in.
+        for child in node.children:
+            if child.type.startswith('Float figure'):
+                if figure is not None:
+                    figure[2] = True
+                child_figure = [None, None, False]
+                visit(child, child_figure)
+                graphics, label, has_subfigures = child_figure
+                if graphics is None:
+                    if not has_subfigures:
+                        raise Exception("LyX file: couldn't get image http "
+                                        "path!")
+                else:
+                    figures.append((graphics, label))
+            elif child.type.startswith('Graphics'):
+                if figure is None:
+                    figures.append((child, None))
+                else:
+                    figure[0] = child
+            elif child.type.startswith('CommandInset label'):
+                if figure is not None and 'name' in child.params:
+                    # format:
+                    #    name "fig:label_per_figure"
+                    figure[1] = unquote(child.params['name'])
+
+    visit(tree, None)
+    return figures
+
+
+def read_image_insets(lyx_path):
+    """
+    Returns the tree of the insets of the LyX file needed by `get_image_info`
+    and `publish_article_images`.
+    """
+    return build_inset_tree_from_file(
+        lyx_path, ('Float figure', 'Graphics', 'CommandInset label'))
 
-    our_fm = front_matters.our_fm
 
+def get_image_info(tree, assets_rel_dir, front_matters):
+    """
+    Returns the paths to use in the HTML file as image src of the figures in
+    `tree` (see `read_image_insets`) and the map from their labels to their
+    numbers.
+
+    NOTE: when a LyX file is converted into a TeX file, the extensions of the
+    image filenames are lost (e.g. picture.svg becomes picture).
+    """
     assets_rel_dir = os.path.normpath(assets_rel_dir)
 
     # The images are created in a directory of the form
     #   blog_path/assets_rel_dir/date-html_fname
     # so that images of different articles are in separate directories.
     date_html_fname = front_matters.get_date_html_fname()
-    rel_dest_dir = os.path.join(assets_rel_dir, date_html_fname)
-    dest_dir = os.path.join(blog_dir, rel_dest_dir)
 
     image_info = []
     name_to_num = {}
+    for image_num, (graphics, label) in enumerate(get_figures(tree), 1):
+        if 'filename' not in graphics.params:
+            raise Exception("LyX file: couldn't get image http path!")
+        base_name = os.path.basename(graphics.params['filename'])
+        # Return the blog-relative path of the copied image
+        image_info.append('/' + assets_rel_dir + '/' + date_html_fname + '/' +
+                          base_name)
+        if label:
+            name_to_num[label] = str(image_num)
+    return image_info, name_to_num
 
-    image_num = 1
-    image_http_path = None
-    image_label = None
 
-    # NOTE:
-    #   - In LyX files, '\' can only appear in commands, so searching for, say,
-    #     '\begin_inset' is safe.
-    with open(lyx_path, encoding='utf-8') as f:
-        # in_* remember the nesting level; -1 = not inside
-        in_graphics = -1
-        in_float_figure = -1
-        in_label = -1
+def publish_article_images(tree, blog_dir, assets_rel_dir, front_matters,
+                           update=True, changed_outputs=None, lyx_dir=''):
+    """
+    Publishes the images in `tree` (see `read_image_insets`) of the LyX file
+    in `lyx_dir` into the assets directory (see `publish_images`).
 
-        nesting = 0
+    The paths of the images which were written or removed are appended to
+    `changed_outputs`, if given.
+    """
+    from assets import publish_images
+    assets_rel_dir = os.path.normpath(assets_rel_dir)
+    date_html_fname = front_matters.get_date_html_fname()
 
-        for line in f:
-            if line.startswith(r'\begin_inset Float figure'):
-                in_float_figure = nesting       # we're in
-            if line.startswith(r'\begin_inset Graphics'):
-                in_graphics = nesting           # we're in
-            if (line.startswith(r'\begin_inset CommandInset label') and
-                    in_float_figure != -1):         # only if in float figure
-                in_label = nesting              # we're in
-
-            we_were_in = (in_graphics != -1 or
-                          in_float_figure != -1 or
-                          in_label != -1)
-
-            # We handle the nesting of begin_ and end_inset.
-            if line.startswith(r'\begin_inset'):
-                nesting += 1
-            elif line.startswith(r'\end_inset'):
-                nesting -= 1
-                if in_graphics == nesting:
-                    in_graphics = -1            # we're out
-                if in_float_figure == nesting:
-                    in_float_figure = -1        # we're out
-                if in_label == nesting:
-                    in_label = -1               # we're out
-
-            we_are_in = (in_graphics != -1 or
-                         in_float_figure != -1 or
-                         in_label != -1)
-
-            if we_were_in and not we_are_in:        # we exited
-                # We write the data collected so far.
-                if image_http_path is None:
-                    raise Exception("LyX file: couldn't get image http path!")
-                image_info.append(image_http_path)
-                if image_label:
-                    name_to_num[image_label] = str(image_num)
-                image_num += 1
-
-                # reset
-                image_http_path = None
-                image_label = None
-
-            if in_graphics != -1:
-                # format:
-                #    filename discrete fgfg.svg
-                m = re.match(r'\s*filename\s+(.+)$', line)
-                if m:
-                    src_path = m[1]
-                    base_name = os.path.basename(src_path)
-                    dest_path = os.path.join(dest_dir, base_name)
-                    if not update and os.path.exists(dest_path):
-                        raise Exception('Already exists: ' + dest_path)
-
-                    # Create the directory and copy the file
-                    os.makedirs(dest_dir, exist_ok=True)
-                    shutil.copy(src_path, dest_path)
-
-                    # Return the blog-relative path of the copied image
-                    image_http_path = ('/' + assets_rel_dir + '/' +
-                                       date_html_fname + '/' + base_name)
-
-            if in_float_figure != -1 and in_label != -1:
-                # format:
-                #    name "fig:label_per_figure"
-                m = re.match(r'\s*name\s+"([^"]+)"$', line)
-                if m:
-                    image_label = m[1]
+    # format:
+    #    filename discrete fgfg.svg
+    report = publish_images([os.path.join(lyx_dir,
+                                          graphics.params['filename'])
+                             for graphics in iter_graphics(tree)
+                             if 'filename' in graphics.params],
+                            os.path.join(blog_dir, assets_rel_dir),
+                            date_html_fname, update)
+    if changed_outputs is not None:
+        dest_dir = os.path.join(blog_dir, assets_rel_dir, date_html_fname)
+        for action in ('copied', 'linked', 'removed'):
+            changed_outputs += [os.path.join(dest_dir, base_name)
+                                for base_name in report[action]]
 
-    return image_info, name_to_num
+
+def handle_images(lyx_path, blog_dir, assets_rel_dir, front_matters,
+                  update=True, changed_outputs=None):
+    """
+    Publishes the images into the assets directory (see
+    `publish_article_images`) and returns the correct path to use in the HTML
+    file as image src (see `get_image_info`).
+    """
+    tree = read_image_insets(lyx_path)
+    image_info_and_map = get_image_info(tree, assets_rel_dir, front_matters)
+    # We publish the images only after having parsed the whole file.
+    publish_article_images(tree, blog_dir, assets_rel_dir, front_matters,
+                           update, changed_outputs,
+                           os.path.dirname(lyx_path))
+    return image_info_and_map
+
+
+MANGLED_ENVS = ['align', 'align*',
+                'alignat', 'alignat*',
+                'eqnarray', 'eqnarray*'
+                'gather', 'gather*',
+                'multline', 'multline*',
+                ]
+
+# NOTE:
+#   We never slice `latex` but use the `pos` argument of `search` and `match`
+#   so that the scan is linear in the size of the document. Since `^` doesn't
+#   match at `pos` when `pos` isn't at the start of a line, MATH_ENV_AT_RE is
+#   tried at `pos` first.
+_mangled_envs_re = "|".join(re.escape(env) for env in MANGLED_ENVS)
+MATH_ENV_AT_RE = re.compile(r'\\begin{(%s)}' % _mangled_envs_re)
+# Note: LyX puts `\begin` at the start of its line so we can use '^'.
+MATH_ENV_OR_REF_RE = re.compile(
+    r'^\\begin{(%s)}|\\(ref|eqref){[^}]*}|\\begin{(verbatim)}'
+    % _mangled_envs_re, flags=re.MULTILINE)
+END_VERBATIM_STR = r"\end{verbatim}"
+
+# math env -> regex used to find its end
+_math_env_end_res = {}
+
+
+def _get_math_env_end_re(math_env):
+    search_re = _math_env_end_res.get(math_env)
+    if search_re is None:
+        escaped_math_env = re.escape(math_env)      # escapes '*'
+        search_re = re.compile(r"\\begin{verbatim}|\\begin{%s}|\\end{%s}" %
+                               (escaped_math_env, escaped_math_env))
+        _math_env_end_res[math_env] = search_re
+    return search_re
 
 
 def get_math_env_pos(latex):
     def find_end(math_env, start):
-        escaped_math_env = re.escape(math_env)      # escapes '*'
-        search_re = r"\\begin{verbatim}|\\begin{%s}|\\end{%s}" % \
-                    (escaped_math_env, escaped_math_env)
+        search_re = _get_math_env_end_re(math_env)
         begin_env = r"\begin{%s}" % math_env
         open_occ = 1
         while True:
-            m = re.search(search_re, latex[start:])
-            start += m.end(0)
+            m = search_re.search(latex, start)
             if m is None:
-                raise Exception("Can't find closing \end{}")
+                raise Exception("Can't find closing \\end{}")
+            start = m.end(0)
             if m[0] == r"\begin{verbatim}":
-                pos = latex.find(r"\end{verbatim}", start)
+                pos = latex.find(END_VERBATIM_STR, start)
                 if pos == -1:
-                    raise Exception("Can't find closing \end{verbatim}")
-                start = pos + len(r"\end{verbatim}")
+                    raise Exception("Can't find closing \\end{verbatim}")
+                start = pos + len(END_VERBATIM_STR)
             elif m[0] == begin_env:
                 open_occ += 1           # another nested one
             else:           # end_env
@@ -220,33 +325,27 @@ def get_math_env_pos(latex):
                 if open_occ == 0:
                     return start
 
-    mangled_envs = ['align', 'align*',
-                    'alignat', 'alignat*',
-                    'eqnarray', 'eqnarray*'
-                    'gather', 'gather*',
-                    'multline', 'multline*',
-                    ]
-    mangled_envs = [re.escape(env) for env in mangled_envs]     # escapes '*'
-
     pos = 0
     while True:
-        # Note: LyX puts `\begin` at the start of its line so we can use '^'.
-        m = re.search(
-            r'^\\begin{(%s)}|\\(ref|eqref){[^}]*}|\\begin{(verbatim)}'
-            % "|".join(mangled_envs), latex[pos:], flags=re.MULTILINE)
-        if m is None:
-            break
-        start = pos + m.start(0)
-        end = pos + m.end(0)
+        m = MATH_ENV_AT_RE.match(latex, pos)
+        if m is not None:
+            math_env = m[1]
+        else:
+            m = MATH_ENV_OR_REF_RE.search(latex, pos)
+            if m is None:
+                break
+            math_env = m[1] if m.lastindex == 1 else None
+        start = m.start(0)
+        end = m.end(0)
         if m.lastindex == 3:        # verbatim
-            pos = latex.find(r"\end{verbatim}", end)
+            pos = latex.find(END_VERBATIM_STR, end)
             if pos == -1:
-                raise Exception("Can't find closing \end{verbatim}")
+                raise Exception("Can't find closing \\end{verbatim}")
             end = pos           # we skip it
         elif m.lastindex == 2:      # (eq)ref
             yield start, end, 'inline'
         else:                       # math env
-            end = find_end(m[1], start=end)
+            end = find_end(math_env, start=end)
             yield start, end, 'block'
         pos = end
 
@@ -270,8 +369,7 @@ def protect_math_envs(latex):
     return ''.join(output)
 
 
-def add_mathjax_conf(html):
-    conf = '''
+MATHJAX_CONF = '''
         <script type="text/javascript" 
             src="//cdnjs.cloudflare.com/ajax/libs/mathjax/2.7.2/MathJax.js?config=TeX-AMS-MML_HTMLorMML">
         </script>
@@ -281,23 +379,27 @@ def add_mathjax_conf(html):
         });
         </script>
         '''
-    return conf + html
+
+
+def add_mathjax_conf(html):
+    return MATHJAX_CONF + html
 
 
 def get_section_label_info(html_path):
     UID = 'guy76r856itybr6dv76e47igyuytb098hjkl'    # see filter_num.py
-    re_str = (r'^<h. id="' + UID +
-              r'"><span class="header-section-number">([^<]+)' +
-              r'</span>(.*)</h.>$')
+    # pandoc 2 puts the number in a span, pandoc 3 (also) in `data-number`.
+    re_str = (r'^<h.(?: data-number="([^"]+)")? id="' + UID + r'"[^>]*>'
+              r'(?:<span class="header-section-number">([^<]+)</span>)?'
+              r'(.*)</h.>$')
 
     section_info = []
     name_to_num = {}
     with open(html_path, 'r', encoding='utf-8') as f:
         for line in f:
             m = re.match(re_str, line, flags=re.I)
-            if m:
-                num = m[1]
-                name = m[2]
+            if m and (m[1] or m[2]):
+                num = m[2] or m[1]
+                name = m[3]
                 m2 = re.match(r'.*\[([^]]+)\]', name)
                 label_name = m2[1] if m2 else None
                 section_info.append((m[0], num, name, label_name))
@@ -306,167 +408,1189 @@ def get_section_label_info(html_path):
     return section_info, name_to_num
 
 
-def fix_figure_tag(html):
-    UID2 = '86345huihsdfguhsjlkertvxgkh3498asdg'
-    new_html = []
-    start = 0
-    while True:
-        m = re.search(r'<figure()>\n<img src=.*?({}:([^"]+))'.format(UID2),
-                      html[start:])
-        if m is None:
-            break
+UID2 = '86345huihsdfguhsjlkertvxgkh3498asdg'
+FIGURE_IMG_RE = re.compile(r'<img src=.*?({}:([^"]+))'.format(UID2))
 
-        pos1 = start + m.start(1)
-        new_html.append(html[start: pos1])
 
-        new_html.append(' style="margin-left: {}; margin-right: {};"'
-                        .format(m[3], m[3]))
+def fix_figure_tag_lines(lines):
+    """
+    Generator version of `fix_figure_tag` which works on an iterable of lines
+    (with their '\n') so that we can stream the HTML file.
 
-        # Remove the fake class from image
-        pos2 = start + m.start(2)       # right before fake class
-        pos3 = start + m.end(2)         # right after fake class
-        pos4 = start + m.end(0)
-        new_html.append(html[pos1: pos2])
-        new_html.append(html[pos3: pos4])
+    A line ending with '<figure>' is held back until we see the next line,
+    since the fake class (see filter.py) in the next line determines the
+    margins of the figure.
+    """
+    pending = None
+    for line in lines:
+        if pending is not None and pending.endswith('<figure>\n'):
+            m = FIGURE_IMG_RE.match(line)
+            if m:
+                pending = (pending[:-len('>\n')] +
+                           ' style="margin-left: {}; margin-right: {};"'
+                           .format(m[2], m[2]) + '>\n')
 
-        start = pos4
+                # Remove the fake class from image
+                line = line[:m.start(1)] + line[m.end(1):]
+        if pending is not None:
+            yield pending
+        pending = line
+    if pending is not None:
+        yield pending
 
-    new_html.append(html[start:])
 
-    return ''.join(new_html)
+def fix_figure_tag(html):
+    return ''.join(fix_figure_tag_lines(html.splitlines(keepends=True)))
 
 
 def add_style_text(html, style_text):
     return '<style>' + style_text + '</style>' + html
 
 
-def print_usage():
-    print('LyXBlog [--update] [--args_from_file] <input file> <blog base dir> '
-          '<assets relative dir>')
+CITEPROC_METADATA_ARGS = ['--metadata', 'link-citations=true',
+                          '--metadata', 'reference-section-title=Bibliography']
 
+_pandoc_version = None
 
-def main(script_path, argv):
-    update = False
-    args_from_file = False
-    if '--update' in argv:
-        update = True
-        argv.remove('--update')
-    if '--args_from_file' in argv:
-        args_from_file = True
-        argv.remove('--args_from_file')
 
-    if args_from_file:
-        if len(argv) != 1:
-            print_usage()
-            sys.exit(2)
-        lyx_path = argv[0]
-    else:
-        if len(argv) != 3:
-            print_usage()
-            sys.exit(2)
-        lyx_path, blog_dir, assets_rel_dir = argv
+def get_pandoc_version(cache=None):
+    """
+    Returns the version of the local pandoc (e.g. '2.9.2.1'), or '' if it's
+    unknown. It's only looked up once per process (through `cache`, a
+    BuildCache, if given).
+    """
+    global _pandoc_version
+    if _pandoc_version is None:
+        if cache is not None:
+            text = cache.tool_version('pandoc')
+        else:
+            try:
+                text = str(run_pandoc(['--version']), 'utf-8', 'replace')
+            except Exception:
+                text = ''
+        m = re.search(r'\d+(?:\.\d+)+', text)
+        _pandoc_version = m[0] if m else ''
+    return _pandoc_version
+
+
+def get_citeproc_args():
+    # pandoc 2.11 replaced the filter pandoc-citeproc with `--citeproc`.
+    version = tuple(int(n) for n in get_pandoc_version().split('.') if n)
+    if version >= (2, 11):
+        return ['--citeproc'] + CITEPROC_METADATA_ARGS
+    return ['--filter', 'pandoc-citeproc'] + CITEPROC_METADATA_ARGS
 
+
+def _check_pandoc(returncode, stdout, stderr):
+    if returncode != 0:
+        raise Exception("Something's wrong with executing pandoc:\n" +
+                        str(stderr, 'utf-8') + str(stdout, 'utf-8') +
+                        "\n")
+    return stdout
+
+
+def run_pandoc(args, input=None, env=None, cwd=None):
+    """
+    Runs pandoc with the given arguments and returns its stdout.
+    """
+    p = subprocess.run(['pandoc'] + args, input=input, env=env, cwd=cwd,
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return _check_pandoc(p.returncode, p.stdout, p.stderr)
+
+
+async def run_pandoc_async(args, input=None, env=None, cwd=None):
+    """
+    Like `run_pandoc`, but without blocking the event loop.
+    """
+    from scheduler import run_subprocess
+    return _check_pandoc(*await run_subprocess(['pandoc'] + args, input, env,
+                                               cwd=cwd))
+
+
+async def lyx_to_tex(lyx_path, tex_path, lyx_pipe=None):
+    """
+    Exports the LyX file to the LaTeX file `tex_path` (LyX also puts there the
+    files the TeX file needs). If `lyx_pipe` is given, we first ask the LyX
+    listening on that LyXServer pipe to do it, which saves us LyX's startup.
+
+    Returns whether the TeX file comes from the LyX file on disk, which isn't
+    the case if it was exported from a document open in LyX (see
+    lyx_server.export_latex).
+    """
+    import asyncio
+    from scheduler import run_subprocess
+
+    if lyx_pipe is not None:
+        from lyx_server import export_latex, LyXServerUnavailable
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, export_latex, lyx_pipe, os.path.abspath(lyx_path),
+                os.path.abspath(tex_path))
+        except LyXServerUnavailable:
+            pass            # we'll run LyX ourselves
+
+    returncode, stdout, _ = await run_subprocess(
+        ['lyx', '--export-to', 'latex', tex_path, lyx_path],
+        stderr=subprocess.STDOUT)
+    if returncode != 0:
+        raise Exception("Something's wrong with executing LyX:\n" +
+                        str(stdout, 'utf-8') + "\n")
+    return True
+
+
+def write_filter_info(work_dir, section_info_and_map, image_info_and_map,
+                      math_info, index_info):
+    # Everything filter.py needs, in a compact JSON file which it loads fast
+    # (see filter.load_info).
+    from workspace import FILTER_INFO_FILE_NAME
+    info = {'label_info': section_info_and_map,
+            'image_info': image_info_and_map,
+            'math_info': math_info,
+            'index_info': index_info}
+    with open(os.path.join(work_dir, FILTER_INFO_FILE_NAME), 'w',
+              encoding='utf-8') as f:
+        json.dump(info, f, separators=(',', ':'))
+
+
+async def tex_to_html_two_pass(script_path, tex_path, html_path,
+                               image_info_and_map, profiler=None,
+                               math_info=None, index_info=None,
+                               work_dir=None):
+    """
+    Converts the TeX file into HTML with two runs of pandoc and our filters.
+
+    The filters get their data through files in `work_dir` (by default, the
+    directory of the TeX file), which must be private to this conversion.
+    pandoc runs in `work_dir`, so the files the TeX file refers to must be
+    there or have absolute paths.
+    """
+    from workspace import WORKSPACE_ENV_VAR
+    profiler = profiler or Profiler()
     filter_num_path = os.path.join(os.path.dirname(script_path),
                                    'filter_num.py')
     filter_path = os.path.join(os.path.dirname(script_path), 'filter.py')
+    work_dir = os.path.abspath(work_dir or os.path.dirname(tex_path))
+    env = dict(profiler.filter_env() or os.environ,
+               **{WORKSPACE_ENV_VAR: work_dir})
+    # We need the version of pandoc for pass 2, so we look it up meanwhile.
+    import asyncio
+    citeproc_args = asyncio.get_running_loop().run_in_executor(
+        None, get_citeproc_args)
 
-    # Change the working directory
-    os.chdir(os.path.dirname(lyx_path))
+    # TeX to html
+    with profiler.stage('pandoc pass 1'):
+        await run_pandoc_async(['--mathjax',
+                                '--filter', filter_num_path,
+                                '--number-sections',
+                                tex_path, '-o', html_path],
+                               env=env, cwd=work_dir)
+
+    with profiler.stage('get_section_label_info'):
+        section_info_and_map = get_section_label_info(html_path)
+        write_filter_info(work_dir, section_info_and_map, image_info_and_map,
+                          math_info, index_info)
 
-    no_ext_path = os.path.splitext(lyx_path)[0]
-    tex_path = no_ext_path + '.tex'
-    html_path = no_ext_path + '.html'
+    # TeX to html
+    with profiler.stage('pandoc pass 2'):
+        await run_pandoc_async(['--mathjax',
+                                '--filter', filter_path] +
+                               await citeproc_args +
+                               ['--number-sections',
+                                tex_path, '-o', html_path],
+                               env=env, cwd=work_dir)
+    profiler.collect_filter_runs()
 
-    # LyX to TeX
-    p = subprocess.run(['lyx', '--export', 'latex', lyx_path],
-                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    if p.returncode != 0:
-        raise Exception("Something's wrong with executing LyX:\n" +
-                        str(p.stdout, 'utf-8') + "\n")
 
-    # We get the front matter from the TeX file rather than directly from the
-    # LyX file because it's simpler.
-    front_matters = FrontMatters.from_file(tex_path)
+def get_bib_paths(latex, dirs=('',)):
+    """
+    Returns the paths of the bibliography files used by the TeX file. Relative
+    paths are looked up in `dirs`, in order.
+    """
+    paths = []
+    for m in re.finditer(r'\\bibliography{([^}]*)}', latex):
+        for name in m[1].split(','):
+            name = name.strip()
+            if not os.path.splitext(name)[1]:
+                name += '.bib'
+            candidates = [os.path.join(dir, name) for dir in dirs]
+            paths.append(next((path for path in candidates
+                               if os.path.exists(path)), candidates[-1]))
+    return paths
 
-    if args_from_file:
-        args = front_matters.our_fm.get('args', None)
-        if args is None:
-            raise Exception("Can't find 'args' in front matter!")
-        try:
-            blog_dir = args['blog_base_dir']
-            assets_rel_dir = args['assets_rel_dir']
-        except KeyError as e:
-            raise Exception("Can't find {} in 'args' in front matter!"
-                            .format(e))
-
-    # Copies the images into the assets directory and returns the correct path
-    # to use in the HTML file as image src.
-    image_info_and_map = handle_images(lyx_path, blog_dir, assets_rel_dir,
-                                       front_matters, update)
-    pickle.dump(image_info_and_map, open('lyxblog_image_info.p', 'wb'))
-
-    with open(tex_path, 'r+', encoding='utf-8') as f:
-        latex = f.read()
 
-        # Fix the TeX file to support labels and references through MathJax.
-        latex = protect_math_envs(latex)
+REF_NAME_RE = re.compile(r'\\(?:eq)?ref{([^}]*)}')
 
-        # Remove the front matter.
-        latex = FrontMatters.remove_from_file(latex)
 
-        f.seek(0)
-        f.write(latex)
-        f.truncate()
+def get_html_cache_key(cache, script_path, latex, image_info_and_map,
+                       single_pass, pandoc_pool=None, math_info=None,
+                       index_info=None, tex_dir=''):
+    """
+    Returns the cache key of the HTML produced by pandoc (i.e. before the
+    transformations done by `main`) from the TeX file `latex` in `tex_dir`.
 
-    # TeX to html
-    p = subprocess.run(['pandoc', '--mathjax',
-                        '--filter', filter_num_path,
-                        '--number-sections',
-                        tex_path, '-o', html_path],
-                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    if p.returncode != 0:
-        raise Exception("Something's wrong with executing pandoc:\n" +
-                        str(p.stdout, 'utf-8') + "\n")
+    With the label index, the key also depends on the labels of the other
+    articles the TeX file might reference.
+    """
+    script_dir = os.path.dirname(script_path)
+    parts = ['html', latex, repr(image_info_and_map), str(single_pass),
+             cache.tool_version('pandoc'),
+             cache.tool_version('pandoc-citeproc')]
+    if single_pass and pandoc_pool is not None:
+        parts.append(pandoc_pool.version() or '')
+    if math_info is not None:
+        from math_render import get_renderer
+        # The equations themselves are cached separately.
+        parts += [math_info['renderer'], math_info['macros'],
+                  get_renderer(math_info['renderer']).version(cache)]
+    for name in ['LyXBlog.py', 'filter.py', 'filter_num.py', 'pandoc_ast.py',
+                 'math_render.py', 'bibliography.py']:
+        parts.append(hash_file(os.path.join(script_dir, name)))
+    for bib_path in get_bib_paths(latex, [tex_dir]):
+        parts.append(hash_file(bib_path) if os.path.exists(bib_path) else '')
+    if index_info is not None:
+        from label_index import LabelIndex
+        article = index_info['article']
+        with LabelIndex(index_info['path']) as label_index:
+            for name in sorted(set(REF_NAME_RE.findall(latex))):
+                parts.append(repr(label_index.lookup(name, article)))
+    return hash_bytes(*parts)
+
+
+_in_process_filter_lock = threading.Lock()
+
+
+def tex_to_json(latex, pandoc_pool=None, work_dir=None):
+    """
+    Parses the TeX file `latex` into a pandoc AST, through `pandoc_pool` if
+    possible. pandoc runs in `work_dir`.
+    """
+    doc_json = None
+    if pandoc_pool is not None:
+        doc_json = pandoc_pool.convert({'text': latex,
+                                        'from': 'latex', 'to': 'json'})
+    if doc_json is None:
+        doc_json = str(run_pandoc(['-f', 'latex', '-t', 'json'],
+                                  input=latex.encode('utf-8'), cwd=work_dir),
+                       'utf-8')
+    return json.loads(doc_json)
+
+
+def tex_to_json_chunked(latex, chunks, pandoc_pool=None, work_dir=None):
+    """
+    Like `tex_to_json`, but the TeX file is split into up to `chunks` chunks
+    which are parsed in parallel (see chunking.py).
+    """
+    import concurrent.futures
+    from chunking import split_tex, merge_docs
+
+    texts = split_tex(latex, chunks)
+    if len(texts) > 1:
+        with concurrent.futures.ThreadPoolExecutor(len(texts)) as executor:
+            docs = list(executor.map(
+                lambda text: tex_to_json(text, pandoc_pool, work_dir), texts))
+        doc = merge_docs(docs)
+        if doc is not None:
+            return doc
+    return tex_to_json(latex, pandoc_pool, work_dir)
+
+
+def tex_to_html_single_pass(tex_path, html_path, image_info_and_map,
+                            pandoc_pool=None, profiler=None, math_info=None,
+                            cache=None, index_info=None, work_dir=None,
+                            chunks=None):
+    """
+    Converts the TeX file into HTML by parsing it only once: pandoc produces
+    the AST, we number the sections and apply our filter in-process, and then
+    pandoc renders the AST into HTML.
 
-    section_info_and_map = get_section_label_info(html_path)
-    pickle.dump(section_info_and_map, open('lyxblog_label_info.p', 'wb'))
+    Unlike the two-pass conversion, no filter interpreter is started and no
+    info file is written for the filter. The filter keeps its state in its
+    module, so the in-process conversions run one at a time.
 
-    # TeX to html
-    p = subprocess.run(['pandoc', '--mathjax',
-                        '--filter', filter_path,
-                        '--filter', 'pandoc-citeproc',
-                        '--metadata', 'link-citations=true',
-                        '--metadata', 'reference-section-title=Bibliography',
-                        '--number-sections',
-                        tex_path, '-o', html_path],
-                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    if p.returncode != 0:
-        raise Exception("Something's wrong with executing pandoc:\n" +
-                        str(p.stdout, 'utf-8') + "\n")
+    If `pandoc_pool` (a PandocServerPool) is given, the conversions are sent to
+    its pandoc servers; we fall back to running pandoc if they're unreachable.
 
-    # Transform the HTML file.
-    with open(html_path, 'r', encoding='utf-8') as f:
-        html = f.read()
+    Citeproc is only run on the citations, and its output is cached in `cache`
+    (see bibliography.format_citations).
 
-    if 'style' in front_matters.our_fm:
-        html = add_style_text(html, front_matters.our_fm['style'])
+    pandoc runs in `work_dir` (by default, the directory of the TeX file). If
+    `chunks` > 1, the TeX file is parsed in up to `chunks` parallel chunks
+    (see chunking.py), with the same result.
+    """
+    from pandoc_ast import walk
+    import filter_num
+    import filter as lyxblog_filter
 
-    html = fix_figure_tag(html)
+    profiler = profiler or Profiler()
+
+    work_dir = os.path.abspath(work_dir or os.path.dirname(tex_path))
+    with open(tex_path, 'r', encoding='utf-8') as f:
+        latex = f.read()
+    bib_paths = get_bib_paths(latex, [work_dir])
+
+    with profiler.stage('pandoc tex->json'):
+        if chunks is not None and chunks > 1:
+            doc = tex_to_json_chunked(latex, chunks, pandoc_pool, work_dir)
+        else:
+            doc = tex_to_json(latex, pandoc_pool, work_dir)
+
+    # NOTE: pandoc 1.18 or later, so `doc` is always a dict.
+    with profiler.stage('number_sections'):
+        section_info_and_map = filter_num.number_sections(doc['blocks'])
+
+    with profiler.stage('filter (in-process)'), _in_process_filter_lock:
+        lyxblog_filter.set_info(section_info_and_map, image_info_and_map,
+                                math_info, index_info)
+        for action in lyxblog_filter.get_actions():
+            start_wall, start_cpu = time.perf_counter(), time.thread_time()
+            doc = walk(doc, action, 'html', doc['meta'])
+            profiler.add_filter_run({
+                'name': 'filter.py:' + action.__name__,
+                'wall': time.perf_counter() - start_wall,
+                'cpu': time.thread_time() - start_cpu})
+        lyxblog_filter.save_labels()
+
+    with profiler.stage('citeproc'):
+        from bibliography import format_citations
+        citeproc_version = ''
+        if cache is not None:
+            get_pandoc_version(cache)       # so that it's looked up there
+            citeproc_version = ' '.join([cache.tool_version('pandoc'),
+                                         cache.tool_version('pandoc-citeproc'),
+                                         repr(get_citeproc_args())])
+            if pandoc_pool is not None:
+                citeproc_version += ' ' + (pandoc_pool.version() or '')
+        citeproc_done = format_citations(
+            doc, bib_paths,
+            lambda mini_doc: run_citeproc(mini_doc, pandoc_pool, bib_paths,
+                                          work_dir),
+            cache, citeproc_version)
+
+    with profiler.stage('pandoc json->html'):
+        json_to_html(doc, html_path, pandoc_pool, bib_paths,
+                     citeproc=not citeproc_done, work_dir=work_dir)
+
+
+def _get_server_doc(doc):
+    # The server can't run filters and takes no metadata, but it has citeproc
+    # built in (pandoc 3), and the metadata can go in the AST.
+    return dict(doc, meta=dict(
+        doc['meta'],
+        **{'link-citations': {'t': 'MetaBool', 'c': True},
+           'reference-section-title': {'t': 'MetaString',
+                                       'c': 'Bibliography'}}))
+
+
+def _read_files(paths, work_dir=None):
+    # The files are named as in the TeX file, i.e. relative to `work_dir`.
+    files = {}
+    for path in paths:
+        if os.path.exists(path):
+            name = path
+            if work_dir is not None and \
+                    os.path.dirname(os.path.abspath(path)) == work_dir:
+                name = os.path.basename(path)
+            with open(path, 'rb') as f:
+                files[name] = f.read()
+    return files
+
+
+def run_citeproc(doc, pandoc_pool, bib_paths, work_dir=None):
+    """
+    Applies citeproc to the pandoc AST `doc` and returns the resulting AST,
+    through `pandoc_pool` if possible. pandoc runs in `work_dir`.
+    """
+    doc_json = None
+    if pandoc_pool is not None:
+        server_doc = _get_server_doc(doc)
+        doc_json = pandoc_pool.convert({'text': json.dumps(server_doc),
+                                        'from': 'json', 'to': 'json',
+                                        'citeproc': True},
+                                       files=_read_files(bib_paths, work_dir))
+    if doc_json is None:
+        doc_json = str(run_pandoc(['-f', 'json', '-t', 'json'] +
+                                  get_citeproc_args(),
+                                  input=json.dumps(doc).encode('utf-8'),
+                                  cwd=work_dir),
+                       'utf-8')
+    return json.loads(doc_json)
+
+
+def json_to_html(doc, html_path, pandoc_pool, bib_paths, citeproc=True,
+                 work_dir=None):
+    """
+    Renders the (filtered) pandoc AST `doc` into HTML, through `pandoc_pool` if
+    possible, and applies citeproc if `citeproc`. `bib_paths` are only needed
+    by the pandoc servers. pandoc runs in `work_dir`.
+    """
+    html = None
+    if pandoc_pool is not None:
+        html = pandoc_pool.convert({'text': json.dumps(_get_server_doc(doc)),
+                                    'from': 'json', 'to': 'html',
+                                    'html-math-method': 'mathjax',
+                                    'number-sections': True,
+                                    'citeproc': citeproc},
+                                   files=_read_files(bib_paths, work_dir)
+                                   if citeproc else {})
+    if html is not None:
+        with open(html_path, 'w', encoding='utf-8') as f:
+            f.write(html)
+    else:
+        run_pandoc(['-f', 'json', '--mathjax'] +
+                   (get_citeproc_args() if citeproc else []) +
+                   ['--number-sections', '-o', os.path.abspath(html_path)],
+                   input=json.dumps(doc).encode('utf-8'), cwd=work_dir)
 
-    # Activates equation numbering support in MathJax.
-    html = add_mathjax_conf(html)
 
+def get_post_head(front_matters, math_conf=MATHJAX_CONF, excerpt=None):
+    """
+    Returns what `post_process_html` writes before the HTML content: Jekyll's
+    front matter (with `excerpt`, if given and not already there), `math_conf`
+    and the style of the article.
+    """
     # Prepend Jekyll's front matter to the HTML file.
-    html = front_matters.dump_jekyll_fm() + html
-
-    # Write the html content into a properly named file in the correct subdir
-    # in _posts.
-    date_basename = front_matters.get_date_html_fname()
-    dest_html_path = os.path.join(blog_dir, '_posts', date_basename + '.html')
-    if not update and os.path.exists(dest_html_path):
-        raise Exception('Already exists: ' + dest_html_path)
-    with open(dest_html_path, 'w', encoding='utf-8') as f:
-        f.write(html)
+    head = front_matters.dump_jekyll_fm(
+        {'excerpt': excerpt} if excerpt is not None else None)
+
+    # Activates equation numbering support in MathJax.
+    head += math_conf
+
+    if 'style' in front_matters.our_fm:
+        head += add_style_text('', front_matters.our_fm['style'])
+    return head
+
+
+def post_process_html(html_path, dest_html_path, front_matters,
+                      image_attrs=None, math_conf=MATHJAX_CONF, excerpt=None,
+                      inlined_images=None):
+    """
+    Transforms the HTML file produced by pandoc and writes the result to
+    `dest_html_path`.
+
+    This is equivalent to applying `add_style_text`, `fix_figure_tag`,
+    `add_mathjax_conf` and prepending Jekyll's front matter, but the HTML file
+    is processed a line at a time so we never hold a copy of it in memory.
+
+    `image_attrs` are the attributes to add to the images (see
+    `optimize_images`). `math_conf` replaces the configuration of MathJax when
+    the math is rendered at build time. `excerpt` goes into Jekyll's front
+    matter (see `get_post_head`). `inlined_images` are the images to put
+    directly into the page (see `inline_images`).
+
+    `dest_html_path` is replaced atomically, and only if its content changes,
+    so that Jekyll doesn't regenerate the page for nothing. Returns whether it
+    changed.
+    """
+    tmp_path = get_tmp_path(dest_html_path)
+    try:
+        with open(html_path, 'r', encoding='utf-8') as src, \
+                open(tmp_path, 'w', encoding='utf-8') as dest:
+            dest.write(get_post_head(front_matters, math_conf, excerpt))
+
+            lines = fix_figure_tag_lines(src)
+            if image_attrs:
+                from images import add_image_attrs_lines
+                lines = add_image_attrs_lines(lines, image_attrs,
+                                              inlined_images or ())
+            if inlined_images:
+                from images import inline_images_lines
+                lines = inline_images_lines(lines, inlined_images)
+            dest.writelines(lines)
+    except BaseException:
+        remove_if_exists(tmp_path)
+        raise
+    return replace_if_changed(tmp_path, dest_html_path)
+
+
+def print_usage():
+    print('LyXBlog [--update] [--args_from_file] [--single_pass] [--cache] '
+          '[--cache_dir <dir>] [--pandoc_servers <url,...>] '
+          '[--pandoc_pool <n>] [--lyx_server <pipe>] [--profile] '
+          '[--profile_json <file>] [--cprofile <stage>] [--optimize_images] '
+          '[--image_widths <w,...>] [--inline_images <bytes>] '
+          '[--prerender_math <renderer>] '
+          '[--chunks <n>] [--excerpt] [--search_index] <input file> '
+          '<blog base dir> <assets relative dir>')
+    print('LyXBlog --batch <dir|glob> [--jobs <n>] [<options as above>] '
+          '[<blog base dir> <assets relative dir>]')
+    print('LyXBlog --watch <dir|glob> [<options as above>] '
+          '[<blog base dir> <assets relative dir>]')
+    print('LyXBlog --dangling_refs <blog base dir>')
+
+
+def pop_option_value(argv, option):
+    """
+    Removes `option` and its value from `argv` and returns the value (or None
+    if `option` is not present).
+    """
+    if option not in argv:
+        return None
+    idx = argv.index(option)
+    if idx + 1 == len(argv):
+        print_usage()
+        sys.exit(2)
+    value = argv[idx + 1]
+    del argv[idx: idx + 2]
+    return value
+
+
+# Options followed by a value, and the ones whose value is a path.
+VALUE_OPTIONS = {'--batch', '--jobs', '--watch', '--cache_dir',
+                 '--pandoc_pool', '--pandoc_servers', '--lyx_server',
+                 '--profile_json', '--cprofile', '--image_widths',
+                 '--prerender_math', '--dangling_refs', '--chunks'}
+PATH_OPTIONS = {'--cache_dir', '--lyx_server', '--profile_json',
+                '--dangling_refs'}
+
+
+def split_options(argv):
+    """
+    Splits `argv` into options (with their values) and positional arguments.
+    The values of the options in PATH_OPTIONS are made absolute.
+    """
+    options = []
+    args = []
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg in VALUE_OPTIONS:
+            if i + 1 == len(argv):
+                print_usage()
+                sys.exit(2)
+            value = argv[i + 1]
+            if arg in PATH_OPTIONS:
+                value = os.path.abspath(value)
+            options += [arg, value]
+            i += 2
+        else:
+            if arg.startswith('--'):
+                options.append(arg)
+            else:
+                args.append(arg)
+            i += 1
+    return options, args
+
+
+def find_articles(dir_or_glob):
+    if os.path.isdir(dir_or_glob):
+        dir_or_glob = os.path.join(dir_or_glob, '**', '*.lyx')
+    return sorted(os.path.abspath(path)
+                  for path in glob.glob(dir_or_glob, recursive=True))
+
+
+def _publish_article(script_path, argv):
+    """
+    Runs `main` on a single article in a worker process and returns the error
+    message, or None on success.
+    """
+    try:
+        main(script_path, argv)
+    except SystemExit as e:
+        return 'exited with code {}'.format(e.code)
+    except Exception as e:
+        return str(e) or repr(e)
+    return None
+
+
+def split_shared_args(argv):
+    """
+    Checks and splits the options and arguments shared by all the articles in
+    batch and watch mode (i.e. everything but the input file).
+    """
+    options, args = split_options(argv)
+    if len(args) != (0 if '--args_from_file' in options else 2):
+        print_usage()
+        sys.exit(2)
+
+    # `main` resolves relative paths against the directory of each article,
+    # so we need absolute paths.
+    if args:
+        args[0] = os.path.abspath(args[0])          # blog base dir
+    return options, args
+
+
+def get_image_paths(lyx_path):
+    """
+    Returns the paths of the images referenced by the LyX file.
+    """
+    lyx_dir = os.path.dirname(lyx_path)
+    tree = build_inset_tree_from_file(lyx_path, ('Graphics',))
+    return [os.path.join(lyx_dir, graphics.params['filename'])
+            for graphics in iter_graphics(tree)
+            if 'filename' in graphics.params]
+
+
+def watch_main(script_path, dir_or_glob, argv):
+    """
+    Republishes the articles in `dir_or_glob` whenever they or their images
+    change. Everything runs in this process, which is kept warm (modules
+    imported, regexes compiled), so use `--single_pass` to get the most out of
+    it.
+    """
+    import importlib
+    import watch
+    # Pay for the imports now rather than at the first publish.
+    for name in ('asyncio', 'ruamel_yaml', 'scheduler', 'filter_num',
+                 'filter', 'workspace', 'label_index', 'republish',
+                 'bibliography', 'assets', 'images', 'math_render'):
+        importlib.import_module(name)
+
+    options, args = split_shared_args(argv)
+    dir_or_glob = os.path.abspath(dir_or_glob)
+
+    def publish(lyx_path):
+        print('Publishing ' + lyx_path + '...')
+        error = _publish_article(script_path, options + [lyx_path] + args)
+        if error is None:
+            print('OK      ' + lyx_path)
+        else:
+            print('FAILED  ' + lyx_path + ':\n' + error)
+
+    print('Watching ' + dir_or_glob + ' (press CTRL-C to stop)...')
+    try:
+        watch.watch_articles(lambda: find_articles(dir_or_glob),
+                             get_image_paths, publish)
+    except KeyboardInterrupt:
+        pass
+
+
+def batch_main(script_path, dir_or_glob, jobs, argv):
+    """
+    Publishes all the articles in `dir_or_glob` by running `main` on a pool of
+    worker processes. `argv` holds the options and arguments shared by all the
+    articles (i.e. everything but the input file).
+
+    Returns the number of articles that couldn't be published.
+    """
+    import concurrent.futures
+    options, args = split_shared_args(argv)
+
+    lyx_paths = find_articles(dir_or_glob)
+    if not lyx_paths:
+        raise Exception('No LyX files found in ' + dir_or_glob)
+
+    errors = {}
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        futures = {executor.submit(_publish_article, script_path,
+                                   options + [lyx_path] + args): lyx_path
+                   for lyx_path in lyx_paths}
+        for future in concurrent.futures.as_completed(futures):
+            lyx_path = futures[future]
+            try:
+                error = future.result()
+            except Exception as e:          # e.g. the worker died
+                error = str(e) or repr(e)
+            if error is None:
+                print('OK      ' + lyx_path)
+            else:
+                errors[lyx_path] = error
+                print('FAILED  ' + lyx_path)
+
+    print('\n{} published, {} failed (out of {})'.format(
+        len(lyx_paths) - len(errors), len(errors), len(lyx_paths)))
+    for lyx_path in sorted(errors):
+        print('\n' + lyx_path + ':\n' + errors[lyx_path])
+    return len(errors)
+
+
+def dangling_refs_main(blog_dir):
+    """
+    Prints the references, in all the published articles, to labels which no
+    article defines. Returns their number.
+    """
+    from label_index import LabelIndex, get_index_path
+    index_path = get_index_path(blog_dir)
+    if not os.path.exists(index_path):
+        raise Exception('No label index in ' + blog_dir)
+    with LabelIndex(index_path) as label_index:
+        for article in label_index.prune():
+            print('Removed from the index (LyX file not found): ' + article)
+        dangling = label_index.get_dangling_refs()
+    for article, name in dangling:
+        print('{}: {}'.format(article, name))
+    print('{} dangling reference(s)'.format(len(dangling)))
+    return len(dangling)
+
+
+def main(script_path, argv):
+    # We change the working directory below.
+    script_path = os.path.abspath(script_path)
+
+    pandoc_pool_size = pop_option_value(argv, '--pandoc_pool')
+    if pandoc_pool_size is not None:
+        if not (pandoc_pool_size.isdigit() and int(pandoc_pool_size) > 0):
+            print_usage()
+            sys.exit(2)
+        # The servers live as long as we do and are shared by all the
+        # articles (and batch workers). Only the single-pass mode uses them.
+        if '--single_pass' not in argv:
+            argv = argv + ['--single_pass']
+        from pandoc_pool import LocalPandocServers, PandocServersUnavailable
+        try:
+            with LocalPandocServers(int(pandoc_pool_size)) as servers:
+                main(script_path, argv + ['--pandoc_servers',
+                                          ','.join(servers.urls)])
+        except PandocServersUnavailable as e:       # e.g. pandoc < 3
+            print(str(e) + '\nRunning pandoc as usual.')
+            main(script_path, argv)
+        return
+
+    batch = pop_option_value(argv, '--batch')
+    jobs = pop_option_value(argv, '--jobs')
+    if batch is not None:
+        if jobs is not None and not (jobs.isdigit() and int(jobs) > 0):
+            print_usage()
+            sys.exit(2)
+        num_failed = batch_main(script_path, batch,
+                                int(jobs) if jobs else None, argv)
+        sys.exit(1 if num_failed else 0)
+
+    dangling_refs_dir = pop_option_value(argv, '--dangling_refs')
+    if dangling_refs_dir is not None:
+        num_dangling = dangling_refs_main(dangling_refs_dir)
+        sys.exit(1 if num_dangling else 0)
+
+    watch_dir = pop_option_value(argv, '--watch')
+    if watch_dir is not None:
+        watch_main(script_path, watch_dir, argv)
+        return
+
+    update = False
+    args_from_file = False
+    single_pass = False
+    use_cache = False
+    if '--update' in argv:
+        update = True
+        argv.remove('--update')
+    if '--args_from_file' in argv:
+        args_from_file = True
+        argv.remove('--args_from_file')
+    if '--single_pass' in argv:
+        single_pass = True
+        argv.remove('--single_pass')
+    if '--cache' in argv:
+        use_cache = True
+        argv.remove('--cache')
+    cache_dir = pop_option_value(argv, '--cache_dir')
+    pandoc_servers = pop_option_value(argv, '--pandoc_servers')
+    if pandoc_servers is not None:
+        single_pass = True          # the servers are only used in this mode
+    lyx_pipe = pop_option_value(argv, '--lyx_server')
+    if lyx_pipe is not None:
+        lyx_pipe = os.path.abspath(lyx_pipe)
+    print_profile = False
+    if '--profile' in argv:
+        print_profile = True
+        argv.remove('--profile')
+    profile_json_path = pop_option_value(argv, '--profile_json')
+    if profile_json_path is not None:
+        profile_json_path = os.path.abspath(profile_json_path)
+    cprofile_stage = pop_option_value(argv, '--cprofile')
+    optimize = False
+    if '--optimize_images' in argv:
+        optimize = True
+        argv.remove('--optimize_images')
+    image_widths = pop_option_value(argv, '--image_widths')
+    math_renderer = pop_option_value(argv, '--prerender_math')
+    if image_widths is not None:
+        try:
+            image_widths = [int(w) for w in image_widths.split(',')]
+        except ValueError:
+            print_usage()
+            sys.exit(2)
+    chunks = pop_option_value(argv, '--chunks')
+    if chunks is not None:
+        if not (chunks.isdigit() and int(chunks) > 0):
+            print_usage()
+            sys.exit(2)
+        chunks = int(chunks)
+        single_pass = True          # chunking needs the single-pass mode
+    inline_max_size = pop_option_value(argv, '--inline_images')
+    if inline_max_size is not None:
+        if not inline_max_size.isdigit():
+            print_usage()
+            sys.exit(2)
+        inline_max_size = int(inline_max_size)
+    add_excerpt = False
+    if '--excerpt' in argv:
+        add_excerpt = True
+        argv.remove('--excerpt')
+    search_index = False
+    if '--search_index' in argv:
+        search_index = True
+        argv.remove('--search_index')
+
+    if args_from_file:
+        if len(argv) != 1:
+            print_usage()
+            sys.exit(2)
+        lyx_path = argv[0]
+        blog_dir = assets_rel_dir = None        # in the front matter
+    else:
+        if len(argv) != 3:
+            print_usage()
+            sys.exit(2)
+        lyx_path, blog_dir, assets_rel_dir = argv
+
+    profiler = Profiler(enabled=(print_profile or
+                                 profile_json_path is not None or
+                                 cprofile_stage is not None),
+                        cprofile_stage=cprofile_stage)
+
+    cache = None
+    if cache_dir is not None:
+        cache = BuildCache(os.path.abspath(cache_dir))
+    elif use_cache:
+        cache = BuildCache()
+
+    pandoc_pool = None
+    if pandoc_servers is not None:
+        # Only the servers with the same pandoc as ours give the same output.
+        from pandoc_pool import PandocServerPool
+        pandoc_pool = PandocServerPool(
+            pandoc_servers.split(','),
+            local_version=get_pandoc_version(cache))
+
+    # This is also the id of the article in the label index.
+    lyx_path = article = os.path.abspath(lyx_path)
+    lyx_dir = os.path.dirname(lyx_path)
+
+    # The intermediate files go into a private temporary directory rather
+    # than next to the LyX file, so that nothing else, not even another
+    # publication of the same article, can get in the way. We never change the
+    # working directory.
+    from workspace import Workspace
+    from label_index import LabelIndex, get_index_path, get_permalink
+    workspace = Workspace()
+    base_name = os.path.splitext(os.path.basename(lyx_path))[0]
+    tex_path = workspace.path(base_name + '.tex')
+    html_path = workspace.path(base_name + '.html')
+
+    # The outputs we actually wrote or removed.
+    changed_outputs = []
+
+    # The stages below run as soon as the stages they depend on are done (see
+    # StageGraph): the images are read from the LyX file while LyX exports it,
+    # and they're published (and optimized) while pandoc converts the TeX
+    # file.
+
+    async def export_tex():
+        # LyX to TeX
+        with profiler.stage('lyx export'):
+            if cache is None:
+                await lyx_to_tex(lyx_path, tex_path, lyx_pipe)
+            else:
+                tex_key = hash_bytes('tex', hash_file(lyx_path),
+                                     cache.tool_version('lyx'))
+                if not cache.get_file(tex_key, tex_path):
+                    # The key is computed from the file on disk.
+                    if await lyx_to_tex(lyx_path, tex_path, lyx_pipe):
+                        cache.put_file(tex_key, tex_path)
+
+    def read_front_matter(_):
+        # The front matter isn't in the expected form in the LyX file, so we
+        # get it from the TeX file.
+        with profiler.stage('front matter'):
+            front_matters = FrontMatters.from_file(tex_path)
+        return resolve_front_matter(front_matters)
+
+    def resolve_front_matter(front_matters):
+        article_blog_dir, article_assets_rel_dir = blog_dir, assets_rel_dir
+        if args_from_file:
+            args = front_matters.our_fm.get('args', None)
+            if args is None:
+                raise Exception("Can't find 'args' in front matter!")
+            try:
+                article_blog_dir = args['blog_base_dir']
+                article_assets_rel_dir = args['assets_rel_dir']
+            except KeyError as e:
+                raise Exception("Can't find {} in 'args' in front matter!"
+                                .format(e))
+        # Relative to the directory of the LyX file.
+        article_blog_dir = os.path.join(lyx_dir, article_blog_dir)
+
+        # The html content goes into a properly named file in the correct
+        # subdir in _posts.
+        date_basename = front_matters.get_date_html_fname()
+        dest_html_path = os.path.join(article_blog_dir, '_posts',
+                                      date_basename + '.html')
+        if not update and os.path.exists(dest_html_path):
+            raise Exception('Already exists: ' + dest_html_path)
+        return (front_matters, article_blog_dir, article_assets_rel_dir,
+                dest_html_path)
+
+    def republish(fm):
+        # Patches the head of the post if only the front matter changed since
+        # the last publication (see republish.py). Returns the key of the
+        # body of the post and whether it was patched.
+        front_matters, article_blog_dir, article_assets_rel_dir, \
+            dest_html_path = fm
+        script_dir = os.path.dirname(script_path)
+        parts = [repr((single_pass, optimize, image_widths, math_renderer,
+                       add_excerpt, search_index, inline_max_size)),
+                 os.path.abspath(article_blog_dir), article_assets_rel_dir,
+                 front_matters.get_date_html_fname()]
+        parts += [hash_file(path) for path in
+                  sorted(glob.glob(os.path.join(script_dir, '*.py')))]
+        from republish import get_body_key, patch_post
+        index_path = get_index_path(article_blog_dir)
+        if not os.path.exists(index_path):
+            # Never published: no labels of other articles to reference.
+            return get_body_key(article, parts), False
+        with LabelIndex(index_path) as label_index:
+            body_key = get_body_key(article, parts, label_index, article)
+            post = label_index.get_post(article)
+            if not (update and post is not None and
+                    post[0] == os.path.abspath(dest_html_path) and
+                    post[1] == body_key and os.path.exists(dest_html_path)):
+                return body_key, False
+            extract = None
+            if add_excerpt or search_index:
+                extract = label_index.get_extract(article)
+                if extract is None:
+                    return body_key, False
+            changed = patch_post(dest_html_path,
+                                 get_post_head(front_matters, math_conf,
+                                               get_excerpt(extract)),
+                                 math_conf, post[2])
+            if changed is None:
+                return body_key, False
+            if changed:
+                changed_outputs.append(dest_html_path)
+            label_index.set_article(article, get_permalink(
+                article_blog_dir, front_matters.jekyll_fm,
+                front_matters.our_fm['html_file_name']))
+            label_index.set_post(article, post[0], body_key,
+                                 'style' in front_matters.our_fm)
+            # The title, the date or the URL may have changed.
+            update_search_index(fm, extract, label_index)
+        return body_key, True
+
+    def get_excerpt(extract):
+        return extract['excerpt'] if add_excerpt else None
+
+    def update_search_index(fm, extract, label_index):
+        if not search_index:
+            return
+        from extracts import (get_search_entry, write_search_index,
+                              SEARCH_INDEX_FILE_NAME)
+        front_matters, article_blog_dir, _, _ = fm
+        html_file_name = front_matters.our_fm['html_file_name']
+        entry = get_search_entry(
+            get_permalink(article_blog_dir, front_matters.jekyll_fm,
+                          html_file_name),
+            front_matters.jekyll_fm, html_file_name, extract)
+        path = os.path.join(article_blog_dir, SEARCH_INDEX_FILE_NAME)
+        if label_index.update_search_index(
+                article, front_matters.jekyll_fm['date'].isoformat(), entry,
+                lambda entries: write_search_index(path, entries)):
+            changed_outputs.append(path)
+
+    def update_label_index(fm):
+        front_matters, article_blog_dir, _, _ = fm
+        # Records the permalink of the article in the label index (its labels
+        # are recorded by filter.py).
+        with profiler.stage('label index'):
+            index_info = {'path': os.path.abspath(
+                              get_index_path(article_blog_dir)),
+                          'article': article}
+            with LabelIndex(index_info['path']) as label_index:
+                label_index.set_article(article, get_permalink(
+                    article_blog_dir, front_matters.jekyll_fm,
+                    front_matters.our_fm['html_file_name']))
+                # If the index was lost, we must convert the article again.
+                indexed = label_index.is_indexed(article)
+        return index_info, indexed
+
+    def read_images():
+        with profiler.stage('read images'):
+            return read_image_insets(lyx_path)
+
+    def get_article_image_info(tree, fm):
+        # The correct paths to use in the HTML file as image src.
+        front_matters, _, article_assets_rel_dir, _ = fm
+        return get_image_info(tree, article_assets_rel_dir, front_matters)
+
+    def publish_article_images_stage(tree, fm):
+        # Copies the images into the assets directory.
+        front_matters, article_blog_dir, article_assets_rel_dir, _ = fm
+        with profiler.stage('handle_images'):
+            publish_article_images(tree, article_blog_dir,
+                                   article_assets_rel_dir, front_matters,
+                                   update, changed_outputs, lyx_dir)
+
+    def optimize_article_images(image_info_and_map, fm, _):
+        if not optimize:
+            return None
+        with profiler.stage('optimize_images'):
+            from images import optimize_images
+            return optimize_images(fm[1], image_info_and_map[0],
+                                   image_widths, cache,
+                                   changed_outputs=changed_outputs)
+
+    def inline_article_images(image_info_and_map, fm, _):
+        if inline_max_size is None:
+            return None
+        with profiler.stage('inline_images'):
+            from images import inline_images
+            return inline_images(fm[1], image_info_and_map[0],
+                                 inline_max_size, cache)
+
+    def prepare_tex(_, fm):
+        with profiler.stage('protect_math_envs'):
+            with open(tex_path, 'r+', encoding='utf-8') as f:
+                latex = f.read()
+
+                math_info = None
+                if math_renderer is not None:
+                    from math_render import get_macros
+                    math_info = {'renderer': math_renderer,
+                                 'cache_dir': (cache.cache_dir
+                                               if cache is not None
+                                               else None),
+                                 'macros': get_macros(latex)}
+
+                # Fix the TeX file to support labels and references through
+                # MathJax.
+                latex = protect_math_envs(latex)
+
+                # Remove the front matter.
+                latex = FrontMatters.remove_from_file(latex)
+
+                # Give pandoc only the bibliography entries we cite.
+                from bibliography import reduce_bibliography
+                latex = reduce_bibliography(
+                    latex, get_bib_paths(latex, [lyx_dir, workspace.dir]),
+                    cache, workspace.dir)
+
+                f.seek(0)
+                f.write(latex)
+                f.truncate()
+        return latex, math_info
+
+    async def convert(image_info_and_map, prepared, index):
+        # TeX to html
+        latex, math_info = prepared
+        index_info, indexed = index
+        if cache is not None:
+            with profiler.stage('html cache lookup'):
+                html_key = get_html_cache_key(cache, script_path, latex,
+                                              image_info_and_map, single_pass,
+                                              pandoc_pool, math_info,
+                                              index_info, workspace.dir)
+                if indexed and cache.get_file(html_key, html_path):
+                    return
+        if single_pass:
+            import asyncio
+            await asyncio.get_running_loop().run_in_executor(
+                None, tex_to_html_single_pass, tex_path, html_path,
+                image_info_and_map, pandoc_pool, profiler, math_info, cache,
+                index_info, workspace.dir, chunks)
+        else:
+            await tex_to_html_two_pass(script_path, tex_path, html_path,
+                                       image_info_and_map, profiler,
+                                       math_info, index_info, workspace.dir)
+        if cache is not None:
+            cache.put_file(html_key, html_path)
+
+    def extract_text(_):
+        # The text of the article for the outputs other than the post.
+        if not (add_excerpt or search_index):
+            return None
+        from extracts import extract_html
+        with profiler.stage('extracts'):
+            return extract_html(html_path)
+
+    def post_process(fm, _, image_attrs, inlined_images, extract):
+        front_matters, _, _, dest_html_path = fm
+        with profiler.stage('post-processing'):
+            if post_process_html(html_path, dest_html_path, front_matters,
+                                 image_attrs, math_conf,
+                                 extract and get_excerpt(extract),
+                                 inlined_images):
+                changed_outputs.append(dest_html_path)
+
+    def print_profile_report():
+        if print_profile or cprofile_stage is not None:
+            print('Profile of ' + lyx_path + ':')
+            profiler.print_report()
+        if profile_json_path is not None:
+            profiler.append_json(profile_json_path, article=lyx_path)
+
+    math_conf = MATHJAX_CONF
+    if math_renderer is not None:
+        from math_render import get_renderer
+        math_conf = get_renderer(math_renderer).head_html
+
+    try:
+        # The front matter is normally the first ERT inset of the LyX file, so
+        # we can read and check it before running anything, and the images
+        # don't have to wait for LyX.
+        with profiler.stage('front matter'):
+            lyx_front_matters = FrontMatters.from_lyx(article)
+        body_key = None
+        if lyx_front_matters is not None:
+            fm = resolve_front_matter(lyx_front_matters)
+            with profiler.stage('republish'):
+                body_key, patched = republish(fm)
+            if patched:
+                print_changed_outputs(lyx_path, changed_outputs)
+                print_profile_report()
+                return
+
+        # The partial outputs of the failed stages are in the workspace.
+        from scheduler import StageGraph
+        graph = StageGraph()
+        graph.add('lyx export', export_tex)
+        graph.add('read images', read_images)
+        if lyx_front_matters is not None:
+            graph.add('front matter', lambda: fm)
+        else:
+            graph.add('front matter', read_front_matter, ['lyx export'])
+        graph.add('label index', update_label_index, ['front matter'])
+        graph.add('image info', get_article_image_info,
+                  ['read images', 'front matter'])
+        graph.add('handle_images', publish_article_images_stage,
+                  ['read images', 'front matter'])
+        graph.add('optimize_images', optimize_article_images,
+                  ['image info', 'front matter', 'handle_images'])
+        graph.add('inline_images', inline_article_images,
+                  ['image info', 'front matter', 'handle_images'])
+        # It rewrites the TeX file, so it must wait for 'front matter'.
+        graph.add('protect_math_envs', prepare_tex,
+                  ['lyx export', 'front matter'])
+        graph.add('tex to html', convert,
+                  ['image info', 'protect_math_envs', 'label index'])
+        graph.add('extracts', extract_text, ['tex to html'])
+        graph.add('post-processing', post_process,
+                  ['front matter', 'tex to html', 'optimize_images',
+                   'inline_images', 'extracts'])
+        results = graph.run()
+        fm, extract = results['front matter'], results['extracts']
+        front_matters, article_blog_dir, _, dest_html_path = fm
+    finally:
+        workspace.close()
+
+    # So that we can patch the post if only the front matter changes.
+    with LabelIndex(get_index_path(article_blog_dir)) as label_index:
+        label_index.set_post(article, os.path.abspath(dest_html_path),
+                             body_key, 'style' in front_matters.our_fm)
+        if extract is not None:
+            label_index.set_extract(article, extract)
+            with profiler.stage('search index'):
+                update_search_index(fm, extract, label_index)
+
+    print_changed_outputs(lyx_path, changed_outputs)
+    print_profile_report()
+
+
+def print_changed_outputs(lyx_path, changed_outputs):
+    if changed_outputs:
+        print('Changed outputs of ' + lyx_path + ':')
+        for path in changed_outputs:
+            print('  ' + path)
+    else:
+        print('No outputs of ' + lyx_path + ' changed.')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import shutil
+import concurrent.futures
+from cache import hash_file
+from output import get_tmp_path, write_if_changed, remove_if_exists
+
+try:
+    import fcntl                # not available on Windows
+except ImportError:
+    fcntl = None
+
+
+# The index of the published images, in the assets directory. Jekyll doesn't
+# publish files whose name starts with a '.'.
+INDEX_FILE_NAME = '.lyxblog_images.json'
+
+MAX_COPY_WORKERS = 8
+
+# ioctl which makes a file share the blocks of another (Linux: btrfs, XFS...)
+_FICLONE = 0x40049409
+
+
+def _reflink(src_path, dest_path):
+    """
+    Makes `dest_path` a copy-on-write clone of `src_path` and returns True, or
+    returns False if the filesystem doesn't support it.
+    """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    try:
+        with open(src_path, 'rb') as src, open(dest_path, 'wb') as dest:
+            fcntl.ioctl(dest.fileno(), _FICLONE, src.fileno())
+    except OSError:
+        try:
+            os.remove(dest_path)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+def _stamp(st):
+    return st.st_size, st.st_mtime_ns
+
+
+class _ImageIndex:
+    """
+    Content hashes of the images published in the assets directory, so that
+    we don't need to read them again to know whether they changed, and so
+    that identical images shared by different articles are stored only once.
+
+    It's just a hint: an entry is only trusted if the size and mtime of its
+    file haven't changed. Concurrent publishes may lose each other's updates,
+    which only costs a copy or a hash next time.
+    """
+    def __init__(self, assets_dir):
+        self.assets_dir = assets_dir
+        self.path = os.path.join(assets_dir, INDEX_FILE_NAME)
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                # relative path -> [hash, size, mtime_ns]
+                self.entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+        self.by_hash = {entry[0]: rel_path
+                        for rel_path, entry in self.entries.items()}
+
+    def get_hash(self, rel_path, st):
+        entry = self.entries.get(rel_path)
+        if entry is not None and tuple(entry[1:]) == _stamp(st):
+            return entry[0]
+        return None
+
+    def find(self, file_hash):
+        """
+        Returns the path of a published image with hash `file_hash`, or None.
+        """
+        rel_path = self.by_hash.get(file_hash)
+        if rel_path is None:
+            return None
+        path = os.path.join(self.assets_dir, rel_path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return path if self.get_hash(rel_path, st) == file_hash else None
+
+    def set(self, rel_path, file_hash, st):
+        self.entries[rel_path] = [file_hash] + list(_stamp(st))
+        self.by_hash[file_hash] = rel_path
+
+    def remove(self, rel_path):
+        entry = self.entries.pop(rel_path, None)
+        if entry is not None and self.by_hash.get(entry[0]) == rel_path:
+            del self.by_hash[entry[0]]
+
+    def save(self):
+        os.makedirs(self.assets_dir, exist_ok=True)
+        write_if_changed(self.path, json.dumps(self.entries).encode('utf-8'))
+
+
+def _publish_image(src_path, dest_path, rel_path, index):
+    """
+    Makes `dest_path` identical to `src_path`. Returns (action, hash, stat of
+    `dest_path`), where action is 'unchanged', 'linked' or 'copied'.
+    """
+    src_st = os.stat(src_path)
+    try:
+        dest_st = os.stat(dest_path)
+    except FileNotFoundError:
+        dest_st = None
+
+    # We copy the mtime, so this is the common case.
+    if dest_st is not None and _stamp(dest_st) == _stamp(src_st):
+        file_hash = index.get_hash(rel_path, dest_st) or hash_file(src_path)
+        return 'unchanged', file_hash, dest_st
+
+    file_hash = hash_file(src_path)
+    if dest_st is not None and dest_st.st_size == src_st.st_size:
+        dest_hash = index.get_hash(rel_path, dest_st) or hash_file(dest_path)
+        if dest_hash == file_hash:
+            return 'unchanged', file_hash, dest_st
+
+    # We never write into `dest_path` since it may be a hard link to the
+    # image of another article.
+    tmp_path = get_tmp_path(dest_path)
+    action = 'copied'
+    try:
+        same_path = index.find(file_hash)
+        if same_path is not None and same_path != dest_path:
+            if _reflink(same_path, tmp_path):
+                shutil.copystat(src_path, tmp_path)
+                action = 'linked'
+            else:
+                try:
+                    os.link(same_path, tmp_path)
+                    action = 'linked'
+                except OSError:
+                    pass
+        if action == 'copied':
+            if _reflink(src_path, tmp_path):
+                shutil.copystat(src_path, tmp_path)
+            else:
+                shutil.copy2(src_path, tmp_path)
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        remove_if_exists(tmp_path)
+        raise
+    return action, file_hash, os.stat(dest_path)
+
+
+def publish_images(src_paths, assets_dir, article_dir_name, update=True):
+    """
+    Publishes the images `src_paths` in `assets_dir/article_dir_name`:
+        - images which are already there and unchanged aren't copied again;
+        - images identical to already published ones (of any article) are
+          reflinked or hard linked to them, if the filesystem allows it;
+        - the others are copied (in parallel);
+        - with `update`, the images of the article which are no longer
+          referenced are removed.
+
+    Returns a dict with the lists of the names of the images which were
+    'copied', 'linked', 'unchanged' and 'removed'.
+    """
+    dest_dir = os.path.join(assets_dir, article_dir_name)
+    names = {}
+    for src_path in src_paths:
+        base_name = os.path.basename(src_path)
+        dest_path = os.path.join(dest_dir, base_name)
+        if not update and os.path.exists(dest_path):
+            raise Exception('Already exists: ' + dest_path)
+        names[base_name] = src_path         # the last one wins
+
+    report = {'copied': [], 'linked': [], 'unchanged': [], 'removed': []}
+    if names:
+        os.makedirs(dest_dir, exist_ok=True)
+    index = _ImageIndex(assets_dir)
+
+    def publish(base_name):
+        rel_path = article_dir_name + '/' + base_name
+        return _publish_image(names[base_name],
+                              os.path.join(dest_dir, base_name), rel_path,
+                              index)
+
+    if len(names) > 1:
+        with concurrent.futures.ThreadPoolExecutor(
+                min(MAX_COPY_WORKERS, len(names))) as executor:
+            results = list(executor.map(publish, names))
+    else:
+        results = [publish(base_name) for base_name in names]
+
+    for base_name, (action, file_hash, st) in zip(names, results):
+        index.set(article_dir_name + '/' + base_name, file_hash, st)
+        report[action].append(base_name)
+
+    if update and os.path.isdir(dest_dir):
+        for base_name in sorted(os.listdir(dest_dir)):
+            path = os.path.join(dest_dir, base_name)
+            if base_name not in names and os.path.isfile(path):
+                os.remove(path)
+                index.remove(article_dir_name + '/' + base_name)
+                report['removed'].append(base_name)
+
+    if names or report['removed']:
+        index.save()
+    return report
@@ -0,0 +1,446 @@
+# Benchmarks of the stages of LyXBlog on synthetic articles of growing size.
+#
+# Every benchmark is run on the base article scaled by each of the factors in
+# `--scales`, and we estimate the exponent `k` in `time ~ size^k` so that
+# superlinear behavior stands out even when the absolute times are small.
+#
+# Usage:
+#   python benchmarks/bench.py [--scales 1,2,4,8] [--repeat <n>]
+#                              [--only <name,...>] [--spec <field=n,...>]
+#                              [--save [<file>]] [--compare <file>]
+#                              [--threshold <ratio>]
+#
+# With `--save`, the results are written to `benchmarks/results/<commit>.json`
+# (or to `file`). With `--compare`, the results are compared with those in
+# `file` and the exit code is 1 if some benchmark got slower by more than
+# `threshold` (1.25 by default).
+#
+# The end-to-end benchmarks run `main` with the stand-ins for LyX and pandoc
+# in fake_bin, so they measure LyXBlog itself and not LyX and pandoc.
+#
+# The startup benchmarks measure how long a fresh interpreter takes to import
+# LyXBlog and to run each filter on an empty document (minus the startup of
+# an interpreter run the same way that does nothing, so that the time `site`
+# takes isn't counted), since pandoc starts the filters at every conversion.
+# The exit code is 1 if one of them is over its budget in STARTUP_BUDGETS.
+
+import io
+import os
+import sys
+import json
+import math
+import time
+import timeit
+import shutil
+import argparse
+import contextlib
+import datetime
+import platform
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+FAKE_BIN_DIR = os.path.join(BENCH_DIR, 'fake_bin')
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import LyXBlog
+import filter as lyxblog_filter
+import filter_num
+from pandoc_ast import walk
+from label_index import LabelIndex, get_index_path
+import corpus
+import fake_pandoc
+
+
+DEFAULT_SCALES = [1, 2, 4, 8]
+DEFAULT_THRESHOLD = 1.25
+
+# An exponent above this is reported as superlinear.
+SUPERLINEAR_EXPONENT = 1.3
+
+# The budgets (in ms) of the startup benchmarks.
+STARTUP_BUDGETS = {
+    'startup: import LyXBlog': 40,
+    'startup: filter_num.py': 15,
+    'startup: filter.py': 15,
+}
+
+_EMPTY_DOC_JSON = json.dumps({'pandoc-api-version': [1, 17, 5, 1],
+                              'meta': {}, 'blocks': []})
+
+
+def _front_matters():
+    return LyXBlog.FrontMatters({'html_file_name': 'bench_article'},
+                                {'layout': 'post',
+                                 'date': datetime.date(2018, 1, 1)})
+
+
+def _protected_ast(spec):
+    latex = LyXBlog.protect_math_envs(corpus.make_tex(spec))
+    return fake_pandoc.tex_to_ast(LyXBlog.FrontMatters.remove_from_file(latex))
+
+
+# Each benchmark takes the spec and a fresh working directory, does the
+# setup and returns the function to time.
+
+def bench_protect_math_envs(spec, work_dir):
+    latex = corpus.make_tex(spec)
+    return lambda: LyXBlog.protect_math_envs(latex)
+
+
+def bench_get_math_env_pos(spec, work_dir):
+    latex = corpus.make_tex(spec)
+    return lambda: list(LyXBlog.get_math_env_pos(latex))
+
+
+def bench_fix_figure_tag(spec, work_dir):
+    html = corpus.make_html(spec)
+    return lambda: LyXBlog.fix_figure_tag(html)
+
+
+def bench_get_section_label_info(spec, work_dir):
+    html_path = os.path.join(work_dir, 'article.html')
+    with open(html_path, 'w', encoding='utf-8') as f:
+        f.write(corpus.make_html(spec))
+    return lambda: LyXBlog.get_section_label_info(html_path)
+
+
+def bench_handle_images(spec, work_dir):
+    lyx_path = corpus.write_article(os.path.join(work_dir, 'src'), spec)
+    blog_dir = os.path.join(work_dir, 'blog')
+    front_matters = _front_matters()
+
+    return lambda: LyXBlog.handle_images(lyx_path, blog_dir, 'assets',
+                                         front_matters, update=True)
+
+
+def bench_filter_num(spec, work_dir):
+    # The filters change the AST in place, so each run gets its own copy.
+    doc_json = json.dumps(_protected_ast(spec))
+
+    def run():
+        doc = json.loads(doc_json)
+        return walk(doc, filter_num.filter_main, 'html', doc['meta'])
+    return run
+
+
+def bench_filter(spec, work_dir):
+    doc = _protected_ast(spec)
+    image_info_and_map = ([('/assets/fig_%d.png' % i)
+                           for i in range(spec.figures)], {})
+    section_info_and_map = filter_num.number_sections(doc['blocks'])
+    doc_json = json.dumps(doc)
+
+    def run():
+        lyxblog_filter.set_info(section_info_and_map, image_info_and_map)
+        doc = json.loads(doc_json)
+        return walk(doc, lyxblog_filter.filter_main, 'html', doc['meta'])
+    return run
+
+
+def _bench_main(spec, work_dir, options):
+    lyx_path = corpus.write_article(os.path.join(work_dir, 'src'), spec)
+    blog_dir = os.path.join(work_dir, 'blog')
+    os.makedirs(os.path.join(blog_dir, '_posts'))
+    script_path = os.path.join(REPO_DIR, 'LyXBlog.py')
+    index_path = get_index_path(blog_dir)
+    article = os.path.abspath(lyx_path)
+
+    def run():
+        # Without its post in the label index, the article is converted
+        # again rather than only getting its front matter patched (see
+        # republish.py).
+        if os.path.exists(index_path):
+            with LabelIndex(index_path) as label_index:
+                label_index.remove_article(article)
+        path = os.environ['PATH']
+        os.environ['PATH'] = FAKE_BIN_DIR + os.pathsep + path
+        try:
+            # main reports the outputs it changed.
+            with contextlib.redirect_stdout(io.StringIO()):
+                LyXBlog.main(script_path, options + ['--update', lyx_path,
+                                                     blog_dir, 'assets'])
+        finally:
+            os.environ['PATH'] = path
+        # The labels are only recorded by the conversion.
+        with LabelIndex(index_path) as label_index:
+            if not label_index.is_indexed(article):
+                raise Exception('main did not convert ' + lyx_path)
+    return run
+
+
+def bench_main(spec, work_dir):
+    return _bench_main(spec, work_dir, [])
+
+
+def bench_main_single_pass(spec, work_dir):
+    return _bench_main(spec, work_dir, ['--single_pass'])
+
+
+def bench_main_chunks(spec, work_dir):
+    return _bench_main(spec, work_dir, ['--chunks', '4'])
+
+
+def _run_python(args, input=None, env=None):
+    p = subprocess.run([sys.executable] + args, input=input, env=env,
+                       cwd=REPO_DIR, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.PIPE)
+    if p.returncode != 0:
+        raise Exception('{} failed:\n{}'.format(
+            ' '.join(args), str(p.stderr, 'utf-8', 'replace')))
+
+
+def _bench_startup(args, input=None, work_dir=None):
+    # Returns the function to time, which returns the time of `args` minus
+    # that of `-c pass` with the same interpreter flags and environment (see
+    # `time_function`).
+    env = None
+    if work_dir is not None:
+        import workspace
+        env = dict(os.environ, **{workspace.WORKSPACE_ENV_VAR: work_dir})
+
+    def run():
+        start = time.perf_counter()
+        _run_python(['-c', 'pass'], env=env)
+        baseline = time.perf_counter() - start
+        start = time.perf_counter()
+        _run_python(args, input, env)
+        return max(time.perf_counter() - start - baseline, 0)
+    run.returns_time = True
+    return run
+
+
+def bench_startup_lyxblog(spec, work_dir):
+    return _bench_startup(['-c', 'import LyXBlog'])
+
+
+def bench_startup_filter_num(spec, work_dir):
+    return _bench_startup(['filter_num.py', 'html'],
+                          _EMPTY_DOC_JSON.encode('ascii'))
+
+
+def bench_startup_filter(spec, work_dir):
+    LyXBlog.write_filter_info(work_dir, ([], {}), ([], {}), None, None)
+    return _bench_startup(['filter.py', 'html'],
+                          _EMPTY_DOC_JSON.encode('ascii'), work_dir)
+
+
+BENCHMARKS = {
+    'protect_math_envs': bench_protect_math_envs,
+    'get_math_env_pos': bench_get_math_env_pos,
+    'fix_figure_tag': bench_fix_figure_tag,
+    'get_section_label_info': bench_get_section_label_info,
+    'handle_images': bench_handle_images,
+    'filter_num.filter_main': bench_filter_num,
+    'filter.filter_main': bench_filter,
+    'main': bench_main,
+    'main --single_pass': bench_main_single_pass,
+    'main --chunks': bench_main_chunks,
+    'startup: import LyXBlog': bench_startup_lyxblog,
+    'startup: filter_num.py': bench_startup_filter_num,
+    'startup: filter.py': bench_startup_filter,
+}
+
+
+def time_function(func, repeat):
+    """
+    Returns the best time (in seconds) of a call to `func` over `repeat` runs
+    (each run calls `func` as many times as needed to take at least 0.2 s).
+    If `func.returns_time`, `func` measures itself and returns its time.
+    """
+    if getattr(func, 'returns_time', False):
+        return min(func() for _ in range(max(repeat, 1) * 5))
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def fit_exponent(sizes, times):
+    """
+    Returns the slope of the least-squares line through the points
+    (log(size), log(time)), i.e. the `k` in `time ~ size^k`.
+    """
+    points = [(math.log(s), math.log(t))
+              for s, t in zip(sizes, times) if s > 0 and t > 0]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+    if var_x == 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x
+
+
+def run_benchmarks(names, base_spec, scales, repeat):
+    results = {}
+    for name in names:
+        times = {}
+        for scale in scales:
+            spec = base_spec.scaled(scale)
+            work_dir = tempfile.mkdtemp(prefix='lyxblog_bench_')
+            try:
+                times[str(scale)] = time_function(
+                    BENCHMARKS[name](spec, work_dir), repeat)
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        exponent = fit_exponent(scales, [times[str(s)] for s in scales])
+        results[name] = {'times': times, 'exponent': exponent}
+        print_result(name, results[name], scales)
+    return results
+
+
+def print_result(name, result, scales):
+    cells = ['{:>10.3f}'.format(result['times'][str(s)] * 1000)
+             for s in scales]
+    exponent = result['exponent']
+    if exponent is None:
+        exponent_str = '     -'
+    else:
+        exponent_str = '{:6.2f}'.format(exponent)
+        if exponent > SUPERLINEAR_EXPONENT:
+            exponent_str += '  SUPERLINEAR'
+    if is_over_budget(name, result):
+        exponent_str += '  OVER BUDGET ({} ms)'.format(STARTUP_BUDGETS[name])
+    print('{:<24}{}  {}'.format(name, ''.join(cells), exponent_str))
+    sys.stdout.flush()
+
+
+def is_over_budget(name, result):
+    budget = STARTUP_BUDGETS.get(name)
+    return budget is not None and any(t * 1000 > budget
+                                      for t in result['times'].values())
+
+
+def get_commit():
+    try:
+        p = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                           cwd=REPO_DIR, stdout=subprocess.PIPE,
+                           stderr=subprocess.DEVNULL)
+        commit = str(p.stdout, 'utf-8').strip()
+        p = subprocess.run(['git', 'status', '--porcelain',
+                            '--untracked-files=no'],
+                           cwd=REPO_DIR, stdout=subprocess.PIPE,
+                           stderr=subprocess.DEVNULL)
+        if p.stdout.strip():
+            commit += '-dirty'
+        return commit or None
+    except OSError:
+        return None
+
+
+def compare(results, old_path, threshold):
+    """
+    Prints the ratios new/old of the times and returns the number of
+    regressions (i.e. ratios above `threshold`).
+    """
+    with open(old_path, encoding='utf-8') as f:
+        old = json.load(f)
+    print('\nCompared with {} (commit {}):'.format(old_path,
+                                                   old.get('commit')))
+    num_regressions = 0
+    for name, result in results.items():
+        old_result = old['results'].get(name)
+        if old_result is None:
+            continue
+        for scale, t in result['times'].items():
+            old_t = old_result['times'].get(scale)
+            if not old_t:
+                continue
+            ratio = t / old_t
+            flag = ''
+            if ratio > threshold:
+                flag = '  REGRESSION'
+                num_regressions += 1
+            elif ratio < 1 / threshold:
+                flag = '  faster'
+            print('{:<24} x{:<4} {:>10.3f} ms -> {:>10.3f} ms  {:5.2f}{}'
+                  .format(name, scale, old_t * 1000, t * 1000, ratio, flag))
+    return num_regressions
+
+
+def parse_spec(spec_str):
+    spec = corpus.CorpusSpec()
+    if spec_str:
+        for item in spec_str.split(','):
+            name, _, value = item.partition('=')
+            if name not in corpus.CorpusSpec.FIELDS or not value.isdigit():
+                raise argparse.ArgumentTypeError('invalid spec: ' + item)
+            setattr(spec, name, int(value))
+    return spec
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks of LyXBlog on synthetic articles.')
+    parser.add_argument('--scales', default=','.join(map(str, DEFAULT_SCALES)),
+                        help='comma-separated scale factors of the article')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', help='comma-separated benchmark names')
+    parser.add_argument('--spec', type=parse_spec, default=parse_spec(''),
+                        help='base article, e.g. sections=10,figures=5 '
+                             '(fields: ' + ', '.join(corpus.CorpusSpec.FIELDS)
+                             + ')')
+    parser.add_argument('--save', nargs='?', const='', metavar='FILE',
+                        help='save the results (by default, in '
+                             'benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare with saved results')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument('--list', action='store_true',
+                        help='list the benchmarks')
+    args = parser.parse_args(argv)
+
+    if args.list:
+        print('\n'.join(BENCHMARKS))
+        return 0
+
+    names = list(BENCHMARKS)
+    if args.only:
+        names = args.only.split(',')
+        unknown = [name for name in names if name not in BENCHMARKS]
+        if unknown:
+            parser.error('unknown benchmarks: ' + ', '.join(unknown))
+    scales = [float(s) if '.' in s else int(s)
+              for s in args.scales.split(',')]
+
+    print('Base article: {!r}'.format(args.spec))
+    print('{:<24}{}  {:>6}'.format(
+        'time (ms) at scale', ''.join('{:>10}'.format('x' + str(s))
+                                      for s in scales), 'exp'))
+    start = time.perf_counter()
+    results = run_benchmarks(names, args.spec, scales, args.repeat)
+    print('({:.1f} s)'.format(time.perf_counter() - start))
+
+    commit = get_commit()
+    if args.save is not None:
+        save_path = args.save or os.path.join(
+            RESULTS_DIR, '{}.json'.format(commit or 'unknown'))
+        os.makedirs(os.path.dirname(os.path.abspath(save_path)),
+                    exist_ok=True)
+        with open(save_path, 'w', encoding='utf-8') as f:
+            json.dump({'commit': commit,
+                       'date': datetime.datetime.now().isoformat(),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'spec': args.spec.to_dict(),
+                       'scales': scales,
+                       'repeat': args.repeat,
+                       'results': results}, f, indent=2)
+        print('Results saved to ' + save_path)
+
+    exit_code = 0
+    if args.compare is not None:
+        if compare(results, args.compare, args.threshold):
+            exit_code = 1
+    if any(is_over_budget(name, result) for name, result in results.items()):
+        exit_code = 1
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
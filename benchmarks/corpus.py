@@ -0,0 +1,313 @@
+# Generators of synthetic articles for the benchmarks.
+#
+# The LyX file and the TeX file are generated from the same list of items so
+# that they describe the same document (the TeX file is what LyX would
+# export). The generators are deterministic: the same spec always gives the
+# same files.
+
+import os
+
+import fake_lyx
+import fake_pandoc
+
+
+FRONT_MATTER = '''---
+html_file_name:     bench_article
+---
+layout:             post
+title:              Benchmark article
+date:               2018-01-01
+---'''
+
+TEX_PREAMBLE = r'''\documentclass[english]{article}
+\usepackage[T1]{fontenc}
+\usepackage[utf8]{inputenc}
+\usepackage{verbatim}
+\usepackage{amsmath}
+\usepackage{graphicx}
+\usepackage{babel}
+'''
+
+LYX_HEADER = (
+    '#LyX 2.3 created this file. For more info see http://www.lyx.org/\n'
+    r'''\lyxformat 544
+\begin_document
+\begin_header
+\save_transient_properties true
+\origin unavailable
+\textclass article
+\begin_preamble
+\usepackage{verbatim}
+\end_preamble
+\use_default_options true
+\language english
+\inputencoding utf8
+\paperfontsize default
+\use_package amsmath 1
+\cite_engine basic
+\papersize default
+\secnumdepth 3
+\tocdepth 3
+\paragraph_separation indent
+\end_header
+
+\begin_body
+''')
+
+LYX_FOOTER = r'''\end_body
+\end_document
+'''
+
+FILLER = ('The quick brown fox jumps over the lazy dog while the rain in '
+          'Spain stays mainly in the plain and the value function converges '
+          'to its fixed point.')
+
+# A tiny fake image: the benchmarks only copy the images around.
+IMAGE_SIZE = 4096
+
+
+class CorpusSpec:
+    """
+    Size of a synthetic article.
+
+    `labels` is the number of labels, which are given, in turn, to the
+    sections, figures, equations and AMS environments. Every label is
+    referenced once from the text.
+    """
+    FIELDS = ('sections', 'equations', 'ams_envs', 'verbatims', 'figures',
+              'labels')
+
+    def __init__(self, sections=10, equations=50, ams_envs=20, verbatims=5,
+                 figures=10, labels=30):
+        self.sections = max(1, sections)
+        self.equations = equations
+        self.ams_envs = ams_envs
+        self.verbatims = verbatims
+        self.figures = figures
+        self.labels = labels
+
+    def scaled(self, factor):
+        return CorpusSpec(**{name: int(round(getattr(self, name) * factor))
+                             for name in self.FIELDS})
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    def __repr__(self):
+        return 'CorpusSpec({})'.format(', '.join(
+            '{}={}'.format(name, getattr(self, name)) for name in self.FIELDS))
+
+
+def _get_items(spec):
+    """
+    Returns the items of the document, in order, as tuples
+    `(kind, idx, label, refs)`, where `refs` is only used by paragraphs and is
+    a list of `(command, label)`.
+    """
+    counts = {'section': spec.sections, 'figure': spec.figures,
+              'equation': spec.equations, 'ams_env': spec.ams_envs}
+    prefixes = {'section': 'sec', 'figure': 'fig',
+                'equation': 'eq', 'ams_env': 'eq:ams'}
+
+    labels = {}
+    ref_commands = []
+    for i in range(max(counts.values())):
+        for kind in ('section', 'figure', 'equation', 'ams_env'):
+            if len(labels) == spec.labels:
+                break
+            if i < counts[kind]:
+                label = '{}:{}'.format(prefixes[kind], i)
+                labels[kind, i] = label
+                command = 'ref' if kind in ('section', 'figure') else 'eqref'
+                ref_commands.append((command, label))
+
+    # The references are spread over the paragraphs of the sections.
+    refs_per_section = [[] for _ in range(spec.sections)]
+    for k, ref in enumerate(ref_commands):
+        refs_per_section[k % spec.sections].append(ref)
+
+    items = []
+    for s in range(spec.sections):
+        items.append(('section', s, labels.get(('section', s)), None))
+        items.append(('paragraph', s, None, refs_per_section[s]))
+        for kind, count in [('equation', spec.equations),
+                            ('ams_env', spec.ams_envs),
+                            ('verbatim', spec.verbatims),
+                            ('figure', spec.figures)]:
+            for i in range(s, count, spec.sections):
+                items.append((kind, i, labels.get((kind, i)), None))
+                if kind != 'verbatim':
+                    items.append(('paragraph', i, None, []))
+    return items
+
+
+def _equation_tex(idx):
+    return r'x_{%d}=\sum_{i=1}^{%d}\frac{y_{i}}{1+z_{i}}' % (idx, idx + 1)
+
+
+def _ams_lines(idx, label):
+    env = 'align' if label else 'align*'
+    lines = [r'\begin{%s}' % env,
+             r'a_{%d} & =b_{%d}+c\\' % (idx, idx),
+             r'd_{%d} & =\int_{0}^{1}e^{-t}dt' %
+             idx + (r'\label{%s}' % label if label else ''),
+             r'\end{%s}' % env]
+    return lines
+
+
+def _verbatim_lines(idx):
+    # Something that looks like math to exercise the skipping of verbatim
+    # blocks in protect_math_envs.
+    return ['def f_{}(x):'.format(idx),
+            r'    # \begin{align} x \end{align} and \ref{nothing}',
+            '    return x * {}'.format(idx)]
+
+
+def make_tex(spec):
+    """
+    Returns the TeX file LyX would export from `make_lyx(spec)`.
+    """
+    out = [TEX_PREAMBLE, '\\begin{document}\n',
+           '\\begin{comment}\n', FRONT_MATTER, '\n\\end{comment}\n\n']
+    for kind, idx, label, refs in _get_items(spec):
+        tex_label = r'\label{%s}' % label if label else ''
+        if kind == 'section':
+            command = 'subsection' if idx % 4 == 3 else 'section'
+            out.append('\\%s{Section %d%s}\n\n' % (command, idx, tex_label))
+        elif kind == 'paragraph':
+            text = FILLER
+            for command, ref_label in refs:
+                text += r' See \%s{%s}.' % (command, ref_label)
+            out.append(text + '\n\n')
+        elif kind == 'equation':
+            if label:
+                out.append('\\begin{equation}\n%s%s\n\\end{equation}\n\n' %
+                           (_equation_tex(idx), tex_label))
+            else:
+                out.append('\\[\n%s\n\\]\n\n' % _equation_tex(idx))
+        elif kind == 'ams_env':
+            out.append('\n'.join(_ams_lines(idx, label)) + '\n\n')
+        elif kind == 'verbatim':
+            out.append('\\begin{verbatim}\n' +
+                       '\n'.join(_verbatim_lines(idx)) +
+                       '\n\\end{verbatim}\n\n')
+        elif kind == 'figure':
+            out.append('\\begin{figure}\n\\begin{centering}\n'
+                       '\\includegraphics[width=0.5\\columnwidth]{fig_%d}\n'
+                       '\\par\\end{centering}\n'
+                       '\\caption{Caption of figure %d.%s}\n'
+                       '\\end{figure}\n\n' % (idx, idx, tex_label))
+    out.append('\\end{document}\n')
+    return ''.join(out)
+
+
+def _lyx_label(label):
+    return ('\\begin_inset CommandInset label\nLatexCommand label\n'
+            'name "%s"\n\n\\end_inset\n\n' % label)
+
+
+def _lyx_ert(lines):
+    out = ['\\begin_inset ERT\nstatus open\n\n']
+    for line in lines:
+        out.append('\\begin_layout Plain Layout\n\n' +
+                   line.replace('\\', '\n\\backslash\n') +
+                   '\n\\end_layout\n\n')
+    out.append('\\end_inset\n\n')
+    return ''.join(out)
+
+
+def _lyx_formula(tex):
+    return '\\begin_inset Formula %s\n\\end_inset\n\n' % tex
+
+
+def make_lyx(spec):
+    """
+    Returns a LyX file with the structure described by `spec`.
+    """
+    out = [LYX_HEADER, '\n\\begin_layout Standard\n',
+           _lyx_ert(['\\begin{comment}'] + FRONT_MATTER.split('\n') +
+                    ['\\end{comment}']),
+           '\n\\end_layout\n\n']
+    for kind, idx, label, refs in _get_items(spec):
+        lyx_label = _lyx_label(label) if label else ''
+        if kind == 'section':
+            layout = 'Subsection' if idx % 4 == 3 else 'Section'
+            out.append('\\begin_layout %s\nSection %d\n%s\\end_layout\n\n' %
+                       (layout, idx, lyx_label))
+        elif kind == 'paragraph':
+            out.append('\\begin_layout Standard\n' + FILLER + '\n')
+            for command, ref_label in refs:
+                out.append('See \n\\begin_inset CommandInset ref\n'
+                           'LatexCommand %s\nreference "%s"\n\n'
+                           '\\end_inset\n\n.\n' % (command, ref_label))
+            out.append('\\end_layout\n\n')
+        elif kind == 'equation':
+            if label:
+                tex = ('\\begin{equation}\n%s%s\n\\end{equation}' %
+                       (_equation_tex(idx), r'\label{%s}' % label))
+            else:
+                tex = '\\[\n%s\n\\]' % _equation_tex(idx)
+            out.append('\\begin_layout Standard\n' + _lyx_formula(tex) +
+                       '\\end_layout\n\n')
+        elif kind == 'ams_env':
+            out.append('\\begin_layout Standard\n' +
+                       _lyx_formula('\n'.join(_ams_lines(idx, label))) +
+                       '\\end_layout\n\n')
+        elif kind == 'verbatim':
+            for line in _verbatim_lines(idx):
+                out.append('\\begin_layout Verbatim\n%s\n\\end_layout\n\n' %
+                           line.replace('\\', '\n\\backslash\n'))
+        elif kind == 'figure':
+            out.append(
+                '\\begin_layout Standard\n'
+                '\\begin_inset Float figure\nwide false\nsideways false\n'
+                'status open\n\n'
+                '\\begin_layout Plain Layout\n\\align center\n'
+                '\\begin_inset Graphics\n\tfilename fig_%d.png\n'
+                '\twidth 50col%%\n\n\\end_inset\n\n\n\\end_layout\n\n'
+                '\\begin_layout Plain Layout\n'
+                '\\begin_inset Caption Standard\n\n'
+                '\\begin_layout Plain Layout\nCaption of figure %d.\n%s'
+                '\\end_layout\n\n\\end_inset\n\n\n\\end_layout\n\n'
+                '\\end_inset\n\n\n\\end_layout\n\n' % (idx, idx, lyx_label))
+    out.append(LYX_FOOTER)
+    return ''.join(out)
+
+
+def make_html(spec):
+    """
+    Returns the HTML file produced by the first pandoc pass (i.e. with the
+    header ids set by filter_num.py) with the figures produced by filter.py,
+    which is what `get_section_label_info` and `fix_figure_tag` work on.
+    """
+    from filter_num import UID
+    from filter import UID2
+
+    doc = fake_pandoc.tex_to_ast(make_tex(spec))
+    for block in doc['blocks']:
+        if block['t'] == 'Header':
+            block['c'][1][0] = UID
+        elif (block['t'] == 'Para' and len(block['c']) == 1 and
+              block['c'][0]['t'] == 'Image'):
+            block['c'][0]['c'][0] = ['', ['{}:{:.5}%'.format(UID2, 25.0)],
+                                     [['width', '100%']]]
+    return fake_pandoc.ast_to_html(doc, number_sections=True)
+
+
+def write_article(dir_path, spec, name='article'):
+    """
+    Writes the LyX file, its images and the TeX file for the fake LyX (see
+    fake_lyx.py) into `dir_path` and returns the path of the LyX file.
+    """
+    os.makedirs(dir_path, exist_ok=True)
+    lyx_path = os.path.join(dir_path, name + '.lyx')
+    with open(lyx_path, 'w', encoding='utf-8') as f:
+        f.write(make_lyx(spec))
+    with open(os.path.join(dir_path, name + fake_lyx.TEX_SUFFIX), 'w',
+              encoding='utf-8') as f:
+        f.write(make_tex(spec))
+    for idx in range(spec.figures):
+        with open(os.path.join(dir_path, 'fig_%d.png' % idx), 'wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\n' +
+                    bytes((idx + i) % 256 for i in range(IMAGE_SIZE - 8)))
+    return lyx_path
@@ -0,0 +1,28 @@
+# A stand-in for LyX used by the benchmarks (see fake_bin/lyx).
+#
+# `corpus.write_article` generates the TeX file together with the LyX file
+# and stores it next to it, so exporting just means copying it (next to the
+# LyX file with `--export`, or to the given file with `--export-to`).
+
+import shutil
+import os
+
+
+TEX_SUFFIX = '.lyx.tex'
+
+
+def main(argv):
+    if '--version' in argv:
+        print('LyX 2.3 (lyxblog benchmark stand-in)')
+        return 0
+    if len(argv) == 3 and argv[:2] == ['--export', 'latex']:
+        lyx_path = argv[2]
+        tex_path = os.path.splitext(lyx_path)[0] + '.tex'
+    elif len(argv) == 4 and argv[:2] == ['--export-to', 'latex']:
+        tex_path, lyx_path = argv[2:]
+    else:
+        print('usage: lyx --export latex <file.lyx>\n'
+              '       lyx --export-to latex <file.tex> <file.lyx>')
+        return 2
+    shutil.copy(os.path.splitext(lyx_path)[0] + TEX_SUFFIX, tex_path)
+    return 0
@@ -0,0 +1,302 @@
+# A stand-in for pandoc used by the benchmarks (see fake_bin/pandoc).
+#
+# It understands just enough of the TeX produced by LyX (and by
+# `protect_math_envs`) to build a pandoc AST with the nodes our filters care
+# about: headers with labels, display and inline math, verbatim blocks and
+# figures. Everything runs in linear time so that what we measure is our own
+# code and not the stand-in.
+
+import os
+import re
+import sys
+import json
+import html as html_lib
+import subprocess
+
+
+API_VERSION = [1, 17, 5, 4]
+
+SECTION_LEVELS = {'section': 1, 'subsection': 2, 'subsubsection': 3}
+
+_BODY_RE = re.compile(r'\\begin{document}(.*?)(?:\\end{document}|\Z)',
+                      flags=re.DOTALL)
+_BLOCK_RE = re.compile(
+    r'\\(section|subsection|subsubsection)(\*?){([^\n]*)}[ \t]*$'
+    r'|\\begin{verbatim}\n(.*?)\\end{verbatim}'
+    r'|\\begin{figure}(.*?)\\end{figure}'
+    r'|\$\$(.*?)\$\$'
+    r'|\\\[(.*?)\\\]'
+    r'|\\begin{equation}(.*?)\\end{equation}'
+    r'|\n[ \t]*\n',
+    flags=re.DOTALL | re.MULTILINE)
+_INLINE_RE = re.compile(r'\$([^$]+)\$|\\label{([^}]*)}|\s+')
+_GRAPHICS_RE = re.compile(
+    r'\\includegraphics(?:\[width=([0-9.]+)\\columnwidth\])?{([^}]*)}')
+_CAPTION_RE = re.compile(r'\\caption{(.*)}', flags=re.DOTALL)
+
+
+def _str(text):
+    return {'t': 'Str', 'c': text}
+
+
+def _label_span(name):
+    return {'t': 'Span', 'c': [['', [], [['label', name]]],
+                               [_str('[' + name + ']')]]}
+
+
+def parse_inlines(text):
+    inlines = []
+    pos = 0
+    for m in _INLINE_RE.finditer(text):
+        if m.start() > pos:
+            inlines.append(_str(text[pos:m.start()]))
+        if m[1] is not None:
+            inlines.append({'t': 'Math',
+                            'c': [{'t': 'InlineMath'}, m[1]]})
+        elif m[2] is not None:
+            inlines.append(_label_span(m[2]))
+        elif inlines and inlines[-1]['t'] != 'Space':
+            inlines.append({'t': 'Space'})
+        pos = m.end()
+    if pos < len(text):
+        inlines.append(_str(text[pos:]))
+    if inlines and inlines[-1]['t'] == 'Space':
+        inlines.pop()
+    return inlines
+
+
+def _parse_figure(text):
+    m = _GRAPHICS_RE.search(text)
+    if m is None:
+        return None
+    width = '{:g}%'.format(float(m[1]) * 100) if m[1] else '100%'
+    caption = _CAPTION_RE.search(text)
+    alt = parse_inlines(caption[1]) if caption else []
+    title = 'fig:' if caption else ''
+    image = {'t': 'Image', 'c': [['', [], [['width', width]]], alt,
+                                 [m[2], title]]}
+    return {'t': 'Para', 'c': [image]}
+
+
+def _display_math(latex):
+    return {'t': 'Para', 'c': [{'t': 'Math',
+                                'c': [{'t': 'DisplayMath'}, latex]}]}
+
+
+def tex_to_ast(latex):
+    """
+    Returns the pandoc AST (a dict) of the body of the TeX file `latex`.
+    """
+    m = _BODY_RE.search(latex)
+    body = m[1] if m else latex
+
+    blocks = []
+
+    def add_para(text):
+        inlines = parse_inlines(text.strip())
+        if inlines:
+            blocks.append({'t': 'Para', 'c': inlines})
+
+    pos = 0
+    for m in _BLOCK_RE.finditer(body):
+        add_para(body[pos:m.start()])
+        pos = m.end()
+        if m[1] is not None:
+            classes = ['unnumbered'] if m[2] else []
+            blocks.append({'t': 'Header',
+                           'c': [SECTION_LEVELS[m[1]], ['', classes, []],
+                                 parse_inlines(m[3])]})
+        elif m[4] is not None:
+            blocks.append({'t': 'CodeBlock', 'c': [['', [], []], m[4]]})
+        elif m[5] is not None:
+            figure = _parse_figure(m[5])
+            if figure is not None:
+                blocks.append(figure)
+        elif m[6] is not None:
+            blocks.append(_display_math(m[6]))
+        elif m[7] is not None:
+            blocks.append(_display_math(m[7]))
+        elif m[8] is not None:
+            blocks.append(_display_math(r'\begin{equation}' + m[8] +
+                                        r'\end{equation}'))
+    add_para(body[pos:])
+
+    return {'pandoc-api-version': API_VERSION, 'meta': {}, 'blocks': blocks}
+
+
+def _attrs_to_html(attr):
+    id, classes, key_values = attr
+    out = []
+    if id:
+        out.append(' id="{}"'.format(html_lib.escape(id)))
+    if classes:
+        out.append(' class="{}"'.format(html_lib.escape(' '.join(classes))))
+    for k, v in key_values:
+        out.append(' {}="{}"'.format(k, html_lib.escape(v)))
+    return ''.join(out)
+
+
+def inlines_to_html(inlines):
+    out = []
+    for inline in inlines:
+        t = inline['t']
+        if t == 'Str':
+            out.append(html_lib.escape(inline['c'], quote=False))
+        elif t == 'Space':
+            out.append(' ')
+        elif t == 'Math':
+            math_type, latex = inline['c']
+            if math_type['t'] == 'DisplayMath':
+                out.append('<span class="math display">\\[' +
+                           html_lib.escape(latex, quote=False) +
+                           '\\]</span>')
+            else:
+                out.append('<span class="math inline">\\(' +
+                           html_lib.escape(latex, quote=False) +
+                           '\\)</span>')
+        elif t == 'RawInline':
+            out.append(inline['c'][1])
+        elif t == 'Emph':
+            out.append('<em>' + inlines_to_html(inline['c']) + '</em>')
+        elif t == 'Span':
+            attr, content = inline['c']
+            out.append('<span' + _attrs_to_html(attr) + '>' +
+                       inlines_to_html(content) + '</span>')
+        elif t == 'Image':
+            attr, alt, (src, title) = inline['c']
+            # Like pandoc's HTML5 writer, which puts the dimensions in the
+            # style.
+            id, classes, key_values = attr
+            style = ';'.join('{}:{}'.format(k, v) for k, v in key_values
+                             if k in ('width', 'height'))
+            attr = [id, classes,
+                    [[k, v] for k, v in key_values
+                     if k not in ('width', 'height')] +
+                    ([['style', style]] if style else [])]
+            out.append('<img src="{}"{} alt="{}" />'.format(
+                html_lib.escape(src), _attrs_to_html(attr),
+                html_lib.escape(inlines_to_text(alt))))
+    return ''.join(out)
+
+
+def inlines_to_text(inlines):
+    return ''.join(inline['c'] if inline['t'] == 'Str' else
+                   ' ' if inline['t'] == 'Space' else
+                   inlines_to_text(inline['c'][1])
+                   if inline['t'] == 'Span' else ''
+                   for inline in inlines)
+
+
+def ast_to_html(doc, number_sections=False):
+    """
+    Renders the AST `doc` like pandoc 2 does (at least as far as
+    `get_section_label_info` and `fix_figure_tag` are concerned).
+    """
+    out = []
+    last_num = []
+    for block in doc['blocks']:
+        t = block['t']
+        if t == 'Header':
+            level, attr, content = block['c']
+            num_html = ''
+            if number_sections and 'unnumbered' not in attr[1]:
+                if len(last_num) >= level:
+                    last_num = last_num[:level]
+                    last_num[-1] += 1
+                else:
+                    last_num = (last_num + [0] * (level - len(last_num) - 1) +
+                                [1])
+                num_html = ('<span class="header-section-number">' +
+                            '.'.join(str(n) for n in last_num) + '</span> ')
+            out.append('<h{0}{1}>{2}{3}</h{0}>\n'.format(
+                level, _attrs_to_html(attr), num_html,
+                inlines_to_html(content)))
+        elif t == 'Para':
+            content = block['c']
+            if (len(content) == 1 and content[0]['t'] == 'Image' and
+                    content[0]['c'][2][1] == 'fig:'):
+                out.append('<figure>\n' + inlines_to_html(content) +
+                           '\n<figcaption>' +
+                           inlines_to_html(content[0]['c'][1]) +
+                           '</figcaption>\n</figure>\n')
+            else:
+                out.append('<p>' + inlines_to_html(content) + '</p>\n')
+        elif t == 'CodeBlock':
+            out.append('<pre><code>' +
+                       html_lib.escape(block['c'][1], quote=False) +
+                       '</code></pre>\n')
+        elif t == 'RawBlock':
+            out.append(block['c'][1] + '\n')
+    return ''.join(out)
+
+
+def run_filter(filter_path, doc):
+    """
+    Runs a JSON filter the way pandoc does.
+    """
+    if not os.path.exists(filter_path):
+        return doc          # e.g. pandoc-citeproc
+    p = subprocess.run([sys.executable, filter_path, 'html'],
+                       input=json.dumps(doc).encode('utf-8'),
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if p.returncode != 0:
+        raise Exception('Filter {} failed:\n{}'.format(
+            filter_path, str(p.stderr, 'utf-8')))
+    return json.loads(str(p.stdout, 'utf-8'))
+
+
+def main(argv):
+    if '--version' in argv:
+        print('pandoc 2.0 (lyxblog benchmark stand-in)')
+        return 0
+
+    from_format = 'latex'
+    to_format = 'html'
+    output_path = None
+    filters = []
+    number_sections = False
+    input_path = None
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg in ('-f', '--from'):
+            from_format = argv[i + 1]
+            i += 1
+        elif arg in ('-t', '--to'):
+            to_format = argv[i + 1]
+            i += 1
+        elif arg in ('-o', '--output'):
+            output_path = argv[i + 1]
+            i += 1
+        elif arg == '--filter':
+            filters.append(argv[i + 1])
+            i += 1
+        elif arg == '--metadata':
+            i += 1
+        elif arg == '--number-sections':
+            number_sections = True
+        elif not arg.startswith('-'):
+            input_path = arg
+        i += 1
+
+    if input_path is None:
+        text = sys.stdin.buffer.read().decode('utf-8')
+    else:
+        with open(input_path, encoding='utf-8') as f:
+            text = f.read()
+
+    doc = json.loads(text) if from_format == 'json' else tex_to_ast(text)
+    for filter_path in filters:
+        doc = run_filter(filter_path, doc)
+
+    if to_format == 'json':
+        output = json.dumps(doc)
+    else:
+        output = ast_to_html(doc, number_sections)
+
+    if output_path is None:
+        sys.stdout.buffer.write(output.encode('utf-8'))
+    else:
+        with open(output_path, 'w', encoding='utf-8') as f:
+            f.write(output)
+    return 0
@@ -0,0 +1,220 @@
+# Pre-parsed bibliographies and cached citations.
+#
+# pandoc-citeproc parses the whole bibliography on every run, even if the
+# article cites a handful of its entries. So we parse the BibTeX files once
+# (the parsed form is cached by content hash), write a small BibTeX file with
+# just the cited entries and point the TeX file at it. In single-pass mode,
+# we also cache the output of citeproc (the formatted citations and the
+# reference list).
+
+import os
+import re
+import json
+from cache import hash_bytes, hash_file
+
+
+CITED_BIB_NAME = 'lyxblog_cited'
+
+_ENTRY_START_RE = re.compile(r'@\s*(\w+)\s*([{(])')
+_ENTRY_KEY_RE = re.compile(r'\s*([^,\s]+)\s*,')
+_CROSSREF_RE = re.compile(r'\bcrossref\s*=\s*[{"]\s*([^}"\s]+)\s*[}"]',
+                          flags=re.I)
+_CITE_RE = re.compile(r'\\[a-zA-Z]*cite[a-zA-Z]*\*?'
+                      r'(?:\[[^\]]*\]){0,2}\s*{([^}]*)}')
+_BIBLIOGRAPHY_RE = re.compile(r'\\bibliography{([^}]*)}')
+
+
+def parse_bib(data):
+    """
+    Splits the BibTeX file `data` (str) into its entries. Returns
+    `(common, entries)`, where `common` is the list of the @string and
+    @preamble blocks, which every entry may need, and `entries` maps the keys
+    of the entries to their text.
+    """
+    common = []
+    entries = {}
+    pos = 0
+    while True:
+        m = _ENTRY_START_RE.search(data, pos)
+        if m is None:
+            break
+        entry_type = m[1].lower()
+        close = '}' if m[2] == '{' else ')'
+        # Find the end of the entry by counting the braces.
+        depth = 1
+        i = m.end()
+        while i < len(data) and depth:
+            c = data[i]
+            if c == '{' or (c == '(' and close == ')'):
+                depth += 1
+            elif c == '}' or (c == ')' and close == ')'):
+                depth -= 1
+            i += 1
+        text = data[m.start():i]
+        pos = i
+        if entry_type == 'comment':
+            continue
+        if entry_type in ('string', 'preamble'):
+            common.append(text)
+            continue
+        mk = _ENTRY_KEY_RE.match(data, m.end())
+        if mk is not None and mk[1] not in entries:
+            entries[mk[1]] = text
+    return common, entries
+
+
+def load_bib(path, cache):
+    """
+    Returns `parse_bib` of the BibTeX file at `path`, from `cache` (a
+    BuildCache, or None) if it's been parsed before.
+    """
+    if cache is not None:
+        key = hash_bytes('bib', hash_file(path))
+        data = cache.get(key)
+        if data is not None:
+            parsed = json.loads(str(data, 'utf-8'))
+            return parsed['common'], parsed['entries']
+    with open(path, encoding='utf-8', errors='replace') as f:
+        common, entries = parse_bib(f.read())
+    if cache is not None:
+        cache.put(key, json.dumps({'common': common,
+                                   'entries': entries}).encode('utf-8'))
+    return common, entries
+
+
+def get_cited_keys(latex):
+    """
+    Returns the keys cited in the TeX file `latex`, in order, or None if all
+    the entries are needed (`\\nocite{*}`).
+    """
+    keys = []
+    for m in _CITE_RE.finditer(latex):
+        for key in m[1].split(','):
+            key = key.strip()
+            if key == '*':
+                return None
+            if key:
+                keys.append(key)
+    return keys
+
+
+def _point_bibliography(latex, names):
+    # NOTE: pandoc adds the extension '.bib' itself, and '\\' would start a
+    #       TeX command.
+    names = [os.path.splitext(name)[0].replace('\\', '/') for name in names]
+    return _BIBLIOGRAPHY_RE.sub(
+        lambda m: r'\bibliography{%s}' % ','.join(names), latex, count=1)
+
+
+def reduce_bibliography(latex, bib_paths, cache=None, out_dir=''):
+    """
+    Writes the BibTeX file CITED_BIB_NAME.bib in `out_dir` with only the
+    entries of the bibliography files `bib_paths` cited by `latex` (and those
+    they crossref), and returns `latex` with `\\bibliography{...}` pointing
+    to it, relative to `out_dir`.
+
+    If a file is missing or all the entries are needed, `latex` is returned
+    with `\\bibliography{...}` pointing to the absolute `bib_paths` instead.
+    """
+    if not bib_paths:
+        return latex
+    if not all(os.path.exists(path) for path in bib_paths):
+        return _point_bibliography(latex, map(os.path.abspath, bib_paths))
+    cited = get_cited_keys(latex)
+    if cited is None:
+        return _point_bibliography(latex, map(os.path.abspath, bib_paths))
+
+    common = []
+    entries = {}
+    for path in bib_paths:
+        bib_common, bib_entries = load_bib(path, cache)
+        common += bib_common
+        for key, text in bib_entries.items():
+            entries.setdefault(key, text)
+
+    selected = []
+    seen = set()
+    to_visit = list(reversed(cited))
+    while to_visit:
+        key = to_visit.pop()
+        if key in seen or key not in entries:
+            continue
+        seen.add(key)
+        selected.append(entries[key])
+        m = _CROSSREF_RE.search(entries[key])
+        if m:
+            to_visit.append(m[1])
+
+    data = '\n\n'.join(common + selected) + '\n'
+    with open(os.path.join(out_dir, CITED_BIB_NAME + '.bib'), 'w',
+              encoding='utf-8') as f:
+        f.write(data)
+    return _point_bibliography(latex, [CITED_BIB_NAME])
+
+
+def _collect_cites(doc):
+    from pandoc_ast import walk, handles
+
+    cites = []
+
+    @handles('Cite')
+    def collect(key, value, format, meta):
+        cites.append({'t': 'Cite', 'c': value})
+    walk(doc['blocks'], collect, '', {})
+    return cites
+
+
+def format_citations(doc, bib_paths, run_citeproc, cache=None,
+                     citeproc_version=''):
+    """
+    Applies citeproc to the pandoc AST `doc` (in place) through a cache: we
+    send to citeproc (with `run_citeproc(doc)`, which returns the processed
+    AST) a document made of just the citations, in order, and we put the
+    formatted citations and the reference list it returns into `doc`.
+
+    The result of citeproc is cached in `cache` (a BuildCache), if given, by
+    a hash of that document, the bibliography files and `citeproc_version`.
+    Returns False if we couldn't make sense of citeproc's output, in which
+    case `doc` is unchanged and citeproc should be run on the whole document.
+    """
+    from pandoc_ast import walk, handles
+
+    cites = _collect_cites(doc)
+    if not cites and 'nocite' not in doc['meta']:
+        return True             # nothing to do
+
+    mini_doc = dict(doc, blocks=[{'t': 'Para', 'c': [cite]}
+                                 for cite in cites])
+    data = None
+    if cache is not None:
+        parts = ['citeproc', json.dumps(mini_doc, sort_keys=True),
+                 citeproc_version]
+        for path in bib_paths:
+            parts.append(hash_file(path) if os.path.exists(path) else '')
+        key = hash_bytes(*parts)
+        data = cache.get(key)
+    if data is not None:
+        result = json.loads(str(data, 'utf-8'))
+    else:
+        result = run_citeproc(mini_doc)
+
+    blocks = result['blocks']
+    formatted = []
+    for block in blocks[:len(cites)]:
+        if not (block['t'] == 'Para' and len(block['c']) == 1 and
+                block['c'][0]['t'] == 'Cite'):
+            return False
+        formatted.append(block['c'][0])
+    if len(formatted) != len(cites):
+        return False
+    if cache is not None and data is None:
+        cache.put(key, json.dumps(result).encode('utf-8'))
+
+    formatted = iter(formatted)
+
+    @handles('Cite')
+    def replace(key, value, format, meta):
+        return next(formatted)
+    walk(doc['blocks'], replace, '', {})
+    doc['blocks'] += blocks[len(cites):]        # the reference list
+    return True
@@ -0,0 +1,184 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.lyxblog_cache')
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024        # bytes
+
+_TMP_SUFFIX = '.tmp'
+
+
+def hash_bytes(*parts):
+    """
+    Returns the hex digest of the sequence `parts` (made of bytes and str).
+    Each part is length-prefixed so that, say, ('ab', 'c') and ('a', 'bc')
+    have different hashes.
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        h.update(str(len(part)).encode('ascii') + b':')
+        h.update(part)
+    return h.hexdigest()
+
+
+def _write_atomically(path, data):
+    # The temporary file has a unique name, so concurrent writers (processes
+    # or threads) never collide.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    suffix=_TMP_SUFFIX)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class BuildCache:
+    """
+    Persistent content-addressed cache of the expensive stages of the
+    conversion (LyX export, pandoc).
+
+    Each entry is a file named after its key (see `hash_bytes`) so the cache
+    can be shared by concurrent processes (e.g. in batch mode): entries are
+    written atomically and are never modified after being written.
+    Entries are evicted in least-recently-used order when the cache grows
+    beyond `max_size` bytes. The size of the cache is only measured at the
+    first `put` (and at each eviction) and then kept up to date by `put`, so
+    a `put` doesn't scan the whole cache.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR,
+                 max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.entries_dir = os.path.join(cache_dir, 'entries')
+        os.makedirs(self.entries_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._total_size = None     # not measured yet
+
+    def _entry_path(self, key):
+        return os.path.join(self.entries_dir, key[:2], key)
+
+    def get(self, key):
+        """
+        Returns the content (bytes) associated with `key`, or None.
+        """
+        path = self._entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)          # for LRU eviction
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        path = self._entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            old_size = os.stat(path).st_size
+        except FileNotFoundError:
+            old_size = 0
+        _write_atomically(path, data)
+        with self._lock:
+            if self._total_size is not None:
+                self._total_size += len(data) - old_size
+                if self._total_size <= self.max_size:
+                    return
+        self.evict()
+
+    def get_file(self, key, dest_path):
+        """
+        Copies the content associated with `key` to `dest_path` and returns
+        True, or returns False if there's no such content.
+        """
+        data = self.get(key)
+        if data is None:
+            return False
+        with open(dest_path, 'wb') as f:
+            f.write(data)
+        return True
+
+    def put_file(self, key, src_path):
+        with open(src_path, 'rb') as f:
+            self.put(key, f.read())
+
+    def evict(self):
+        """
+        Measures the size of the cache and removes the least recently used
+        entries until it's at most `max_size` bytes.
+        """
+        entries = []
+        total_size = 0
+        for dir_path, _, file_names in os.walk(self.entries_dir):
+            for file_name in file_names:
+                if file_name.endswith(_TMP_SUFFIX):     # being written
+                    continue
+                path = os.path.join(dir_path, file_name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:       # evicted by someone else
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total_size += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+        with self._lock:
+            self._total_size = total_size
+
+    def tool_version(self, exe_name):
+        """
+        Returns the output of `<exe_name> --version`. The output is cached
+        and is only recomputed when the executable changes so that we don't
+        pay for, say, LyX's startup on every run.
+        """
+        exe_path = shutil.which(exe_name)
+        if exe_path is None:
+            return ''
+        st = os.stat(exe_path)
+        exe_id = '{}:{}:{}'.format(exe_path, st.st_size, st.st_mtime_ns)
+
+        # One file per executable, so there's no read-modify-write to race.
+        versions_dir = os.path.join(self.cache_dir, 'tool_versions')
+        version_path = os.path.join(versions_dir, hash_bytes(exe_id))
+        try:
+            with open(version_path, 'rb') as f:
+                return str(f.read(), 'utf-8', 'replace')
+        except FileNotFoundError:
+            pass
+
+        p = subprocess.run([exe_path, '--version'],
+                           stdout=subprocess.PIPE,
+                           stderr=subprocess.STDOUT)
+        os.makedirs(versions_dir, exist_ok=True)
+        _write_atomically(version_path, p.stdout)
+        return str(p.stdout, 'utf-8', 'replace')
@@ -0,0 +1,267 @@
+# Parallel parsing of long articles.
+#
+# pandoc parses a TeX file on a single core, and parsing is most of the time
+# it spends on a long article. So we split the TeX file at its top-level
+# sections into chunks, which pandoc parses in parallel, and we merge their
+# ASTs back into the AST of the whole article, which then goes through the
+# usual single-pass pipeline. The section numbers, the figure and equation
+# numbers, the labels and the bibliography are all computed on the merged AST,
+# so the result is the same as without splitting.
+#
+# NOTE:
+#   The parser has some state of its own (macros, identifiers of headers,
+#   labels for \cref & co., theorem counters, included files, ...), so we only
+#   split where the chunks can be parsed independently:
+#       - the macros defined in the body are copied at the start of the
+#         following chunks (definitions produce no output);
+#       - we don't split at all if there are theorems, \cref & co. or included
+#         files, nor after \appendix or a definition inside a group (whether
+#         it's local to the group depends on the version of pandoc);
+#       - if two chunks end up with the same header identifier, which pandoc
+#         would have made unique, `merge_docs` gives up.
+
+import re
+
+
+_BEGIN_DOCUMENT_STR = r'\begin{document}'
+_END_DOCUMENT_STR = r'\end{document}'
+
+# Don't split the documents which use these.
+_UNSPLITTABLE_RE = re.compile(
+    r'\\(?:newtheorem|[cC]ref|[cC]pageref|autoref|nameref|vref|pageref|'
+    r'input|include|chapter|part)(?![a-zA-Z@])')
+
+_VERBATIM_ENVS = ('verbatim', 'verbatim*', 'lstlisting', 'comment',
+                  'Verbatim', 'minted')
+
+_TOKEN_RE = re.compile(
+    r'(?P<section>^\\section(?![a-zA-Z@]))'
+    r'|%[^\n]*'
+    r'|\\begin{(?P<begin>[^}]*)}'
+    r'|\\end{(?P<end>[^}]*)}'
+    r'|\\verb\*?(?P<verb>[^a-zA-Z*\s])'
+    r'|\\(?P<word>[a-zA-Z@]+)'
+    r'|\\.'
+    r'|(?P<brace>[{}])',
+    flags=re.MULTILINE | re.DOTALL)
+
+_PREFIXES = {'global', 'long', 'protected'}
+_DEF_COMMANDS = {'def', 'gdef', 'edef', 'xdef'}
+_NEWCOMMAND_COMMANDS = {'newcommand', 'renewcommand', 'providecommand',
+                        'DeclareRobustCommand'}
+_DEFINITION_COMMANDS = (_PREFIXES | _DEF_COMMANDS | _NEWCOMMAND_COMMANDS |
+                        {'let', 'DeclareMathOperator', 'newenvironment',
+                         'renewenvironment'})
+
+_SPACES_RE = re.compile(r'\s*')
+_CONTROL_SEQ_RE = re.compile(r'\\(?:[a-zA-Z@]+|.)', flags=re.DOTALL)
+
+
+class _SyntaxError(Exception):
+    pass
+
+
+def _skip_spaces(text, pos):
+    return _SPACES_RE.match(text, pos).end()
+
+
+def _skip_group(text, pos):
+    # Skips a {...} group, or a single token, after optional spaces.
+    pos = _skip_spaces(text, pos)
+    if pos >= len(text):
+        raise _SyntaxError()
+    if text[pos] != '{':
+        m = _CONTROL_SEQ_RE.match(text, pos)
+        return m.end() if m else pos + 1
+    depth = 0
+    while pos < len(text):
+        c = text[pos]
+        if c == '\\':
+            pos += 2
+            continue
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth == 0:
+                return pos + 1
+        pos += 1
+    raise _SyntaxError()
+
+
+def _skip_optional(text, pos, max_count):
+    # Skips up to `max_count` [...] arguments.
+    for _ in range(max_count):
+        start = _skip_spaces(text, pos)
+        if not text.startswith('[', start):
+            break
+        end = text.find(']', start)
+        if end == -1:
+            raise _SyntaxError()
+        pos = end + 1
+    return pos
+
+
+def _skip_star(text, pos):
+    start = _skip_spaces(text, pos)
+    return start + 1 if text.startswith('*', start) else pos
+
+
+def _skip_definition(text, pos, command):
+    """
+    Returns the end of the definition whose command (`command`, without the
+    backslash) ends at `pos`.
+    """
+    while command in _PREFIXES:
+        m = _CONTROL_SEQ_RE.match(text, _skip_spaces(text, pos))
+        if m is None:
+            raise _SyntaxError()
+        pos, command = m.end(), m[0][1:]
+    if command in _DEF_COMMANDS:
+        m = _CONTROL_SEQ_RE.match(text, _skip_spaces(text, pos))
+        if m is None:
+            raise _SyntaxError()
+        body = text.find('{', m.end())          # after the parameters
+        if body == -1:
+            raise _SyntaxError()
+        return _skip_group(text, body)
+    if command in _NEWCOMMAND_COMMANDS:
+        pos = _skip_group(text, _skip_star(text, pos))
+        return _skip_group(text, _skip_optional(text, pos, 2))
+    if command == 'DeclareMathOperator':
+        pos = _skip_group(text, _skip_star(text, pos))
+        return _skip_group(text, pos)
+    if command in ('newenvironment', 'renewenvironment'):
+        pos = _skip_group(text, _skip_star(text, pos))
+        pos = _skip_group(text, _skip_optional(text, pos, 2))
+        return _skip_group(text, pos)
+    if command == 'let':
+        m = _CONTROL_SEQ_RE.match(text, _skip_spaces(text, pos))
+        if m is None:
+            raise _SyntaxError()
+        pos = _skip_spaces(text, m.end())
+        if text.startswith('=', pos):
+            pos = _skip_spaces(text, pos + 1)
+        return _skip_group(text, pos)
+    raise _SyntaxError()
+
+
+def _scan_body(body):
+    """
+    Returns the list of (pos, definitions) of the positions in `body` (the
+    text between \\begin{document} and \\end{document}) where we can split
+    it, where `definitions` are the definitions of macros found before `pos`.
+    """
+    splits = []
+    definitions = []
+    env_depth = brace_depth = 0
+    pos = 0
+    while True:
+        m = _TOKEN_RE.search(body, pos)
+        if m is None:
+            break
+        pos = m.end()
+        if m['section'] is not None:
+            if env_depth == 0 and brace_depth == 0:
+                splits.append((m.start(), ''.join(definitions)))
+        elif m['begin'] is not None:
+            if m['begin'] in _VERBATIM_ENVS:
+                end_str = r'\end{%s}' % m['begin']
+                end = body.find(end_str, pos)
+                if end == -1:
+                    raise _SyntaxError()
+                pos = end + len(end_str)
+            else:
+                env_depth += 1
+        elif m['end'] is not None:
+            env_depth -= 1
+        elif m['verb'] is not None:
+            end = body.find(m['verb'], pos)
+            if end == -1:
+                raise _SyntaxError()
+            pos = end + 1
+        elif m['word'] is not None:
+            if m['word'] == 'appendix':
+                break           # no more splits
+            if m['word'] in _DEFINITION_COMMANDS:
+                if brace_depth > 0:
+                    break       # no more splits (see the NOTE above)
+                pos = _skip_definition(body, pos, m['word'])
+                definitions.append(body[m.start():pos] + '\n')
+        elif m['brace'] is not None:
+            brace_depth += 1 if m['brace'] == '{' else -1
+    return splits
+
+
+def split_tex(latex, max_chunks):
+    """
+    Splits the TeX file `latex` into at most `max_chunks` TeX files of similar
+    size, at top-level sections, which pandoc can parse independently (see the
+    NOTE above). Returns the list of the TeX files, which is just [latex] if
+    it can't be split.
+    """
+    start = latex.find(_BEGIN_DOCUMENT_STR)
+    end = latex.rfind(_END_DOCUMENT_STR)
+    if max_chunks < 2 or start == -1 or end < start:
+        return [latex]
+    start += len(_BEGIN_DOCUMENT_STR)
+    if _UNSPLITTABLE_RE.search(latex):
+        return [latex]
+    body = latex[start:end]
+    try:
+        splits = _scan_body(body)
+    except _SyntaxError:
+        return [latex]
+
+    # We group the sections into chunks of similar size.
+    target_size = len(body) / max_chunks
+    chunks = []
+    chunk_start, chunk_definitions = 0, ''
+    for split, definitions in splits:
+        if (split - chunk_start >= target_size and
+                len(chunks) < max_chunks - 1):
+            chunks.append((chunk_start, split, chunk_definitions))
+            chunk_start, chunk_definitions = split, definitions
+    chunks.append((chunk_start, len(body), chunk_definitions))
+    if len(chunks) == 1:
+        return [latex]
+
+    preamble, tail = latex[:start], latex[end:]
+    return [preamble + definitions + body[chunk_start:chunk_end] + tail
+            for chunk_start, chunk_end, definitions in chunks]
+
+
+def _get_header_ids(blocks):
+    from pandoc_ast import walk, handles
+
+    ids = set()
+
+    @handles('Header')
+    def collect(key, value, format, meta):
+        if value[1][0]:
+            ids.add(value[1][0])
+    walk(blocks, collect, '', {})
+    return ids
+
+
+def merge_docs(docs):
+    """
+    Merges the pandoc ASTs of the chunks made by `split_tex` into the AST of
+    the whole document. Returns None if they can't be merged into what pandoc
+    would have produced from the whole document.
+    """
+    seen_ids = set()
+    for doc in docs:
+        ids = _get_header_ids(doc['blocks'])
+        if ids & seen_ids:
+            return None
+        seen_ids |= ids
+
+    meta = {}
+    blocks = []
+    for doc in docs:
+        # The metadata is mostly set in the preamble, which every chunk has,
+        # and the body can override it.
+        meta.update(doc['meta'])
+        blocks += doc['blocks']
+    return dict(docs[0], meta=meta, blocks=blocks)
@@ -0,0 +1,148 @@
+# Plain-text extracts of an article for the outputs other than its post: the
+# excerpt shown by the feed (see `--excerpt`) and the entry of the article in
+# the site-wide search index (see `--search_index`).
+#
+# They're extracted from the HTML file produced by pandoc, so LyX and pandoc
+# run only once for all the outputs. The search index is a JSON file in the
+# blog base directory which is rewritten from the entries recorded in the
+# label index (see label_index.py), so only the article being published is
+# processed, never the other posts.
+
+import json
+from html.parser import HTMLParser
+from output import write_if_changed
+
+
+EXCERPT_LENGTH = 300            # in characters
+
+# Jekyll copies it as it is, since it has no front matter.
+SEARCH_INDEX_FILE_NAME = 'search.json'
+
+_HEADER_TAGS = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+_SKIPPED_TAGS = {'script', 'style'}
+
+
+def _normalize(parts):
+    return ' '.join(''.join(parts).split())
+
+
+class _Extractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        # The text before the first header is in a section without anchor.
+        self.sections = [{'anchor': '', 'num': '', 'title': [], 'text': []}]
+        self.paragraphs = []        # the first paragraphs, for the excerpt
+        self.excerpt_length = 0
+        self.paragraph = None
+        self.header = None
+        self.in_num = False
+        self.skip_depth = 0         # in <script>, <style> or math
+        self.spans = []             # for each open <span>, what it is
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        classes = (attrs.get('class') or '').split()
+        if tag in _SKIPPED_TAGS:
+            self.skip_depth += 1
+        elif tag == 'span':
+            if 'math' in classes:
+                self.spans.append('math')
+                self.skip_depth += 1
+            elif 'header-section-number' in classes:
+                self.spans.append('num')
+                self.in_num = True
+            else:
+                self.spans.append(None)
+        elif tag in _HEADER_TAGS:
+            self.header = {'anchor': attrs.get('id') or '', 'num': [],
+                           'title': [], 'text': []}
+        elif (tag == 'p' and self.header is None and
+                self.excerpt_length < EXCERPT_LENGTH):
+            self.paragraph = []
+
+    def handle_endtag(self, tag):
+        if tag in _SKIPPED_TAGS:
+            self.skip_depth -= 1
+        elif tag == 'span' and self.spans:
+            kind = self.spans.pop()
+            if kind == 'math':
+                self.skip_depth -= 1
+            elif kind == 'num':
+                self.in_num = False
+        elif tag in _HEADER_TAGS and self.header is not None:
+            self.sections.append(self.header)
+            self.header = None
+        elif tag == 'p' and self.paragraph is not None:
+            text = _normalize(self.paragraph)
+            if text:
+                self.paragraphs.append(text)
+                self.excerpt_length += len(text) + 1
+            self.paragraph = None
+
+    def handle_data(self, data):
+        if self.skip_depth > 0:
+            return
+        if self.header is not None:
+            (self.header['num'] if self.in_num else
+             self.header['title']).append(data)
+            return
+        self.sections[-1]['text'].append(data)
+        if self.paragraph is not None:
+            self.paragraph.append(data)
+
+    def get_excerpt(self):
+        excerpt = ' '.join(self.paragraphs)
+        if len(excerpt) > EXCERPT_LENGTH:
+            cut = excerpt.rfind(' ', 0, EXCERPT_LENGTH)
+            excerpt = excerpt[:cut if cut > 0 else EXCERPT_LENGTH] + '…'
+        return excerpt
+
+    def get_sections(self):
+        sections = [{key: _normalize(value) if key != 'anchor' else value
+                     for key, value in section.items()}
+                    for section in self.sections]
+        if not sections[0]['text']:
+            del sections[0]
+        return sections
+
+
+def extract_html(html_path):
+    """
+    Returns the extracts of the HTML file produced by pandoc: a dict with the
+    plain-text `excerpt` (the first paragraphs, up to EXCERPT_LENGTH
+    characters) and the `sections`, a list of dicts with the `anchor`, `num`,
+    `title` and plain `text` of each section. Math is left out.
+    """
+    extractor = _Extractor()
+    with open(html_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            extractor.feed(line)
+    extractor.close()
+    return {'excerpt': extractor.get_excerpt(),
+            'sections': extractor.get_sections()}
+
+
+def get_search_entry(url, jekyll_fm, html_file_name, extract):
+    """
+    Returns the entry (JSON text) of the article in the search index.
+    """
+    entry = {'url': url,
+             'title': str(jekyll_fm.get('title', html_file_name)),
+             'date': jekyll_fm['date'].isoformat(),
+             'excerpt': extract['excerpt'],
+             'sections': extract['sections']}
+    for key in ('categories', 'tags'):
+        value = jekyll_fm.get(key)
+        if value is not None:
+            entry[key] = (value.split() if isinstance(value, str) else
+                          [str(v) for v in value])
+    return json.dumps(entry, ensure_ascii=False, sort_keys=True)
+
+
+def write_search_index(path, entries):
+    """
+    Writes the search index made of `entries` (JSON texts) to `path`, unless
+    it's unchanged. Returns whether it changed.
+    """
+    data = '[\n' + ',\n'.join(entries) + '\n]\n'
+    return write_if_changed(path, data.encode('utf-8'))
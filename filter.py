@@ -1,9 +1,16 @@
 # AST defs: search for "Text-Pandoc-Definition.html"
 
-from pandocfilters import toJSONFilter, RawBlock, Math, RawInline, Para,\
-    Image, Emph, Str, Space, Span, Header
+# pandoc runs this filter in a fresh interpreter at every conversion, so we
+# keep its startup short: no pandocfilters (see pandoc_ast.py), and the info
+# from LyXBlog.py is in a single JSON file. The math renderer and the label
+# index are only made if needed.
+
+from pandoc_ast import run_filters, handles, RawBlock, Math, RawInline, \
+    Para, Plain, Figure, Image, Emph, Str, Space, Span, Header
+import os
 import re
-import pickle
+import time
+import json
 
 # f = open('filter_log.txt', 'w', encoding='utf-8')
 
@@ -13,14 +20,168 @@ image_idx = 0
 
 UID2 = '86345huihsdfguhsjlkertvxgkh3498asdg'
 
-section_info, sec_name_to_num = pickle.load(open('lyxblog_label_info.p', 'rb'))
-image_info, img_name_to_num = pickle.load(open('lyxblog_image_info.p', 'rb'))
+section_info, sec_name_to_num = [], {}
+image_info, img_name_to_num = [], {}
+
+# Set when the math is rendered at build time (see math_render.py): the
+# options of the renderer, and the renderer (see `get_math_prerenderer`).
+prerender_math_info, math_prerenderer = None, None
+
+# The path of the index of the labels of all the articles (see
+# label_index.py), the index (see `get_label_index`) and this article in it.
+index_path, label_index, article = None, None, None
+eq_name_to_num, next_eq_num = {}, 1
+other_labels = set()            # the labels not in sections, figures or eqs
+ref_names = []
+
+
+def set_info(section_info_and_map, image_info_and_map, math_info=None,
+             index_info=None):
+    # This is used when the filter is run in-process (see LyXBlog.py) rather
+    # than by pandoc.
+    # `math_info` is a dict with the 'renderer', 'cache_dir' (or None) and
+    # 'macros' of the build-time math rendering, or None to leave the math to
+    # MathJax.
+    # `index_info` is a dict with the 'path' of the label index and the
+    # 'article', or None not to use the index.
+    global section_info, sec_name_to_num, image_info, img_name_to_num
+    global image_idx, prerender_math_info, math_prerenderer
+    global index_path, label_index, article
+    global eq_name_to_num, next_eq_num, other_labels, ref_names
+    section_info, sec_name_to_num = section_info_and_map
+    image_info, img_name_to_num = image_info_and_map
+    image_idx = 0
+    prerender_math_info, math_prerenderer = math_info, None
+    if label_index is not None:
+        label_index.close()
+    index_path, label_index, article = None, None, None
+    if index_info is not None:
+        index_path, article = index_info['path'], index_info['article']
+    eq_name_to_num, next_eq_num = {}, 1
+    other_labels = set()
+    ref_names = []
+
+
+def load_info(work_dir):
+    # Loads the info written by LyXBlog.py (see write_filter_info) in the
+    # workspace of the conversion.
+    from workspace import FILTER_INFO_FILE_NAME
+    with open(os.path.join(work_dir, FILTER_INFO_FILE_NAME), 'rb') as f:
+        info = json.loads(f.read())
+    set_info(info['label_info'], info['image_info'], info['math_info'],
+             info['index_info'])
+
+
+def get_math_prerenderer():
+    global math_prerenderer
+    if math_prerenderer is None:
+        import math_render
+        from cache import BuildCache
+        cache_dir = prerender_math_info['cache_dir']
+        math_prerenderer = math_render.MathPrerenderer(
+            math_render.get_renderer(prerender_math_info['renderer']),
+            BuildCache(cache_dir) if cache_dir is not None else None,
+            prerender_math_info['macros'])
+    return math_prerenderer
+
+
+def get_label_index():
+    global label_index
+    if label_index is None:
+        from label_index import LabelIndex
+        label_index = LabelIndex(index_path)
+    return label_index
+
+
+def get_eq_name_to_num():
+    if prerender_math_info is not None:
+        return get_math_prerenderer().label_to_num
+    return eq_name_to_num
+
+
+def save_labels():
+    # Records the labels of the article and the names it references in the
+    # label index. This must be called after the whole document has been
+    # filtered.
+    if index_path is None:
+        return
+    from math_render import equation_anchor
+    # With MathJax, the anchors of the equations are made by MathJax.
+    eq_anchor_fmt = ('{}' if prerender_math_info is not None else
+                     'mjx-eqn-{}')
+    labels = {name: ('', 'label', name) for name in other_labels}
+    labels.update({name: (num, 'equation',
+                          eq_anchor_fmt.format(equation_anchor(name)))
+                   for name, num in get_eq_name_to_num().items()})
+    labels.update({name: (num, 'figure', name)
+                   for name, num in img_name_to_num.items()})
+    labels.update({name: (num, 'section', name)
+                   for name, num in sec_name_to_num.items()})
+    get_label_index().set_labels(article, labels, ref_names)
 
 
 def make_attrs(id, classes, style_dict):
     return id, classes, list(style_dict.items())
 
 
+def to_ams_env(latex):
+    # MathJax supports labels and eq. numbering only for AMS envs, so we
+    # convert non-AMS envs into AMS envs.
+    if latex.startswith(r'\begin{'):
+        return latex
+    # We assume there are no comments inside math blocks (if the file
+    # is produced by LyX, there shouldn't be any).
+    pos = latex.find(r'\label{')
+    if pos == -1:           # no labels => no numbering
+        return r'\begin{align*}' + latex + r'\end{align*}'
+    else:
+        return r'\begin{align}' + latex + r'\end{align}'
+
+
+def is_ref(latex):
+    return ((latex.startswith('\\ref{') or latex.startswith('\\eqref{')) and
+            latex[-1] == '}')
+
+
+@handles('Math')
+def collect_math(key, value, format, meta):
+    # This runs before `filter_main` when the math is rendered at build time,
+    # so that all the equations are numbered and rendered before we need them.
+    if key == 'Math':
+        if value[0]['t'] == 'DisplayMath':
+            get_math_prerenderer().add(to_ams_env(value[1]), True)
+        elif not is_ref(value[1]):
+            get_math_prerenderer().add(value[1], False)
+
+
+@handles('Math', 'Span')
+def collect_labels(key, value, format, meta):
+    # This runs before `filter_main` when we use the label index, so that we
+    # know all the labels of this article when we find the references. We
+    # number the equations the way MathJax does.
+    global next_eq_num
+    if key == 'Math' and value[0]['t'] == 'DisplayMath':
+        if prerender_math_info is None:
+            import math_render
+            _, labels, next_eq_num = math_render.number_equation(
+                to_ams_env(value[1]), next_eq_num)
+            eq_name_to_num.update(labels)
+    elif key == 'Span':
+        key_values = value[0][2]
+        if len(key_values) == 1 and key_values[0][0] == 'label':
+            other_labels.add(key_values[0][1])
+
+
+def get_actions():
+    actions = [filter_main]
+    if index_path is not None:
+        actions.insert(0, collect_labels)
+    if prerender_math_info is not None:
+        actions.insert(0, collect_math)
+    return actions
+
+
+@handles('CodeBlock', 'Math', 'Span', 'Header', 'Para', 'Figure')
 def filter_main(key, value, format, meta):
     # f.write(repr(key) + '\n')
     # f.write(repr(value) + '\n')
@@ -31,17 +192,12 @@ def filter_main(key, value, format, meta):
         if m:
             return RawBlock('html', m[1])
     elif key == 'Math' and value[0]['t'] == 'DisplayMath':  # i.e. not inline
-        # MathJax supports labels and eq. numbering only for AMS envs, so we
-        # convert non-AMS envs into AMS envs.
         latex = value[1]
-        if not latex.startswith(r'\begin{'):        # not AMS env
-            # We assume there are no comments inside math blocks (if the file
-            # is produced by LyX, there shouldn't be any).
-            pos = latex.find(r'\label{')
-            if pos == -1:           # no labels => no numbering
-                fixed = r'\begin{align*}' + value[1] + r'\end{align*}'
-            else:
-                fixed = r'\begin{align}' + value[1] + r'\end{align}'
+        fixed = to_ams_env(latex)
+        if prerender_math_info is not None:
+            return RawInline('html',
+                             get_math_prerenderer().get_html(fixed, True))
+        if fixed != latex:              # not AMS env
             return Math(value[0], fixed)
     elif key == 'Span':
         # This supports general labels (i.e. labels not in equations, captions
@@ -60,59 +216,127 @@ def filter_main(key, value, format, meta):
                 value[1][0] = label_name
                 return Header(value[0], value[1], content[:-1])
     elif key == 'Math' and value[0]['t'] == 'InlineMath':
-        if value[1].startswith('\\ref{') and value[1][-1] == '}':
-            name = value[1][len('\\ref{'): -1]
+        if is_ref(value[1]):
+            is_eqref = value[1].startswith('\\eqref{')
+            name = value[1][value[1].index('{') + 1: -1]
 
             # We try to extract the text from the label itself.
             # (=00007B and =00007D represent '{' and '}' and are in the TeX
             # file produced by LyX.)
             m = re.match(r'.*=00007B([^}]+)=00007D$', name)
-            if m:
+            if m and not is_eqref:
                 return RawInline(
                     'html', '<a href="#{}">{}</a>'.format(name, m[1]))
 
+            ref_names.append(name)
+
             # We only handle references to sections and images here.
             # (Mathjax already handles the equations.)
             num = sec_name_to_num.get(name,
                                       img_name_to_num.get(name, None))
-            if num:
+            if num and not is_eqref:
                 return RawInline(
                     'html', '<a href="#{}">{}</a>'.format(name, num))
 
+            # A label of another article?
+            if (index_path is not None and num is None and
+                    name not in get_eq_name_to_num() and
+                    name not in other_labels):
+                found = get_label_index().lookup(name, article)
+                if found is not None:
+                    permalink, num, kind, anchor = found
+                    num = num or '??'
+                    if is_eqref:
+                        num = '(' + num + ')'
+                    return RawInline('html', '<a href="{}#{}">{}</a>'.format(
+                        permalink, anchor, num))
+
+            # With build-time math rendering, there's no MathJax to handle the
+            # references to equations.
+            if prerender_math_info is not None:
+                from math_render import equation_anchor
+                num = get_math_prerenderer().label_to_num.get(name) or '??'
+                if is_eqref:
+                    num = '(' + num + ')'
+                return RawInline('html', '<a href="#{}">{}</a>'.format(
+                    equation_anchor(name), num))
+        elif prerender_math_info is not None:
+            return RawInline('html',
+                             get_math_prerenderer().get_html(value[1],
+                                                             False))
+
     elif key == 'Para' and value[0]['t'] == 'Image':
         # NOTE:
         #   In pandoc 2, a Para[Image] where Image.title is 'fig:' becomes
         #   a <figure> with a <figcaption>.
 
-        [id, classes, style], alt, [src, title] = value[0]['c']
-        style = {k: v for k, v in style}
-        width = float(style.get('width', '100.0%')[:-1])
-        margin = (100 - width) / 2
+        [_, _, style], alt, [_, title] = value[0]['c']
+        img_attrs, caption, src = make_figure(style, alt, title == 'fig:')
+        return Para([Image(img_attrs, caption, (src, 'fig:'))])
+
+    elif key == 'Figure':
+        # NOTE:
+        #   pandoc 3 has Figure blocks instead. We make the same figure, with
+        #   the label on the image, so that fix_figure_tag still works.
+        [label, _, _], [_, caption_blocks], blocks = value
+        images = find_images(blocks)
+        if len(images) != 1:
+            return None
+        [_, _, style], _, _ = images[0]['c']
+        alt = [inline for block in caption_blocks
+               if block['t'] in ('Plain', 'Para') for inline in block['c']]
+        img_attrs, caption, src = make_figure(style, alt, True, label)
+        return Figure(make_attrs('', [], {}), [None, [Plain(caption)]],
+                      [Plain([Image(img_attrs, caption, (src, ''))])])
+
+
+def find_images(blocks):
+    # Returns the images in `blocks`, also looking into Divs: the body of a
+    # LyX figure is `Div.centering[Plain[Image]]` in pandoc 3.
+    images = []
+    for block in blocks:
+        if block['t'] == 'Div':
+            images += find_images(block['c'][1])
+        elif block['t'] in ('Plain', 'Para'):
+            images += [inline for inline in block['c']
+                       if inline['t'] == 'Image']
+    return images
 
-        global image_idx
-        src = image_info[image_idx]
-        image_idx += 1
 
-        label = ''
-        if alt[-1]['t'] == 'Span':
-            id, classes, key_values = alt[-1]['c'][0]       # attr
-            key_values = dict(key_values)
-            if 'label' in key_values:
-                # remove the label from the caption (it'll be put right before
-                # the image).
-                alt = alt[:-1]      # remove the label from the caption
-                label = key_values['label']
+def make_figure(style, alt, has_caption, label=''):
+    # Returns the attributes, the caption and the src of the image of the next
+    # figure, given the style and the alt text (i.e. the caption) of the image
+    # produced by pandoc. The label may be at the end of the caption.
+    style = {k: v for k, v in style}
+    width = float(style.get('width', '100.0%')[:-1])
+    margin = (100 - width) / 2
 
-        fake_class = '{}:{:.5}%'.format(UID2, margin)
-        img_attrs = make_attrs(label, [fake_class], {'width': '100%'})
-        caption = [Emph([Str('Figure {}.'.format(image_idx))])]
-        if title == 'fig:':
-            caption += [Space()] + alt
+    global image_idx
+    src = image_info[image_idx]
+    image_idx += 1
 
-        para_content = [Image(img_attrs, caption, (src, 'fig:'))]
+    if alt and alt[-1]['t'] == 'Span':
+        key_values = dict(alt[-1]['c'][0][2])       # attr
+        if 'label' in key_values:
+            # remove the label from the caption (it'll be put right before
+            # the image).
+            alt = alt[:-1]
+            label = key_values['label']
 
-        return Para(para_content)
+    fake_class = '{}:{:.5}%'.format(UID2, margin)
+    img_attrs = make_attrs(label, [fake_class], {'width': '100%'})
+    caption = [Emph([Str('Figure {}.'.format(image_idx))])]
+    if has_caption:
+        caption += [Space()] + alt
+    return img_attrs, caption, src
 
 
 if __name__ == "__main__":
-    toJSONFilter(filter_main)
+    start_time = time.perf_counter()
+    from workspace import WORKSPACE_ENV_VAR
+    load_info(os.environ[WORKSPACE_ENV_VAR])
+    run_filters(get_actions())
+    save_labels()
+    if 'LYXBLOG_PROFILE_FILTERS' in os.environ:       # see profiling.py
+        import profiling
+        profiling.record_filter_run('filter.py', start_time)
@@ -1,4 +1,6 @@
-from pandocfilters import toJSONFilter, Header
+import os
+import time
+from pandoc_ast import run_filters, handles, Header, stringify
 
 
 # f = open('filter_num_log.txt', 'w', encoding='utf-8')
@@ -6,6 +8,7 @@ from pandocfilters import toJSONFilter, Header
 UID = 'guy76r856itybr6dv76e47igyuytb098hjkl'
 
 
+@handles('Header')
 def filter_main(key, value, format, meta):
     # f.write(repr(key) + '\n')
     # f.write(repr(value) + '\n')
@@ -16,5 +19,47 @@ def filter_main(key, value, format, meta):
         return Header(value[0], [UID, [], []], value[2])
 
 
+def number_sections(blocks):
+    """
+    Computes the section numbers directly on the AST, the same way pandoc does
+    with `--number-sections`, so that we don't need a pandoc pass with
+    `filter_main` and `get_section_label_info` to scrape them from the HTML.
+
+    Returns the same `(section_info, name_to_num)` pair as
+    `get_section_label_info`, but the first field of each item of
+    `section_info` is None as there's no HTML line.
+    """
+    section_info = []
+    name_to_num = {}
+
+    # NOTE: pandoc only numbers top-level headers.
+    last_num = []
+    for block in blocks:
+        if block['t'] != 'Header':
+            continue
+        level, [id, classes, key_values], content = block['c']
+        if 'unnumbered' in classes:
+            continue
+        if len(last_num) >= level:
+            last_num = last_num[:level]
+            last_num[-1] += 1
+        else:
+            last_num = last_num + [0] * (level - len(last_num) - 1) + [1]
+        num = '.'.join(str(n) for n in last_num)
+
+        label_name = None
+        if content and content[-1]['t'] == 'Span':
+            [_, _, span_key_values], _ = content[-1]['c']
+            label_name = dict(span_key_values).get('label', None)
+        section_info.append((None, num, stringify(content), label_name))
+        if label_name:
+            name_to_num[label_name] = num
+    return section_info, name_to_num
+
+
 if __name__ == "__main__":
-    toJSONFilter(filter_main)
+    start_time = time.perf_counter()
+    run_filters([filter_main])
+    if 'LYXBLOG_PROFILE_FILTERS' in os.environ:       # see profiling.py
+        import profiling
+        profiling.record_filter_run('filter_num.py', start_time)
@@ -0,0 +1,497 @@
+import os
+import re
+import io
+import json
+import base64
+import struct
+import concurrent.futures
+from cache import hash_bytes, hash_file
+from output import write_if_changed
+
+# PIL.Image, once imported (see `_get_pil_image`).
+_pil_image = False
+
+
+DEFAULT_WIDTHS = [480, 960, 1440]
+
+# The resized variants and the minified SVGs go in this subdirectory of the
+# directory of the images of the article.
+VARIANTS_DIR_NAME = 'variants'
+
+# Bump it when the output of `_process_image` changes.
+_PROCESS_VERSION = '1'
+
+# Bump it when the output of `_get_inline_payload` changes.
+_INLINE_VERSION = '1'
+
+_RESIZABLE_FORMATS = {'png': 'PNG', 'jpeg': 'JPEG'}
+
+
+def _get_pil_image():
+    # Pillow is slow to import, so we only import it when we optimize images.
+    global _pil_image
+    if _pil_image is False:
+        try:
+            # Optional: without it, we don't generate resized variants.
+            import PIL.Image
+            _pil_image = PIL.Image
+        except ImportError:
+            _pil_image = None
+    return _pil_image
+
+
+def _read_png_size(data):
+    if data[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', data[16:24])
+
+
+def _read_gif_size(data):
+    return struct.unpack('<HH', data[6:10])
+
+
+def _read_jpeg_size(data):
+    pos = 2
+    while pos + 9 < len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:          # padding
+            pos += 1
+            continue
+        if 0xD0 <= marker <= 0xD9 or marker == 0x01:    # no length
+            pos += 2
+            continue
+        length = struct.unpack('>H', data[pos + 2:pos + 4])[0]
+        # SOF markers (but not DHT, JPG and DAC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>HH', data[pos + 5:pos + 9])
+            return width, height
+        pos += 2 + length
+    return None
+
+
+_SVG_ROOT_RE = re.compile(rb'<svg\b[^>]*>', flags=re.S)
+_SVG_LENGTH_RE = re.compile(rb'^\s*([0-9.]+)\s*(px)?\s*$')
+
+
+def _svg_attr(tag, name):
+    m = re.search(rb'\s' + name + rb'\s*=\s*["\']([^"\']*)["\']', tag)
+    return m[1] if m else None
+
+
+def _read_svg_size(data):
+    m = _SVG_ROOT_RE.search(data)
+    if m is None:
+        return None
+    tag = m[0]
+    width = _svg_attr(tag, rb'width')
+    height = _svg_attr(tag, rb'height')
+    if width is not None and height is not None:
+        mw = _SVG_LENGTH_RE.match(width)
+        mh = _SVG_LENGTH_RE.match(height)
+        if mw and mh:
+            return round(float(mw[1])), round(float(mh[1]))
+    view_box = _svg_attr(tag, rb'viewBox')
+    if view_box is not None:
+        values = view_box.replace(b',', b' ').split()
+        if len(values) == 4:
+            return round(float(values[2])), round(float(values[3]))
+    return None
+
+
+def get_image_format(data):
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if data.startswith(b'\xff\xd8'):
+        return 'jpeg'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if _SVG_ROOT_RE.search(data[:4096]) is not None:
+        return 'svg'
+    return None
+
+
+def get_image_size(data):
+    """
+    Returns the intrinsic (width, height) of the image `data` (bytes), read
+    from its header, or None if unknown.
+    """
+    readers = {'png': _read_png_size, 'jpeg': _read_jpeg_size,
+               'gif': _read_gif_size, 'svg': _read_svg_size}
+    image_format = get_image_format(data)
+    if image_format is None:
+        return None
+    try:
+        return readers[image_format](data)
+    except (struct.error, ValueError):
+        return None
+
+
+_SVG_COMMENT_RE = re.compile(rb'<!--.*?-->', flags=re.S)
+_SVG_EDITOR_DATA_RE = re.compile(
+    rb'<metadata\b.*?</metadata>|<metadata\b[^>]*/>'
+    rb'|<sodipodi:namedview\b.*?(?:/>|</sodipodi:namedview>)', flags=re.S)
+_SVG_EDITOR_ATTR_RE = re.compile(rb'\s(?:inkscape|sodipodi):[\w-]+="[^"]*"')
+_SVG_INDENT_RE = re.compile(rb'\n\s+')
+
+
+def minify_svg(data):
+    """
+    Removes comments, editor data (metadata, Inkscape's attributes) and
+    indentation from the SVG `data` (bytes).
+    """
+    data = _SVG_COMMENT_RE.sub(b'', data)
+    data = _SVG_EDITOR_DATA_RE.sub(b'', data)
+    data = _SVG_EDITOR_ATTR_RE.sub(b'', data)
+    return _SVG_INDENT_RE.sub(b'\n', data).strip() + b'\n'
+
+
+def _process_image(path, widths):
+    """
+    Returns the info of the image at `path` as a dict with
+        'size':     (width, height) or None
+        'variants': {width: bytes} of the resized variants
+        'svg':      the minified SVG (bytes), or None
+    This runs in a worker process.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    info = {'size': get_image_size(data), 'variants': {}, 'svg': None}
+    image_format = get_image_format(data)
+    if image_format == 'svg':
+        info['svg'] = minify_svg(data)
+    elif (image_format in _RESIZABLE_FORMATS and
+          _get_pil_image() is not None and info['size'] is not None):
+        pil_image = _get_pil_image()
+        width, height = info['size']
+        with pil_image.open(io.BytesIO(data)) as image:
+            image.load()
+            for w in widths:
+                if w >= width:
+                    continue
+                h = max(1, round(height * w / width))
+                out = io.BytesIO()
+                image.resize((w, h), pil_image.LANCZOS).save(
+                    out, _RESIZABLE_FORMATS[image_format], optimize=True)
+                info['variants'][w] = out.getvalue()
+    return info
+
+
+def _get_cached(cache, key):
+    data = cache.get(key)
+    if data is None:
+        return None
+    meta = json.loads(str(data, 'utf-8'))
+    info = {'size': meta['size'] and tuple(meta['size']), 'variants': {},
+            'svg': None}
+    for w in meta['variants']:
+        variant = cache.get(hash_bytes(key, 'variant', str(w)))
+        if variant is None:
+            return None
+        info['variants'][w] = variant
+    if meta['svg']:
+        info['svg'] = cache.get(hash_bytes(key, 'svg'))
+        if info['svg'] is None:
+            return None
+    return info
+
+
+def _put_cached(cache, key, info):
+    # The metadata goes last, so the entry is complete when it's there.
+    for w, variant in info['variants'].items():
+        cache.put(hash_bytes(key, 'variant', str(w)), variant)
+    if info['svg'] is not None:
+        cache.put(hash_bytes(key, 'svg'), info['svg'])
+    cache.put(key, json.dumps({'size': info['size'],
+                               'variants': sorted(info['variants']),
+                               'svg': info['svg'] is not None})
+              .encode('utf-8'))
+
+
+def optimize_images(blog_dir, image_http_paths, widths=None, cache=None,
+                    jobs=None, changed_outputs=None):
+    """
+    Generates, for the published images `image_http_paths` (as in the
+    `image_info` returned by `handle_images`), the resized variants (only if
+    PIL is installed) and the minified SVGs, which go in the subdirectory
+    VARIANTS_DIR_NAME of the directory of the images.
+
+    The results are cached by content hash in `cache` (a BuildCache), if
+    given, so unchanged images are never processed again. The images which
+    aren't in the cache are processed on a pool of `jobs` processes.
+
+    Returns a dict which maps the http path of each image to the attributes
+    to add to its `<img>` tag (see `add_image_attrs_lines`). The paths of the
+    files written or removed are appended to `changed_outputs`, if given.
+    """
+    widths = sorted(widths or DEFAULT_WIDTHS)
+    if changed_outputs is None:
+        changed_outputs = []
+
+    def write(path, data):
+        if write_if_changed(path, data):
+            changed_outputs.append(path)
+
+    keys = {}
+    for http_path in set(image_http_paths):
+        path = os.path.join(blog_dir, http_path.lstrip('/'))
+        keys[http_path] = hash_bytes('image', _PROCESS_VERSION,
+                                     hash_file(path), repr(widths),
+                                     str(_get_pil_image() is not None))
+
+    infos = {}
+    to_process = []
+    for http_path, key in keys.items():
+        info = _get_cached(cache, key) if cache is not None else None
+        if info is None:
+            to_process.append(http_path)
+        else:
+            infos[http_path] = info
+
+    if len(to_process) > 1:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            futures = {http_path: executor.submit(
+                _process_image, os.path.join(blog_dir, http_path.lstrip('/')),
+                widths) for http_path in to_process}
+            for http_path, future in futures.items():
+                infos[http_path] = future.result()
+    else:
+        for http_path in to_process:
+            infos[http_path] = _process_image(
+                os.path.join(blog_dir, http_path.lstrip('/')), widths)
+    if cache is not None:
+        for http_path in to_process:
+            _put_cached(cache, keys[http_path], infos[http_path])
+
+    image_attrs = {}
+    written = {}        # variants dir -> names of the files we wrote
+    for http_path, info in sorted(infos.items()):
+        http_dir, base_name = http_path.rsplit('/', 1)
+        http_variants_dir = http_dir + '/' + VARIANTS_DIR_NAME
+        variants_dir = os.path.join(blog_dir, http_variants_dir.lstrip('/'))
+        names = written.setdefault(variants_dir, set())
+
+        attrs = {'loading': 'lazy'}
+        if info['size'] is not None:
+            attrs['width'], attrs['height'] = map(str, info['size'])
+        if info['svg'] is not None:
+            os.makedirs(variants_dir, exist_ok=True)
+            write(os.path.join(variants_dir, base_name), info['svg'])
+            names.add(base_name)
+            attrs['src'] = http_variants_dir + '/' + base_name
+        if info['variants']:
+            os.makedirs(variants_dir, exist_ok=True)
+            root, ext = os.path.splitext(base_name)
+            srcset = []
+            for w, variant in sorted(info['variants'].items()):
+                name = '{}-{}w{}'.format(root, w, ext)
+                write(os.path.join(variants_dir, name), variant)
+                names.add(name)
+                srcset.append('{}/{} {}w'.format(http_variants_dir, name, w))
+            srcset.append('{} {}w'.format(http_path, info['size'][0]))
+            attrs['srcset'] = ', '.join(srcset)
+        image_attrs[http_path] = attrs
+
+    # Remove the variants of the images which changed or are gone.
+    for variants_dir, names in written.items():
+        if not os.path.isdir(variants_dir):
+            continue
+        for name in os.listdir(variants_dir):
+            if name not in names:
+                os.remove(os.path.join(variants_dir, name))
+                changed_outputs.append(os.path.join(variants_dir, name))
+    return image_attrs
+
+
+_IMG_SRC_RE = re.compile(r'<img src="([^"]+)"([^>]*?)(\s*/?>)')
+_STYLE_RE = re.compile(r'\sstyle="')
+
+
+def add_image_attrs_lines(lines, image_attrs, keep_src=()):
+    """
+    Adds to the `<img>` tags in `lines` the attributes in `image_attrs` (see
+    `optimize_images`). If an image has a width and a height, its style also
+    gets 'height:auto' so that it's scaled in proportion to its width.
+
+    The images in `keep_src` keep their src, so that `inline_images_lines`
+    can still find them.
+    """
+    def fix_img(m):
+        attrs = image_attrs.get(m[1])
+        if attrs is None:
+            return m[0]
+        attrs = dict(attrs)
+        src = attrs.pop('src', m[1])
+        if m[1] in keep_src:
+            src = m[1]
+        rest = m[2]
+        if 'height' in attrs:
+            if _STYLE_RE.search(rest):
+                rest = _STYLE_RE.sub(' style="height:auto;', rest, count=1)
+            else:
+                rest += ' style="height:auto"'
+        return ('<img src="' + src + '"' + rest +
+                ''.join(' {}="{}"'.format(k, v)
+                        for k, v in sorted(attrs.items())
+                        if ' {}='.format(k) not in rest) +
+                m[3])
+
+    for line in lines:
+        if '<img ' in line:
+            line = _IMG_SRC_RE.sub(fix_img, line)
+        yield line
+
+
+_XML_PROLOG_RE = re.compile(rb'^.*?(?=<svg\b)', flags=re.S)
+_SVG_ID_RE = re.compile(rb'(\sid\s*=\s*)(["\'])([^"\']+)\2')
+_SVG_ID_REF_RE = re.compile(rb'url\(\s*#([^)\s]+)\s*\)|'
+                            rb'((?:xlink:)?href\s*=\s*["\'])#([^"\']+)')
+
+
+def _prepare_inline_svg(data, prefix):
+    """
+    Returns the minified SVG `data` (bytes) ready to be put into an HTML page
+    (without the XML prolog), with the ids of its elements (and the references
+    to them) prefixed with `prefix` so that they can't collide with the ones
+    of the page or of other SVGs.
+    """
+    data = _XML_PROLOG_RE.sub(b'', minify_svg(data), count=1)
+    ids = {m[3] for m in _SVG_ID_RE.finditer(data)}
+    data = _SVG_ID_RE.sub(lambda m: m[1] + m[2] + prefix + m[3] + m[2], data)
+
+    def fix_ref(m):
+        if m[1] is not None:
+            return (b'url(#' + prefix + m[1] + b')' if m[1] in ids else
+                    m[0])
+        return m[2] + b'#' + prefix + m[3] if m[3] in ids else m[0]
+    data = _SVG_ID_REF_RE.sub(fix_ref, data)
+
+    # Without a viewBox, the SVG couldn't be scaled like an image.
+    m = _SVG_ROOT_RE.search(data)
+    if m is not None and _svg_attr(m[0], rb'viewBox') is None:
+        size = _read_svg_size(data)
+        if size is not None:
+            data = (data[:m.start() + len(b'<svg')] +
+                    ' viewBox="0 0 {} {}"'.format(*size).encode('ascii') +
+                    data[m.start() + len(b'<svg'):])
+    return data
+
+
+def _get_inline_payload(path, key):
+    """
+    Returns ('data', data URI) for a raster image, ('svg', SVG element) for
+    an SVG and None for other images.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    image_format = get_image_format(data)
+    if image_format == 'svg':
+        prefix = 'svg-{}-'.format(key[:8]).encode('ascii')
+        return 'svg', str(_prepare_inline_svg(data, prefix), 'utf-8')
+    if image_format is None:
+        return None
+    return 'data', 'data:image/{};base64,{}'.format(
+        image_format, str(base64.b64encode(data), 'ascii'))
+
+
+def inline_images(blog_dir, image_http_paths, max_size, cache=None):
+    """
+    Returns the payloads of the published images `image_http_paths` (as in
+    the `image_info` returned by `handle_images`) whose files are at most
+    `max_size` bytes, to put them directly into the HTML page (see
+    `inline_images_lines`): a dict which maps the http path of each image to
+    ('data', data URI) or ('svg', SVG element).
+
+    The payloads are cached by content hash in `cache` (a BuildCache), if
+    given, so unchanged images are never encoded again.
+    """
+    payloads = {}
+    for http_path in set(image_http_paths):
+        path = os.path.join(blog_dir, http_path.lstrip('/'))
+        if os.path.getsize(path) > max_size:
+            continue
+        key = hash_bytes('inline', _INLINE_VERSION, hash_file(path))
+        data = cache.get(key) if cache is not None else None
+        if data is not None:
+            payload = json.loads(str(data, 'utf-8'))
+        else:
+            payload = _get_inline_payload(path, key)
+            if cache is not None:
+                cache.put(key, json.dumps(payload).encode('utf-8'))
+        if payload is not None:
+            payloads[http_path] = tuple(payload)
+    return payloads
+
+
+_ATTR_RE = re.compile(r'\s([\w:.-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+_SVG_ROOT_STR_RE = re.compile(r'<svg\b([^>]*?)(/?>)', flags=re.S)
+_SVG_ID_PREFIX_RE = re.compile(r'svg-[0-9a-f]{8}-')
+_VARIANT_ATTRS_RE = re.compile(r'\s(?:srcset|sizes)="[^"]*"')
+
+# The attributes of the `<img>` tag which don't apply to an SVG element.
+_IMG_ONLY_ATTRS = {'alt', 'loading', 'srcset', 'sizes', 'decoding'}
+
+
+def _parse_attrs(text):
+    return {m[1]: m[2] if m[2] is not None else m[3]
+            for m in _ATTR_RE.finditer(text)}
+
+
+def _img_to_svg(svg, img_attrs, prefix):
+    # Gives the SVG element the attributes of the `<img>` tag, so that it
+    # keeps its id (for the references to the figure), class and style.
+    if prefix is not None:
+        svg = svg.replace(prefix[0], prefix[1])
+    m = _SVG_ROOT_STR_RE.search(svg)
+    if m is None:
+        return None
+    attrs = _parse_attrs(m[1])
+    if 'width' in img_attrs or 'width:' in img_attrs.get('style', ''):
+        attrs.pop('width', None)
+        attrs.pop('height', None)
+    for name, value in img_attrs.items():
+        if name not in _IMG_ONLY_ATTRS and value:
+            attrs[name] = value
+    if img_attrs.get('alt', '').strip():
+        attrs['role'] = 'img'
+        attrs['aria-label'] = img_attrs['alt'].strip()
+    root = '<svg' + ''.join(' {}="{}"'.format(name,
+                                              value.replace('"', '&quot;'))
+                            for name, value in attrs.items()) + m[2]
+    return svg[:m.start()] + root + svg[m.end():].rstrip('\n')
+
+
+def inline_images_lines(lines, payloads):
+    """
+    Puts the images in `payloads` (see `inline_images`) directly into the
+    `<img>` tags in `lines`: the raster images become data URIs, and the
+    SVGs replace the tags. If an SVG appears more than once, each copy gets
+    its own ids. This goes after `add_image_attrs_lines`, so that the raster
+    images keep their width and height.
+    """
+    counts = {}
+
+    def fix_img(m):
+        payload = payloads.get(m[1])
+        if payload is None:
+            return m[0]
+        kind, data = payload
+        if kind == 'data':
+            # The variants would take precedence over the data URI.
+            return ('<img src="' + data + '"' +
+                    _VARIANT_ATTRS_RE.sub('', m[2]) + m[3])
+        count = counts[m[1]] = counts.get(m[1], 0) + 1
+        prefix = None
+        if count > 1:
+            id_prefix = _SVG_ID_PREFIX_RE.search(data)
+            if id_prefix is not None:
+                prefix = (id_prefix[0],
+                          '{}{}-'.format(id_prefix[0], count))
+        svg = _img_to_svg(data, _parse_attrs(m[2]), prefix)
+        return m[0] if svg is None else svg
+
+    for line in lines:
+        if '<img ' in line:
+            line = _IMG_SRC_RE.sub(fix_img, line)
+        yield line
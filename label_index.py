@@ -0,0 +1,242 @@
+# Index of the labels of all the published articles, so that an article can
+# reference a section, figure or equation of another one.
+#
+# It's an SQLite database in the blog base directory. When an article is
+# converted, filter.py replaces its labels (with their numbers) and the names
+# it references; the other articles are never parsed again. `\ref`s which
+# aren't labels of the article itself are looked up by name.
+#
+# It also remembers where each article was last published (see
+# republish.py), and its extracts and entry in the search index (see
+# extracts.py).
+
+import os
+import re
+import json
+import sqlite3
+
+
+# Jekyll doesn't publish files whose name starts with a '.'.
+INDEX_FILE_NAME = '.lyxblog_labels.sqlite'
+
+# Jekyll's built-in permalink styles.
+PERMALINK_STYLES = {
+    'date': '/:categories/:year/:month/:day/:title:output_ext',
+    'pretty': '/:categories/:year/:month/:day/:title/',
+    'ordinal': '/:categories/:year/:y_day/:title:output_ext',
+    'none': '/:categories/:title:output_ext',
+}
+
+_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS articles (
+        article TEXT PRIMARY KEY,
+        permalink TEXT NOT NULL,
+        indexed INTEGER NOT NULL DEFAULT 0);
+    CREATE TABLE IF NOT EXISTS labels (
+        name TEXT NOT NULL,
+        article TEXT NOT NULL,
+        num TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        anchor TEXT NOT NULL,
+        PRIMARY KEY (name, article));
+    CREATE TABLE IF NOT EXISTS refs (
+        article TEXT NOT NULL,
+        name TEXT NOT NULL,
+        PRIMARY KEY (article, name));
+    CREATE INDEX IF NOT EXISTS refs_by_name ON refs (name);
+    CREATE TABLE IF NOT EXISTS posts (
+        article TEXT PRIMARY KEY,
+        path TEXT NOT NULL,
+        body_key TEXT,
+        has_style INTEGER NOT NULL);
+    CREATE TABLE IF NOT EXISTS extracts (
+        article TEXT PRIMARY KEY,
+        data TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS search (
+        article TEXT PRIMARY KEY,
+        date TEXT NOT NULL,
+        entry TEXT NOT NULL);
+'''
+
+_PERMALINK_RE = re.compile(r'^\s*permalink\s*:\s*(\S+)\s*$', flags=re.M)
+_PLACEHOLDER_RE = re.compile(r':(categories|year|month|day|y_day|title|'
+                             r'output_ext)')
+
+
+def get_index_path(blog_dir):
+    return os.path.join(blog_dir, INDEX_FILE_NAME)
+
+
+def get_permalink(blog_dir, jekyll_fm, html_file_name):
+    """
+    Returns the URL of the post the way Jekyll computes it, from the
+    `permalink` of the front matter or of the site's `_config.yml`.
+    """
+    template = jekyll_fm.get('permalink')
+    if template is None:
+        try:
+            with open(os.path.join(blog_dir, '_config.yml'),
+                      encoding='utf-8') as f:
+                m = _PERMALINK_RE.search(f.read())
+            template = m[1].strip('\'"') if m else 'date'
+        except FileNotFoundError:
+            template = 'date'
+    template = PERMALINK_STYLES.get(template, template)
+
+    categories = jekyll_fm.get('categories', jekyll_fm.get('category', []))
+    if isinstance(categories, str):
+        categories = categories.split()
+    date = jekyll_fm['date']
+    values = {
+        'categories': '/'.join(str(c) for c in categories),
+        'year': '{:04}'.format(date.year),
+        'month': '{:02}'.format(date.month),
+        'day': '{:02}'.format(date.day),
+        'y_day': '{:03}'.format(date.timetuple().tm_yday),
+        'title': html_file_name,
+        'output_ext': '.html',
+    }
+    url = _PLACEHOLDER_RE.sub(lambda m: values[m[1]], template)
+    return re.sub(r'/{2,}', '/', '/' + url)
+
+
+class LabelIndex:
+    """
+    The label index at `path` (see `get_index_path`). Articles are identified
+    by the absolute paths of their LyX files.
+    """
+    def __init__(self, path):
+        self.path = path
+        # Other articles may be being published at the same time. The index
+        # may be used by different threads, but never at the same time.
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.db:
+            self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def set_article(self, article, permalink):
+        with self.db:
+            self.db.execute('INSERT INTO articles (article, permalink) '
+                            'VALUES (?, ?) ON CONFLICT (article) '
+                            'DO UPDATE SET permalink = excluded.permalink',
+                            (article, permalink))
+
+    def is_indexed(self, article):
+        """
+        Tells whether the labels of `article` are in the index.
+        """
+        row = self.db.execute('SELECT indexed FROM articles WHERE article = ?',
+                              (article,)).fetchone()
+        return bool(row and row[0])
+
+    def set_labels(self, article, labels, ref_names):
+        """
+        Replaces the labels of `article` (which must have been added with
+        `set_article`) with `labels`, a dict which maps their names to
+        (number, kind, anchor), and the names it references with
+        `ref_names`.
+        """
+        with self.db:
+            self.db.execute('DELETE FROM labels WHERE article = ?',
+                            (article,))
+            self.db.executemany(
+                'INSERT INTO labels VALUES (?, ?, ?, ?, ?)',
+                [(name, article, num, kind, anchor)
+                 for name, (num, kind, anchor) in labels.items()])
+            self.db.execute('DELETE FROM refs WHERE article = ?', (article,))
+            self.db.executemany('INSERT INTO refs VALUES (?, ?)',
+                                [(article, name) for name in set(ref_names)])
+            self.db.execute('UPDATE articles SET indexed = 1 '
+                            'WHERE article = ?', (article,))
+
+    def get_post(self, article):
+        """
+        Returns (path, body key, whether it has a style) of the post of
+        `article` at its last publication, or None.
+        """
+        return self.db.execute('SELECT path, body_key, has_style FROM posts '
+                               'WHERE article = ?', (article,)).fetchone()
+
+    def set_post(self, article, path, body_key, has_style):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?)',
+                            (article, path, body_key, int(has_style)))
+
+    def get_extract(self, article):
+        """
+        Returns the extracts of `article` (see extracts.extract_html) at its
+        last publication, or None.
+        """
+        row = self.db.execute('SELECT data FROM extracts WHERE article = ?',
+                              (article,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_extract(self, article, extract):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO extracts VALUES (?, ?)',
+                            (article, json.dumps(extract)))
+
+    def update_search_index(self, article, date, entry, write):
+        """
+        Replaces the entry of `article` in the search index with `entry` and
+        calls `write` with the list of all the entries, the newest first.
+        Returns what `write` returns.
+
+        The index stays locked until `write` returns, so that concurrent
+        publications write the search index one at a time.
+        """
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO search VALUES (?, ?, ?)',
+                            (article, date, entry))
+            entries = [entry for entry, in self.db.execute(
+                'SELECT entry FROM search ORDER BY date DESC, article')]
+            return write(entries)
+
+    def remove_article(self, article):
+        with self.db:
+            for table in ('articles', 'labels', 'refs', 'posts', 'extracts',
+                          'search'):
+                self.db.execute('DELETE FROM {} WHERE article = ?'
+                                .format(table), (article,))
+
+    def lookup(self, name, exclude_article=None):
+        """
+        Returns (permalink, number, kind, anchor) of the label `name` of an
+        article other than `exclude_article`, or None.
+        """
+        return self.db.execute(
+            'SELECT permalink, num, kind, anchor FROM labels JOIN articles '
+            'USING (article) WHERE name = ? AND article IS NOT ? '
+            'ORDER BY permalink LIMIT 1', (name, exclude_article)).fetchone()
+
+    def get_dangling_refs(self):
+        """
+        Returns the list of (article, name) of the references to labels which
+        no article defines.
+        """
+        return self.db.execute(
+            'SELECT article, name FROM refs WHERE NOT EXISTS '
+            '(SELECT 1 FROM labels WHERE labels.name = refs.name) '
+            'ORDER BY article, name').fetchall()
+
+    def prune(self):
+        """
+        Removes the articles whose LyX files no longer exist. Returns them.
+        """
+        articles = [article for article, in
+                    self.db.execute('SELECT article FROM articles UNION '
+                                    'SELECT article FROM labels UNION '
+                                    'SELECT article FROM posts UNION '
+                                    'SELECT article FROM search')
+                    if not os.path.exists(article)]
+        for article in articles:
+            self.remove_article(article)
+        return articles
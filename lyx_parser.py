@@ -0,0 +1,168 @@
+# Streaming parser for the LyX file format.
+#
+# NOTE:
+#   - In LyX files, '\' can only appear in commands, so searching for, say,
+#     '\begin_inset' is safe.
+#   - The parameters of an inset are the lines right inside it, e.g.
+#         \begin_inset Graphics
+#             filename fig.svg
+#             width 50col%
+#         \end_inset
+#     while its content is in layouts (\begin_layout ... \end_layout), so a
+#     line is a parameter only if the innermost open block is an inset.
+
+import re
+
+
+BEGIN_INSET = 'begin_inset'
+END_INSET = 'end_inset'
+PARAM = 'param'
+
+_BEGIN_INSET_STR = '\\begin_inset'
+_END_INSET_STR = '\\end_inset'
+_PARAM_RE = re.compile(r'\s*(\S+)(?:\s+(.*?))?\s*$')
+_QUOTED_RE = re.compile(r'"([^"]*)"$')
+
+# markers for the stack of open blocks
+_INSET = 0
+_OTHER = 1
+
+
+def parse_events(lines):
+    """
+    Generates the events
+        (BEGIN_INSET, inset_type)       e.g. inset_type = 'Float figure'
+        (END_INSET, inset_type)
+        (PARAM, name, value)            value = '' if there's no value
+    from the lines of a LyX file.
+    """
+    open_blocks = []
+    inset_types = []
+    for line in lines:
+        if line.startswith('\\'):
+            if line.startswith(_BEGIN_INSET_STR):
+                inset_type = line[len(_BEGIN_INSET_STR):].strip()
+                open_blocks.append(_INSET)
+                inset_types.append(inset_type)
+                yield BEGIN_INSET, inset_type
+            elif line.startswith(_END_INSET_STR):
+                # Be lenient with malformed files.
+                while open_blocks and open_blocks.pop() != _INSET:
+                    pass
+                if inset_types:
+                    yield END_INSET, inset_types.pop()
+            elif line.startswith('\\begin_'):
+                open_blocks.append(_OTHER)
+            elif line.startswith('\\end_'):
+                if open_blocks and open_blocks[-1] == _OTHER:
+                    open_blocks.pop()
+        elif open_blocks and open_blocks[-1] == _INSET:
+            m = _PARAM_RE.match(line)
+            if m:
+                yield PARAM, m[1], m[2] or ''
+
+
+def unquote(value):
+    """
+    Returns the content of a parameter value like "fig:label" (with quotes).
+    """
+    m = _QUOTED_RE.match(value)
+    return m[1] if m else value
+
+
+class InsetNode:
+    __slots__ = ('type', 'params', 'children')
+
+    def __init__(self, type):
+        self.type = type
+        self.params = {}
+        self.children = []
+
+    def __repr__(self):
+        return 'InsetNode({!r}, {!r}, {!r})'.format(self.type, self.params,
+                                                    self.children)
+
+
+def build_inset_tree(lines, types):
+    """
+    Builds, in one pass, the tree of the insets whose type starts with one of
+    `types` (a tuple). The insets we don't care about are left out, and their
+    children are attached to their closest ancestor in the tree.
+
+    Returns the root, which is an InsetNode with type None.
+    """
+    root = InsetNode(None)
+    parents = [root]
+    # for each open inset, whether it's in the tree
+    in_tree = []
+    for event in parse_events(lines):
+        if event[0] == BEGIN_INSET:
+            if event[1].startswith(types):
+                node = InsetNode(event[1])
+                parents[-1].children.append(node)
+                parents.append(node)
+                in_tree.append(True)
+            else:
+                in_tree.append(False)
+        elif event[0] == END_INSET:
+            if in_tree.pop():
+                parents.pop()
+        elif in_tree and in_tree[-1]:
+            _, name, value = event
+            parents[-1].params[name] = value
+    return root
+
+
+def build_inset_tree_from_file(lyx_path, types):
+    with open(lyx_path, encoding='utf-8') as f:
+        return build_inset_tree(f, types)
+
+
+_BEGIN_ERT_STR = '\\begin_inset ERT'
+
+
+def read_first_ert(lines):
+    """
+    Returns the text of the first ERT inset (TeX code) in the lines of a LyX
+    file, with a '\\n' between its paragraphs, or None if there's none. It
+    stops reading right after the inset.
+
+    NOTE: in the text of a paragraph, each '\\' is written as a
+          '\\backslash' line, and LyX may break long lines (at spaces), so
+          the lines of a paragraph are joined without separators.
+    """
+    in_ert = False
+    paragraphs = []
+    paragraph = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not in_ert:
+            in_ert = line.startswith(_BEGIN_ERT_STR)
+        elif line.startswith('\\begin_layout'):
+            paragraph = []
+        elif line.startswith('\\end_layout'):
+            paragraphs.append(''.join(paragraph or []))
+            paragraph = None
+        elif line.startswith(_END_INSET_STR):
+            return '\n'.join(paragraphs)
+        elif paragraph is not None:
+            if line == '\\backslash':
+                paragraph.append('\\')
+            elif line and not line.startswith('\\'):
+                paragraph.append(line)
+    return None
+
+
+def skip_first_ert(lines):
+    """
+    Generates the lines of a LyX file except those of its first ERT inset.
+    """
+    lines = iter(lines)
+    for line in lines:
+        if line.startswith(_BEGIN_ERT_STR):
+            for line in lines:
+                if line.startswith(_END_INSET_STR):
+                    break
+            break
+        yield line
+    yield from lines
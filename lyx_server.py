@@ -0,0 +1,317 @@
+# Client for the LyXServer, i.e. the pair of named pipes `<pipe>.in` and
+# `<pipe>.out` through which a running LyX accepts commands (see
+# Tools->Preferences->Paths->LyXServer pipe and "LyX Functions" in LyX's
+# Additional Features manual).
+#
+# The protocol is line-based:
+#     client -> LyX:  LYXSRV:<client>:hello
+#                     LYXCMD:<client>:<function>:<argument>
+#                     LYXSRV:<client>:bye
+#     LyX -> client:  LYXSRV:<client>:hello
+#                     INFO:<client>:<function>:<data>
+#                     ERROR:<client>:<function>:<error message>
+
+import os
+import time
+import queue
+import select
+import threading
+
+try:
+    import fcntl
+except ImportError:         # Windows
+    fcntl = None
+    import msvcrt
+
+
+class LyXServerError(Exception):
+    pass
+
+
+class LyXServerUnavailable(LyXServerError):
+    pass
+
+
+def _read(fd, closed):
+    """
+    Reads from `fd` without blocking for more than a fraction of a second so
+    that the reading threads can notice `closed()` (on POSIX, at least).
+    Returns b'' when there's nothing to read.
+    """
+    if os.name == 'posix':
+        while not select.select([fd], [], [], 0.1)[0]:
+            if closed():
+                return b''
+    data = os.read(fd, 4096)
+    if not data:                # no writer (yet)
+        time.sleep(0.05)
+    return data
+
+
+def _try_lock(fd):
+    # Raises OSError if the lock is held. The OS releases it when the file is
+    # closed, even if the process dies.
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    else:
+        msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+
+
+def _acquire_lock(lock_path, timeout):
+    """
+    Returns the file `lock_path`, opened and locked. Close it to release the
+    lock.
+    """
+    f = open(lock_path, 'ab')
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _try_lock(f.fileno())
+            return f
+        except OSError:
+            if time.monotonic() > deadline:
+                f.close()
+                raise LyXServerUnavailable("LyXServer: can't acquire " +
+                                           lock_path)
+            time.sleep(0.05)
+
+
+def _open_nonblocking(path, flags):
+    # NOTE: without O_NONBLOCK, opening a FIFO blocks until the other end is
+    # opened, i.e. forever if LyX isn't running.
+    fd = os.open(path, flags | getattr(os, 'O_NONBLOCK', 0))
+    if hasattr(os, 'set_blocking'):
+        os.set_blocking(fd, True)
+    return fd
+
+
+class LyXServerClient:
+    """
+    Context manager which connects to the LyXServer at `pipe_path` (without
+    the '.in' and '.out' extensions).
+
+    `hello_timeout` is short because LyX doesn't serve the pipe while it's
+    busy (e.g. waiting for a converter), and then we'd better fall back to
+    running LyX ourselves.
+    """
+    def __init__(self, pipe_path, timeout=60, hello_timeout=5,
+                 client_name=None):
+        self.pipe_path = pipe_path
+        self.timeout = timeout
+        self.hello_timeout = hello_timeout
+        self.client_name = client_name or 'lyxblog{}'.format(os.getpid())
+        self._in_fd = None
+        self._out_fd = None
+        self._lines = queue.Queue()
+        self._closed = False
+        self._reader_thread = None
+
+    def _reader(self):
+        buf = b''
+        while not self._closed:
+            try:
+                data = _read(self._out_fd, lambda: self._closed)
+            except OSError:
+                break
+            buf += data
+            *lines, buf = buf.split(b'\n')
+            for line in lines:
+                self._lines.put(str(line, 'utf-8', 'replace'))
+
+    def _send(self, line):
+        os.write(self._in_fd, (line + '\n').encode('utf-8'))
+
+    def _receive(self, prefixes, timeout):
+        """
+        Returns the first line starting with one of `prefixes`. The other
+        lines (e.g. replies to other clients) are ignored.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise LyXServerUnavailable('LyXServer: no reply from LyX!')
+            try:
+                line = self._lines.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            if line.startswith(prefixes):
+                return line
+
+    def __enter__(self):
+        in_path = self.pipe_path + '.in'
+        out_path = self.pipe_path + '.out'
+        if not (os.path.exists(in_path) and os.path.exists(out_path)):
+            raise LyXServerUnavailable("LyXServer: can't find the pipes " +
+                                       self.pipe_path + '.{in,out}')
+        try:
+            # We open our end of `out` first so that LyX (or FakeLyXServer)
+            # can write the reply to `hello`.
+            self._out_fd = _open_nonblocking(out_path, os.O_RDONLY)
+            self._in_fd = _open_nonblocking(in_path, os.O_WRONLY)
+        except OSError as e:        # ENXIO: nobody is reading (stale pipes)
+            self._close_fds()
+            raise LyXServerUnavailable('LyXServer: ' + str(e))
+        self._reader_thread = threading.Thread(target=self._reader,
+                                               daemon=True)
+        self._reader_thread.start()
+
+        try:
+            self._send('LYXSRV:{}:hello'.format(self.client_name))
+            self._receive(('LYXSRV:{}:hello'.format(self.client_name),),
+                          self.hello_timeout)
+        except BaseException:
+            self._close_fds()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self._send('LYXSRV:{}:bye'.format(self.client_name))
+        except OSError:
+            pass
+        self._close_fds()
+
+    def _close_fds(self):
+        self._closed = True
+        if self._reader_thread is not None and os.name == 'posix':
+            self._reader_thread.join()
+        for fd in (self._in_fd, self._out_fd):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self._in_fd = self._out_fd = None
+
+    def command(self, function, argument=''):
+        """
+        Executes the LyX function `function` and returns its data.
+        """
+        self._send('LYXCMD:{}:{}:{}'.format(self.client_name, function,
+                                            argument))
+        line = self._receive(('INFO:{}:{}:'.format(self.client_name,
+                                                   function),
+                              'ERROR:{}:{}:'.format(self.client_name,
+                                                    function)),
+                             self.timeout)
+        kind, _, _, data = line.split(':', 3)
+        if kind == 'ERROR':
+            raise LyXServerError('LyXServer: {} failed: {}'
+                                 .format(function, data))
+        return data
+
+
+def export_latex(pipe_path, lyx_path, tex_path, timeout=60):
+    """
+    Asks the LyX listening on `pipe_path` to export `lyx_path` to the LaTeX
+    file `tex_path` (both absolute paths), just like
+    `lyx --export-to latex <tex_path> <lyx_path>`.
+
+    If the file is already open in LyX, LyX exports the open document, which
+    may have unsaved changes. Otherwise, we open it and close it again when
+    we're done. Returns whether the TeX file comes from the file on disk
+    (i.e. we opened it).
+
+    Raises LyXServerUnavailable if LyX can't be reached.
+    """
+    # Only one client at a time can safely read the replies from `.out`, so
+    # we serialize the exports (e.g. of batch workers).
+    with _acquire_lock(pipe_path + '.lyxblog.lock', timeout):
+        with LyXServerClient(pipe_path, timeout) as client:
+            try:
+                client.command('buffer-switch', lyx_path)
+                opened = False
+            except LyXServerError:          # not open
+                client.command('file-open', lyx_path)
+                opened = True
+            try:
+                client.command('buffer-export', 'latex ' + tex_path)
+            finally:
+                if opened:
+                    client.command('buffer-close')
+    return opened
+
+
+class FakeLyXServer:
+    """
+    Stand-in for a running LyX, used to test the LyXServer backend without
+    LyX. It creates the pipes (POSIX only) and answers the commands from a
+    thread: `buffer-export latex <tex_path>` calls `export(lyx_path,
+    tex_path)` with the path of the current document (see `file-open`,
+    `buffer-switch` and `buffer-close`). `open_paths` are the paths of the
+    open documents. Every received line is appended to `received`.
+    """
+    def __init__(self, pipe_path, export, open_paths=()):
+        self.pipe_path = pipe_path
+        self.export = export
+        self.open_paths = list(open_paths)
+        self.received = []
+        self._stopped = False
+        self._thread = None
+
+    def __enter__(self):
+        os.mkfifo(self.pipe_path + '.in')
+        os.mkfifo(self.pipe_path + '.out')
+        self._in_fd = _open_nonblocking(self.pipe_path + '.in', os.O_RDONLY)
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stopped = True
+        self._thread.join()
+        os.close(self._in_fd)
+        os.remove(self.pipe_path + '.in')
+        os.remove(self.pipe_path + '.out')
+
+    def _reply(self, out_fd, line):
+        os.write(out_fd, (line + '\n').encode('utf-8'))
+
+    def _serve(self):
+        out_fd = None
+        current_path = None
+        buf = b''
+        while not self._stopped:
+            buf += _read(self._in_fd, lambda: self._stopped)
+            *lines, buf = buf.split(b'\n')
+            for line in lines:
+                line = str(line, 'utf-8')
+                self.received.append(line)
+                kind, client, rest = line.split(':', 2)
+                if out_fd is None:
+                    out_fd = os.open(self.pipe_path + '.out', os.O_WRONLY)
+                if kind == 'LYXSRV':
+                    if rest == 'hello':
+                        self._reply(out_fd, line)
+                    continue
+                function, argument = rest.split(':', 1)
+                try:
+                    if function == 'file-open':
+                        if argument not in self.open_paths:
+                            self.open_paths.append(argument)
+                        current_path = argument
+                    elif function == 'buffer-switch':
+                        if argument not in self.open_paths:
+                            raise Exception('Document not loaded')
+                        current_path = argument
+                    elif function == 'buffer-close':
+                        if current_path is None:
+                            raise Exception('No document open')
+                        self.open_paths.remove(current_path)
+                        current_path = (self.open_paths[-1]
+                                        if self.open_paths else None)
+                    elif function == 'buffer-export':
+                        fmt, _, tex_path = argument.partition(' ')
+                        if (fmt != 'latex' or not tex_path or
+                                current_path is None):
+                            raise Exception('Unsupported export')
+                        self.export(current_path, tex_path)
+                except Exception as e:
+                    self._reply(out_fd, 'ERROR:{}:{}:{}'.format(
+                        client, function, e))
+                else:
+                    self._reply(out_fd, 'INFO:{}:{}:'.format(client,
+                                                             function))
+        if out_fd is not None:
+            os.close(out_fd)
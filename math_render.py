@@ -0,0 +1,334 @@
+# Build-time rendering of the math, as an alternative to MathJax.
+#
+# We number the equations and resolve the references to them ourselves, the
+# way MathJax does with `equationNumbers: { autoNumber: "AMS" }`: every row of
+# a non-starred AMS environment gets the next number unless it has
+# `\nonumber`, `\notag` or its own `\tag`. The equations are then rendered
+# with the numbers as `\tag`s and without labels, so the renderer doesn't
+# need to know about numbering or references.
+
+import os
+import re
+import abc
+import shlex
+import subprocess
+import collections
+import concurrent.futures
+from cache import hash_bytes
+
+
+KATEX_HEAD_HTML = '''
+        <link rel="stylesheet"
+            href="//cdn.jsdelivr.net/npm/katex@0.16.9/dist/katex.min.css">
+        '''
+
+# Environments whose rows are numbered separately, and environments with a
+# single number.
+ROW_NUMBERED_ENVS = {'align', 'alignat', 'eqnarray', 'flalign', 'gather'}
+SINGLE_NUMBERED_ENVS = {'equation', 'multline'}
+
+# The renderers are given the TeX on stdin and this environment variable is
+# 'display' or 'inline'.
+MATH_MODE_ENV_VAR = 'LYXBLOG_MATH_MODE'
+
+MAX_RENDER_WORKERS = 8
+
+_ENV_RE = re.compile(r'\s*\\begin{(\w+)(\*?)}(.*)\\end{\1\2}\s*$',
+                     flags=re.DOTALL)
+_LABEL_RE = re.compile(r'\\label{([^}]*)}')
+_NO_NUMBER_RE = re.compile(r'\\(?:nonumber|notag)\b')
+_TAG_RE = re.compile(r'\\tag\*?{([^}]*)}')
+_ROW_TOKEN_RE = re.compile(r'\\\\|\\begin{[^}]*}|\\end{[^}]*}|\\.|[{}]')
+_MACRO_DEF_RE = re.compile(
+    r'^\\(?:(?:re)?newcommand|providecommand|def|DeclareMathOperator)\b.*$',
+    flags=re.MULTILINE)
+_MATH_OPERATOR_RE = re.compile(
+    r'\\DeclareMathOperator(\*?)\s*{(\\[A-Za-z]+)}\s*{(.*)}\s*$',
+    flags=re.DOTALL)
+
+
+class MathRenderer(abc.ABC):
+    """
+    Renders TeX math into HTML. `head_html` is put at the start of the page
+    (e.g. a stylesheet) and `version` is part of the cache keys.
+    """
+    name = None
+    head_html = ''
+
+    def version(self, cache):
+        return ''
+
+    @abc.abstractmethod
+    def render(self, latex, display):
+        """
+        Returns the HTML of the math `latex` (display math if `display`).
+        """
+
+
+class CommandRenderer(MathRenderer):
+    """
+    Runs `argv` (+ `display_args` for display math) with the TeX on stdin and
+    takes the HTML from stdout.
+    """
+    def __init__(self, name, argv, display_args=(), head_html=''):
+        self.name = name
+        self.argv = list(argv)
+        self.display_args = list(display_args)
+        self.head_html = head_html
+
+    def version(self, cache):
+        return cache.tool_version(self.argv[0])
+
+    def render(self, latex, display):
+        argv = self.argv + (self.display_args if display else [])
+        env = dict(os.environ,
+                   **{MATH_MODE_ENV_VAR: 'display' if display else 'inline'})
+        p = subprocess.run(argv, input=latex.encode('utf-8'), env=env,
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if p.returncode != 0:
+            raise Exception("Can't render the math\n{}\nwith {}:\n{}".format(
+                latex, self.name, str(p.stderr, 'utf-8', 'replace')))
+        return str(p.stdout, 'utf-8').strip()
+
+
+# name -> function which returns the renderer
+RENDERERS = {
+    'katex': lambda: CommandRenderer('katex', ['katex'], ['--display-mode'],
+                                     KATEX_HEAD_HTML),
+}
+
+
+def equation_anchor(name):
+    """
+    Returns the anchor of the equation labeled `name`, without MathJax's
+    'mjx-eqn-' prefix: like MathJax, we replace the whitespace with '_'.
+    """
+    return re.sub(r'\s', '_', name)
+
+
+def register_renderer(name, make_renderer):
+    RENDERERS[name] = make_renderer
+
+
+def get_renderer(spec):
+    """
+    Returns the renderer registered as `spec`, or a CommandRenderer which runs
+    the command line `spec`.
+    """
+    if spec in RENDERERS:
+        return RENDERERS[spec]()
+    return CommandRenderer(spec, shlex.split(spec))
+
+
+def get_macros(latex):
+    """
+    Returns the macro definitions in the TeX file `latex`, which are put
+    before every formula we render and are part of the cache keys of the
+    equations. A definition may go on for several lines, until its braces
+    are balanced. `\\DeclareMathOperator`, which is only allowed in the
+    preamble, becomes a `\\newcommand` with `\\operatorname`.
+    """
+    macros = []
+    for m in _MACRO_DEF_RE.finditer(latex):
+        end = m.end()
+        while (_brace_depth(latex[m.start():end]) > 0 and
+               end < len(latex)):
+            next_end = latex.find('\n', end + 1)
+            end = len(latex) if next_end < 0 else next_end
+        definition = latex[m.start():end]
+        if _brace_depth(definition) != 0:
+            continue                    # malformed: it would break the math
+        op = _MATH_OPERATOR_RE.match(definition)
+        if op:
+            definition = r'\newcommand{%s}{\operatorname%s{%s}}' % (
+                op[2], op[1], op[3])
+        macros.append(definition)
+    return '\n'.join(macros)
+
+
+def _brace_depth(tex):
+    # The number of `{` in `tex` which aren't closed (not counting `\{`).
+    depth = 0
+    for m in re.finditer(r'\\.|[{}]', tex):
+        if m[0] == '{':
+            depth += 1
+        elif m[0] == '}':
+            depth -= 1
+    return depth
+
+
+def split_rows(body):
+    """
+    Splits the body of an environment at the `\\\\` which aren't inside braces
+    or nested environments. Returns the rows and the separators.
+    """
+    rows = []
+    separators = []
+    depth = 0
+    start = 0
+    for m in _ROW_TOKEN_RE.finditer(body):
+        token = m[0]
+        if token == '{' or token.startswith('\\begin{'):
+            depth += 1
+        elif token == '}' or token.startswith('\\end{'):
+            depth -= 1
+        elif token == '\\\\' and depth == 0:
+            rows.append(body[start:m.start()])
+            separators.append(token)
+            start = m.end()
+    rows.append(body[start:])
+    return rows, separators
+
+
+def number_equation(latex, next_num):
+    """
+    Numbers the display math `latex` (already converted to an AMS environment
+    by filter.py if needed) starting from `next_num`.
+
+    Returns `(render_latex, labels, next_num)`, where `render_latex` has the
+    numbers as `\\tag`s, no labels and a starred environment, and `labels`
+    maps the names of the labels to their numbers.
+    """
+    labels = {}
+    m = _ENV_RE.match(latex)
+    if m is None:
+        # Not numbered, but the labels still work (like in MathJax).
+        for name in _LABEL_RE.findall(latex):
+            labels[name] = ''
+        return _LABEL_RE.sub('', latex), labels, next_num
+
+    env, star, body = m[1], m[2], m[3]
+    if star or (env not in ROW_NUMBERED_ENVS and
+                env not in SINGLE_NUMBERED_ENVS):
+        for name in _LABEL_RE.findall(body):
+            labels[name] = ''
+        return _LABEL_RE.sub('', latex), labels, next_num
+
+    if env in ROW_NUMBERED_ENVS:
+        rows, separators = split_rows(body)
+        # A trailing `\\` doesn't start a new row.
+        if len(rows) > 1 and not rows[-1].strip():
+            last_row = rows.pop()
+            separators.pop()
+        else:
+            last_row = None
+    else:
+        rows, separators, last_row = [body], [], None
+
+    new_rows = []
+    for row in rows:
+        names = _LABEL_RE.findall(row)
+        row = _LABEL_RE.sub('', row)
+        if _NO_NUMBER_RE.search(row):
+            row = _NO_NUMBER_RE.sub('', row)
+            num = ''
+        elif _TAG_RE.search(row):
+            num = _TAG_RE.search(row)[1]
+        else:
+            num = str(next_num)
+            next_num += 1
+            row += r'\tag{%s}' % num
+        for name in names:
+            labels[name] = num
+        new_rows.append(row)
+
+    out = [new_rows[0]]
+    for separator, row in zip(separators, new_rows[1:]):
+        out += [separator, row]
+    if last_row is not None:
+        out += ['\\\\', last_row]
+    render_latex = r'\begin{%s*}%s\end{%s*}' % (env, ''.join(out), env)
+    return render_latex, labels, next_num
+
+
+class MathPrerenderer:
+    """
+    Renders all the math of a document at once (see `add`, `render_all`) and
+    then hands out the HTML in document order (see `get_html`).
+
+    The rendered HTML is cached per equation in `cache` (a BuildCache), if
+    given, by a hash of the TeX, the macro context and the renderer, so only
+    new or changed equations are rendered.
+    """
+    def __init__(self, renderer, cache=None, macros=''):
+        self.renderer = renderer
+        self.cache = cache
+        self.macros = macros
+        self.next_num = 1
+        # (display, latex) -> deque of (render_latex, anchor names)
+        self._pending = collections.defaultdict(collections.deque)
+        self._to_render = []
+        self._rendered = {}
+        self.label_to_num = {}
+        self.done = False
+        self._renderer_version = None
+
+    def add(self, latex, display):
+        """
+        Adds the math `latex`. Display math must be added in document order.
+        """
+        if display:
+            render_latex, labels, self.next_num = number_equation(
+                latex, self.next_num)
+            self.label_to_num.update(labels)
+            names = list(labels)
+        else:
+            render_latex, names = latex, []
+        self._pending[display, latex].append((render_latex, names))
+        self._to_render.append((render_latex, display))
+
+    def _with_macros(self, render_latex):
+        # The renderer sees each formula on its own, so it needs the macros
+        # of the document every time.
+        if not self.macros:
+            return render_latex
+        return self.macros + '\n' + render_latex
+
+    def _key(self, render_latex, display):
+        if self._renderer_version is None:
+            self._renderer_version = self.renderer.version(self.cache)
+        return hash_bytes('math', self.renderer.name,
+                          self._renderer_version, str(display),
+                          self.macros, render_latex)
+
+    def render_all(self):
+        """
+        Renders the math which isn't in the cache, in parallel.
+        """
+        missing = []
+        for item in set(self._to_render):
+            data = (self.cache.get(self._key(*item)) if self.cache is not None
+                    else None)
+            if data is None:
+                missing.append(item)
+            else:
+                self._rendered[item] = str(data, 'utf-8')
+
+        if missing:
+            with concurrent.futures.ThreadPoolExecutor(
+                    min(MAX_RENDER_WORKERS, len(missing))) as executor:
+                htmls = executor.map(
+                    lambda item: self.renderer.render(
+                        self._with_macros(item[0]), item[1]),
+                    missing)
+                for item, html in zip(missing, htmls):
+                    self._rendered[item] = html
+                    if self.cache is not None:
+                        self.cache.put(self._key(*item),
+                                       html.encode('utf-8'))
+        self.done = True
+
+    def get_html(self, latex, display):
+        """
+        Returns the HTML of the math `latex`, which must have been added.
+        """
+        if not self.done:
+            self.render_all()
+        render_latex, names = self._pending[display, latex].popleft()
+        html = self._rendered[render_latex, display]
+        if display:
+            anchors = ''.join('<span id="{}"></span>'.format(
+                equation_anchor(name)) for name in names)
+            return '<span class="math display">{}{}</span>'.format(anchors,
+                                                                   html)
+        return '<span class="math inline">{}</span>'.format(html)
@@ -0,0 +1,51 @@
+import os
+import filecmp
+
+
+def get_tmp_path(path):
+    # The name starts with a '.' so that Jekyll ignores it.
+    dir_path, name = os.path.split(path)
+    return os.path.join(dir_path, '.{}.{}.tmp'.format(name, os.getpid()))
+
+
+def remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def replace_if_changed(tmp_path, path):
+    """
+    Renames `tmp_path` to `path` unless `path` already has the same content,
+    in which case `tmp_path` is removed and `path` (and its mtime) is left
+    untouched. Returns whether `path` changed.
+    """
+    if os.path.isfile(path) and filecmp.cmp(tmp_path, path, shallow=False):
+        os.remove(tmp_path)
+        return False
+    os.replace(tmp_path, path)
+    return True
+
+
+def write_if_changed(path, data):
+    """
+    Atomically writes `data` (bytes) to `path` unless `path` already has that
+    content. Returns whether `path` changed.
+    """
+    try:
+        if os.path.getsize(path) == len(data):
+            with open(path, 'rb') as f:
+                if f.read() == data:
+                    return False
+    except OSError:
+        pass
+    tmp_path = get_tmp_path(path)
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        remove_if_exists(tmp_path)
+        raise
+    return True
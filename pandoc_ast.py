@@ -0,0 +1,122 @@
+# A lightweight replacement for the parts of pandocfilters our filters use.
+#
+# The filters run in a fresh interpreter at every pandoc pass, so their
+# startup matters: this module only needs `json` and `sys`. Moreover, `walk`
+# changes the AST in place instead of copying it, and only calls an action on
+# the elements of the types it handles (see `handles`), rather than on every
+# element of the document.
+
+import sys
+import json
+
+
+def elt(elt_type, num_args):
+    # Same as pandocfilters.elt.
+    def make(*args):
+        if len(args) != num_args:
+            raise ValueError('{} expects {} arguments, but given {}'
+                             .format(elt_type, num_args, len(args)))
+        if num_args == 0:
+            content = []
+        elif num_args == 1:
+            content = args[0]
+        else:
+            content = list(args)
+        return {'t': elt_type, 'c': content}
+    return make
+
+
+Para = elt('Para', 1)
+Plain = elt('Plain', 1)
+Figure = elt('Figure', 3)
+RawBlock = elt('RawBlock', 2)
+Header = elt('Header', 3)
+Str = elt('Str', 1)
+Emph = elt('Emph', 1)
+Space = elt('Space', 0)
+Math = elt('Math', 2)
+RawInline = elt('RawInline', 2)
+Image = elt('Image', 3)
+Span = elt('Span', 2)
+
+
+def handles(*elt_types):
+    """
+    Decorator which tells `walk` that the action only does something on the
+    elements of the types `elt_types`, so that it isn't called on the others.
+    """
+    def decorate(action):
+        action.elt_types = frozenset(elt_types)
+        return action
+    return decorate
+
+
+def walk(x, action, format, meta):
+    """
+    Like pandocfilters.walk, but `x` is changed in place (and returned). If
+    `action` was decorated with `handles`, it's only called on the elements of
+    the types it handles.
+    """
+    elt_types = getattr(action, 'elt_types', None)
+
+    def visit(x):
+        if isinstance(x, list):
+            i = 0
+            while i < len(x):
+                item = x[i]
+                if (isinstance(item, dict) and 't' in item and
+                        (elt_types is None or item['t'] in elt_types)):
+                    res = action(item['t'], item.get('c'), format, meta)
+                    if isinstance(res, list):
+                        x[i:i + 1] = res
+                        for z in res:
+                            visit(z)
+                        i += len(res)
+                        continue
+                    if res is not None:
+                        x[i] = item = res
+                if isinstance(item, (list, dict)):
+                    visit(item)
+                i += 1
+        else:
+            for value in x.values():
+                if isinstance(value, (list, dict)):
+                    visit(value)
+
+    if isinstance(x, (list, dict)):
+        visit(x)
+    return x
+
+
+def stringify(x):
+    """
+    Same as pandocfilters.stringify.
+    """
+    result = []
+
+    @handles('Str', 'MetaString', 'Code', 'Math', 'LineBreak', 'SoftBreak',
+             'Space')
+    def go(key, value, format, meta):
+        if key in ('Str', 'MetaString'):
+            result.append(value)
+        elif key in ('Code', 'Math'):
+            result.append(value[1])
+        else:
+            result.append(' ')
+    walk(x, go, '', {})
+    return ''.join(result)
+
+
+def run_filters(actions):
+    """
+    Runs the actions on the document pandoc sends to a JSON filter on stdin,
+    in order, and writes the result to stdout (like
+    pandocfilters.toJSONFilters).
+    """
+    doc = json.loads(sys.stdin.buffer.read())
+    format = sys.argv[1] if len(sys.argv) > 1 else ''
+    # NOTE: pandoc 1.18 or later, so `doc` is a dict.
+    for action in actions:
+        walk(doc, action, format, doc['meta'])
+    sys.stdout.buffer.write(
+        json.dumps(doc, separators=(',', ':')).encode('ascii'))
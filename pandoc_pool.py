@@ -0,0 +1,185 @@
+import os
+import re
+import json
+import time
+import base64
+import socket
+import itertools
+import threading
+import subprocess
+import urllib.request
+import urllib.error
+
+
+_VERSION_RE = re.compile(r'\d+(?:\.\d+)+')
+
+
+def parse_version(text):
+    """
+    Returns the first version number (e.g. '2.9.2.1') in `text` (e.g. the
+    output of `pandoc --version`), or ''.
+    """
+    m = _VERSION_RE.search(text)
+    return m[0] if m else ''
+
+
+class PandocServersUnavailable(Exception):
+    pass
+
+
+class PandocServerPool:
+    """
+    Client for a pool of long-lived pandoc servers (see `pandoc server` in
+    pandoc 3), so that we don't pay for pandoc's startup on every conversion.
+
+    The jobs are spread over the servers in round-robin order. `convert`
+    returns None when no server can be reached so that the caller can fall
+    back to running pandoc as a process.
+
+    If `local_version` (the version of the local pandoc, see `parse_version`)
+    is given, only the servers of the same version are used, since the
+    output of the servers must be the same as that of the local pandoc
+    (e.g. pandoc 3 has Figure blocks, and citeproc is built in from 2.11).
+    """
+    def __init__(self, urls, timeout=600, local_version=None):
+        self.all_urls = list(urls)
+        self.timeout = timeout
+        self.local_version = local_version
+        self._urls = None       # the compatible servers (see `urls`)
+        self._lock = threading.Lock()
+        # Different processes (e.g. batch workers) start from different
+        # servers.
+        self._counter = itertools.count(os.getpid())
+
+    @property
+    def urls(self):
+        """
+        The URLs of the servers we use. They're checked on first use.
+        """
+        with self._lock:
+            if self._urls is None:
+                if self.local_version is None:
+                    self._urls = self.all_urls
+                else:
+                    self._urls = [url for url in self.all_urls
+                                  if self._get_version(url) ==
+                                  self.local_version]
+            return self._urls
+
+    def _request(self, url, data=None):
+        headers = {'Accept': 'application/json'}
+        if data is not None:
+            headers['Content-Type'] = 'application/json'
+        request = urllib.request.Request(url, data=data, headers=headers)
+        with urllib.request.urlopen(request, timeout=self.timeout) as r:
+            return r.read()
+
+    def _get_version(self, url):
+        # The server answers with a JSON string, since we accept JSON.
+        try:
+            return parse_version(str(self._request(url + '/version'),
+                                     'utf-8'))
+        except (urllib.error.URLError, OSError):
+            return None
+
+    def version(self):
+        for url in self.urls:
+            version = self._get_version(url)
+            if version is not None:
+                return version
+        return None
+
+    def convert(self, params, files=None):
+        """
+        Sends a conversion job to one of the servers and returns the output
+        (a str). `params` are the options accepted by pandoc's server
+        (e.g. {'text': ..., 'from': 'latex', 'to': 'json'}) and `files` maps
+        the names of the files needed by the conversion (e.g. bibliographies)
+        to their content (bytes).
+        """
+        if files:
+            params = dict(params,
+                          files={name: str(base64.b64encode(content), 'ascii')
+                                 for name, content in files.items()})
+        data = json.dumps(params).encode('utf-8')
+
+        urls = self.urls
+        start = next(self._counter)
+        for i in range(len(urls)):
+            url = urls[(start + i) % len(urls)]
+            try:
+                response = self._request(url, data)
+            except urllib.error.HTTPError as e:
+                raise Exception("Something's wrong with the pandoc server "
+                                "at {}:\n{}\n".format(
+                                    url, str(e.read(), 'utf-8', 'replace')))
+            except (urllib.error.URLError, OSError):
+                continue            # try the next one
+
+            result = json.loads(str(response, 'utf-8'))
+            if 'error' in result:
+                raise Exception("Something's wrong with the pandoc server "
+                                "at {}:\n{}\n".format(url, result['error']))
+            output = result['output']
+            if result.get('base64'):
+                output = str(base64.b64decode(output), 'utf-8')
+            return output
+        return None
+
+
+def _get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+class LocalPandocServers:
+    """
+    Context manager which starts `num_servers` pandoc servers on free ports of
+    the local host and stops them on exit. `urls` holds their URLs.
+
+    Raises PandocServersUnavailable if they can't be started (e.g. pandoc is
+    older than 3).
+    """
+    def __init__(self, num_servers, startup_timeout=10):
+        self.num_servers = num_servers
+        self.startup_timeout = startup_timeout
+        self.processes = []
+        self.urls = []
+
+    def __enter__(self):
+        for _ in range(self.num_servers):
+            port = _get_free_port()
+            try:
+                self.processes.append(subprocess.Popen(
+                    ['pandoc', 'server', '--port', str(port)],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+            except OSError as e:
+                self.__exit__(None, None, None)
+                raise PandocServersUnavailable(
+                    "Can't start the pandoc servers: {}".format(e))
+            self.urls.append('http://localhost:{}'.format(port))
+
+        # Wait until they're up. If one of our servers exits (e.g. because
+        # someone else took its port in the meantime), whatever answers on its
+        # port isn't ours.
+        deadline = time.monotonic() + self.startup_timeout
+        for p, url in zip(self.processes, self.urls):
+            while PandocServerPool([url]).version() is None:
+                if p.poll() is not None or time.monotonic() > deadline:
+                    self.__exit__(None, None, None)
+                    raise PandocServersUnavailable(
+                        "Can't start the pandoc servers!")
+                time.sleep(0.1)
+            if p.poll() is not None:
+                self.__exit__(None, None, None)
+                raise PandocServersUnavailable(
+                    "Can't start the pandoc servers!")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for p in self.processes:
+            p.terminate()
+        for p in self.processes:
+            p.wait()
+        self.processes = []
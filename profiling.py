@@ -0,0 +1,253 @@
+import os
+import sys
+import time
+import json
+import threading
+import contextlib
+
+try:
+    import resource             # not available on Windows
+except ImportError:
+    resource = None
+
+
+# The filters run by pandoc append their timings to the file named by this
+# environment variable (see `record_filter_run`).
+FILTER_PROFILE_ENV_VAR = 'LYXBLOG_PROFILE_FILTERS'
+
+
+def _children_cpu_time():
+    t = os.times()
+    return t.children_user + t.children_system
+
+
+def _max_rss(who):
+    """
+    Returns the peak resident set size in bytes of this process
+    (who = RUSAGE_SELF) or of its biggest terminated child process
+    (who = RUSAGE_CHILDREN), or None if unknown.
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def _get_counters():
+    # The process-wide counters: CPU time of this process and of its
+    # terminated children, and the peak RSS of both.
+    return {'cpu': time.process_time(),
+            'children_cpu': _children_cpu_time(),
+            'peak_rss': _max_rss(resource and resource.RUSAGE_SELF),
+            'children_rss': _max_rss(resource and resource.RUSAGE_CHILDREN)}
+
+
+def _get_deltas(start, end):
+    # The peak RSS is only reported if it grew (it's a maximum over the life
+    # of the process, or over all its children so far).
+    return {'cpu': end['cpu'] - start['cpu'],
+            'children_cpu': end['children_cpu'] - start['children_cpu'],
+            'peak_rss': (end['peak_rss']
+                         if end['peak_rss'] != start['peak_rss'] else None),
+            'children_rss': (end['children_rss']
+                             if end['children_rss'] != start['children_rss']
+                             else None)}
+
+
+class Profiler:
+    """
+    Records wall time, CPU time and peak memory of the stages of the
+    conversion. When `enabled` is False, `stage` does nothing.
+
+    Stages may overlap (see StageGraph). For each stage we record:
+        start:          when it started, relative to the creation of the
+                        profiler
+        wall:           wall-clock time
+        cpu:            CPU time of this process
+        children_cpu:   CPU time of the subprocesses (LyX, pandoc, filters)
+                        which terminated during the stage
+        peak_rss:       peak RSS of this process, if it grew during the stage
+        children_rss:   peak RSS of the subprocesses, if it grew during the
+                        stage (it's the maximum over all the children so far)
+    The last four are process-wide counters, so they're None for the stages
+    which overlapped other stages (`overlapped` is True): whatever they
+    measure could belong to any of them. `totals` holds the same counters for
+    the whole run.
+
+    If `cprofile_stage` is the name of a stage, that stage is also run under
+    cProfile.
+    """
+    def __init__(self, enabled=False, cprofile_stage=None):
+        self.enabled = enabled
+        self.cprofile_stage = cprofile_stage
+        self.cprofile_stats = None
+        self.stages = []
+        self.filter_runs = []
+        self._start_wall = time.perf_counter()
+        self._start_counters = _get_counters() if enabled else None
+        self._totals = None
+        self._lock = threading.Lock()
+        self._active = []           # the stages running now
+        self._filter_profile_path = None
+
+    @property
+    def totals(self):
+        """
+        The counters (see above) of the whole run, up to the first time
+        they're read.
+        """
+        if self._totals is None and self._start_counters is not None:
+            self._totals = _get_deltas(self._start_counters, _get_counters())
+        return self._totals
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        entry = {'name': name, 'overlapped': False}
+        with self._lock:
+            if self._active:
+                entry['overlapped'] = True
+                for other in self._active:
+                    other['overlapped'] = True
+            self._active.append(entry)
+        start_counters = _get_counters()
+        start_wall = time.perf_counter()
+
+        profile = None
+        if name == self.cprofile_stage:
+            import cProfile
+            profile = cProfile.Profile()
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                import pstats
+                self.cprofile_stats = pstats.Stats(profile)
+
+            wall = time.perf_counter() - start_wall
+            deltas = _get_deltas(start_counters, _get_counters())
+            with self._lock:
+                self._active.remove(entry)
+                entry.update(start=start_wall - self._start_wall, wall=wall)
+                entry.update((key, None if entry['overlapped'] else value)
+                             for key, value in deltas.items())
+                self.stages.append(entry)
+
+    def filter_env(self):
+        """
+        Returns the environment for the pandoc processes so that the filters
+        record their timings, or None if we're not profiling.
+        """
+        if not self.enabled:
+            return None
+        if self._filter_profile_path is None:
+            # Other conversions may be profiled at the same time.
+            import tempfile
+            fd, self._filter_profile_path = tempfile.mkstemp(
+                prefix='lyxblog_filter_profile_', suffix='.jsonl')
+            os.close(fd)
+        return dict(os.environ,
+                    **{FILTER_PROFILE_ENV_VAR: self._filter_profile_path})
+
+    def collect_filter_runs(self):
+        """
+        Collects the timings written by the filters run so far.
+        """
+        path = self._filter_profile_path
+        if path is None or not os.path.exists(path):
+            return
+        with open(path, encoding='utf-8') as f:
+            self.filter_runs += [json.loads(line) for line in f]
+        os.remove(path)
+
+    def add_filter_run(self, run):
+        """
+        Records a run of a filter in this process (e.g. an action of filter.py
+        in the single-pass mode): a dict with its 'name', 'wall' and 'cpu'.
+        """
+        if self.enabled:
+            self.filter_runs.append(run)
+
+    def print_report(self, file=sys.stdout):
+        def fmt_mem(num_bytes):
+            if num_bytes is None:
+                return '-'
+            return '{:.1f} MB'.format(num_bytes / 2**20)
+
+        def fmt_time(t):
+            return '-' if t is None else '{:.3f}'.format(t)
+
+        rows = [('stage', 'start (s)', 'wall (s)', 'cpu (s)', 'child cpu (s)',
+                 'peak rss', 'child rss')]
+        for s in self.stages:
+            rows.append((s['name'] + (' *' if s['overlapped'] else ''),
+                         '{:.3f}'.format(s['start']),
+                         '{:.3f}'.format(s['wall']),
+                         fmt_time(s['cpu']), fmt_time(s['children_cpu']),
+                         fmt_mem(s['peak_rss']), fmt_mem(s['children_rss'])))
+        for r in self.filter_runs:
+            rows.append(('  filter ' + r['name'], '-',
+                         '{:.3f}'.format(r['wall']),
+                         '{:.3f}'.format(r['cpu']), '-', '-',
+                         fmt_mem(r.get('max_rss'))))
+        # The stages may overlap, so the total wall time isn't their sum.
+        total_wall = 0
+        if self.stages:
+            total_wall = (max(s['start'] + s['wall'] for s in self.stages) -
+                          min(s['start'] for s in self.stages))
+        totals = self.totals
+        rows.append(('total', '',
+                     '{:.3f}'.format(total_wall),
+                     fmt_time(totals['cpu']), fmt_time(totals['children_cpu']),
+                     fmt_mem(totals['peak_rss']),
+                     fmt_mem(totals['children_rss'])))
+
+        widths = [max(len(row[i]) for row in rows) for i in range(7)]
+        for row in rows:
+            print(row[0].ljust(widths[0]) + '  ' +
+                  '  '.join(cell.rjust(width)
+                            for cell, width in zip(row[1:], widths[1:])),
+                  file=file)
+        if any(s['overlapped'] for s in self.stages):
+            print('* overlapped other stages: its CPU time and memory are '
+                  'only counted in the total', file=file)
+
+        if self.cprofile_stats is not None:
+            print('\ncProfile of stage "{}":'.format(self.cprofile_stage),
+                  file=file)
+            self.cprofile_stats.stream = file
+            self.cprofile_stats.sort_stats('cumulative').print_stats(30)
+
+    def to_dict(self):
+        return {'stages': self.stages, 'filters': self.filter_runs,
+                'totals': self.totals}
+
+    def append_json(self, json_path, **extra):
+        """
+        Appends the timings to the JSON Lines file `json_path` (one object per
+        run, so that, e.g., batch workers can share the file).
+        """
+        line = json.dumps(dict(extra, **self.to_dict())) + '\n'
+        with open(json_path, 'a', encoding='utf-8') as f:
+            f.write(line)
+
+
+def record_filter_run(name, start_wall):
+    """
+    Called by a filter run by pandoc at the end of its run. `cpu` includes the
+    startup of the interpreter and the imports, but `wall` starts at
+    `start_wall` (a time.perf_counter()).
+    """
+    run = {'name': name,
+           'wall': time.perf_counter() - start_wall,
+           'cpu': time.process_time(),
+           'max_rss': _max_rss(resource and resource.RUSAGE_SELF)}
+    with open(os.environ[FILTER_PROFILE_ENV_VAR], 'a',
+              encoding='utf-8') as f:
+        f.write(json.dumps(run) + '\n')
@@ -0,0 +1,98 @@
+# Fast republishing of articles whose front matter is the only thing which
+# changed (e.g. the title, the summary or the style): the post in _posts is
+# patched in place, without running LyX and pandoc.
+#
+# To know that nothing else changed, we record in the label index, for each
+# article, a hash of everything the body of its post depends on (see
+# `get_body_key`).
+
+import os
+import re
+import shutil
+from cache import hash_bytes
+from lyx_parser import build_inset_tree, skip_first_ert, unquote
+from output import get_tmp_path, replace_if_changed, remove_if_exists
+
+
+_JEKYLL_FM_RE = re.compile(r'---\n.*?^---\n', flags=re.S | re.M)
+
+
+def _iter_insets(node):
+    for child in node.children:
+        yield child
+        yield from _iter_insets(child)
+
+
+def _stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return 'missing'
+    return '{} {}'.format(st.st_size, st.st_mtime_ns)
+
+
+def get_body_key(lyx_path, extra_parts, label_index=None, article=None):
+    """
+    Returns a hash of everything the body of the post of the LyX file depends
+    on: the LyX file without the front matter (its first ERT inset), the
+    images and bibliography files it references (by size and mtime), the
+    labels of the other articles (in `label_index`, or none if it's None) it
+    may reference and `extra_parts` (a list of str, e.g. options and
+    versions). LyX and pandoc are identified by their executables.
+    """
+    with open(lyx_path, encoding='utf-8') as f:
+        lines = list(skip_first_ert(f))
+    parts = ['body', ''.join(lines)] + list(extra_parts)
+    for tool in ('lyx', 'pandoc'):
+        parts.append(_stamp(shutil.which(tool) or ''))
+
+    lyx_dir = os.path.dirname(lyx_path)
+    tree = build_inset_tree(lines, ('Graphics', 'CommandInset bibtex',
+                                    'CommandInset ref'))
+    for node in _iter_insets(tree):
+        if node.type == 'Graphics' and 'filename' in node.params:
+            parts.append(_stamp(os.path.join(lyx_dir,
+                                             node.params['filename'])))
+        elif node.type == 'CommandInset bibtex':
+            for name in unquote(node.params.get('bibfiles', '')).split(','):
+                if name:
+                    if not os.path.splitext(name)[1]:
+                        name += '.bib'
+                    parts.append(_stamp(os.path.join(lyx_dir, name)))
+        elif node.type == 'CommandInset ref':
+            name = unquote(node.params.get('reference', ''))
+            parts.append(repr(label_index.lookup(name, article)
+                              if label_index is not None else None))
+    return hash_bytes(*parts)
+
+
+def patch_post(post_path, head, math_conf, had_style):
+    """
+    Replaces the head of the post at `post_path` (as written by
+    `post_process_html`: Jekyll's front matter, `math_conf` and, if
+    `had_style`, a `<style>` block) with `head`.
+
+    Returns whether the post changed, or None if it doesn't look as expected,
+    in which case it's left untouched.
+    """
+    with open(post_path, encoding='utf-8') as f:
+        data = f.read()
+    m = _JEKYLL_FM_RE.match(data)
+    if m is None or not data.startswith(math_conf, m.end()):
+        return None
+    pos = m.end() + len(math_conf)
+    if had_style:
+        end = data.find('</style>', pos)
+        if not data.startswith('<style>', pos) or end == -1:
+            return None
+        pos = end + len('</style>')
+
+    tmp_path = get_tmp_path(post_path)
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(head)
+            f.write(data[pos:])
+    except BaseException:
+        remove_if_exists(tmp_path)
+        raise
+    return replace_if_changed(tmp_path, post_path)
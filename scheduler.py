@@ -0,0 +1,93 @@
+# Runs the stages of the publication of an article concurrently, as allowed by
+# their dependencies: the stages which wait for subprocesses (LyX, pandoc) are
+# coroutines run on an asyncio event loop, and the others (file I/O, parsing)
+# run on a thread pool.
+
+import asyncio
+import inspect
+import subprocess
+import concurrent.futures
+
+
+class StageGraph:
+    """
+    A graph of stages. Each stage runs as soon as the stages it depends on are
+    done, and gets their results as arguments. Coroutine functions run on the
+    event loop, the other functions on a thread pool of `max_workers` threads.
+
+    If a stage fails, no more stages are started, the running coroutines are
+    cancelled (which kills their subprocesses, see `run_subprocess`), the
+    running threads are waited for and the exception is raised again. The
+    stages write their intermediate files to the workspace of the conversion
+    (see workspace.py), which is removed anyway.
+    """
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self.stages = {}        # name -> (func, deps)
+
+    def add(self, name, func, deps=()):
+        # The dependencies must be added first, so there can't be cycles.
+        for dep in deps:
+            if dep not in self.stages:
+                raise Exception('Unknown stage: ' + dep)
+        self.stages[name] = (func, tuple(deps))
+
+    def run(self):
+        """
+        Runs all the stages and returns a dict with their results.
+        """
+        return asyncio.run(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        executor = concurrent.futures.ThreadPoolExecutor(self.max_workers)
+        tasks = {}
+
+        async def run_stage(func, deps):
+            args = [await tasks[dep] for dep in deps]
+            if inspect.iscoroutinefunction(func):
+                return await func(*args)
+            return await loop.run_in_executor(executor, func, *args)
+
+        try:
+            for name, (func, deps) in self.stages.items():
+                tasks[name] = asyncio.ensure_future(run_stage(func, deps))
+            done, pending = await asyncio.wait(
+                tasks.values(), return_when=asyncio.FIRST_EXCEPTION)
+            error = next((task.exception() for task in tasks.values()
+                          if task in done and task.exception() is not None),
+                         None)
+            if error is None:
+                return {name: task.result() for name, task in tasks.items()}
+
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            # The stages which depend on the failed one fail with the same
+            # exception, which we've handled.
+            for task in tasks.values():
+                if not task.cancelled():
+                    task.exception()
+        finally:
+            # The threads can't be interrupted, so we wait for them.
+            await loop.run_in_executor(None, executor.shutdown)
+        raise error
+
+
+async def run_subprocess(argv, input=None, env=None,
+                         stderr=subprocess.PIPE, cwd=None):
+    """
+    Like `subprocess.run(argv, input=input, env=env, stdout=PIPE,
+    stderr=stderr, cwd=cwd)`, but it doesn't block the event loop and kills
+    the process if cancelled. Returns (returncode, stdout, stderr).
+    """
+    p = await asyncio.create_subprocess_exec(
+        *argv, stdin=subprocess.PIPE if input is not None else None,
+        stdout=subprocess.PIPE, stderr=stderr, env=env, cwd=cwd)
+    try:
+        stdout, stderr_data = await p.communicate(input)
+    except asyncio.CancelledError:
+        p.kill()
+        await p.wait()
+        raise
+    return p.returncode, stdout, stderr_data
@@ -0,0 +1,78 @@
+# Tests of the parallel parsing of long articles (see chunking.py): the post
+# published with `--chunks` must be the same as with `--single_pass`.
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import contextlib
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.join(REPO_DIR, 'benchmarks')
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import LyXBlog
+import corpus
+from chunking import split_tex
+
+
+def _publish(lyx_path, blog_dir, options):
+    os.makedirs(os.path.join(blog_dir, '_posts'))
+    path = os.environ['PATH']
+    os.environ['PATH'] = (os.path.join(BENCH_DIR, 'fake_bin') + os.pathsep +
+                          path)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            LyXBlog.main(os.path.join(REPO_DIR, 'LyXBlog.py'),
+                         options + [lyx_path, blog_dir, 'assets'])
+    finally:
+        os.environ['PATH'] = path
+    posts_dir = os.path.join(blog_dir, '_posts')
+    posts = {}
+    for name in os.listdir(posts_dir):
+        with open(os.path.join(posts_dir, name), 'rb') as f:
+            posts[name] = f.read()
+    return posts
+
+
+class SplitTexTest(unittest.TestCase):
+    def test_definition_in_group(self):
+        text = 'Text. ' * 50 + '\n'
+        latex = ('\\begin{document}\n'
+                 '\\section{A}\n' + text * 3 +
+                 '\\section{B}\n{\\newcommand{\\x}{1}}\n' + text +
+                 '\\section{C}\n' + text +
+                 '\\section{D}\n\\x\n' + text +
+                 '\\end{document}\n')
+        chunks = split_tex(latex, 4)
+        # No split after the definition in the group.
+        self.assertEqual(len(chunks), 2)
+        self.assertIn('\\section{D}', chunks[-1])
+        self.assertIn('\\section{B}', chunks[-1])
+
+
+@unittest.skipUnless(os.name == 'posix', 'the fake LyX and pandoc need POSIX')
+class ChunksOutputTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='lyxblog_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_same_as_single_pass(self):
+        spec = corpus.CorpusSpec().scaled(2)
+        self.assertGreater(len(split_tex(corpus.make_tex(spec), 4)), 1)
+        lyx_path = corpus.write_article(os.path.join(self.dir, 'src'), spec)
+        single_pass = _publish(lyx_path, os.path.join(self.dir, 'blog1'),
+                               ['--single_pass'])
+        chunks = _publish(lyx_path, os.path.join(self.dir, 'blog2'),
+                          ['--chunks', '4'])
+        self.assertTrue(single_pass)
+        self.assertEqual(chunks, single_pass)
+
+
+if __name__ == '__main__':
+    unittest.main()
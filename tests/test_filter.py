@@ -0,0 +1,74 @@
+# Tests of filter.py, and of what LyXBlog.py reads from the first pandoc pass,
+# with the output of pandoc 3.
+
+import os
+import sys
+import tempfile
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import LyXBlog
+import filter as lyxblog_filter
+from filter_num import UID
+from pandoc_ast import walk, stringify
+
+
+def _lyx_figure(idx, label):
+    # What pandoc 3 makes of a LyX figure:
+    #   \begin{figure}\begin{centering}\includegraphics[...]{fig_<idx>}
+    #   \par\end{centering}\caption{Caption <idx>.\label{<label>}}\end{figure}
+    image = {'t': 'Image',
+             'c': [['', [], [['width', '50%']]], [],
+                   ['fig_%d' % idx, '']]}
+    centering = {'t': 'Div',
+                 'c': [['', ['centering'], []],
+                       [{'t': 'Plain', 'c': [image]}]]}
+    caption = [{'t': 'Plain',
+                'c': [{'t': 'Str', 'c': 'Caption'}, {'t': 'Space'},
+                      {'t': 'Str', 'c': '%d.' % idx}]}]
+    return {'t': 'Figure',
+            'c': [[label, [], []], [None, caption], [centering]]}
+
+
+class FigureTest(unittest.TestCase):
+    def test_lyx_figures(self):
+        doc = {'pandoc-api-version': [1, 23, 1], 'meta': {},
+               'blocks': [_lyx_figure(0, 'fig:a'), _lyx_figure(1, 'fig:b')]}
+        lyxblog_filter.set_info(([], {}), (['/assets/a.png',
+                                            '/assets/b.png'], {}))
+        walk(doc, lyxblog_filter.filter_main, 'html', doc['meta'])
+
+        for idx, (block, src, label) in enumerate(zip(
+                doc['blocks'], ['/assets/a.png', '/assets/b.png'],
+                ['fig:a', 'fig:b'])):
+            self.assertEqual(block['t'], 'Figure')
+            [body] = block['c'][2]
+            [image] = body['c']
+            self.assertEqual(image['t'], 'Image')
+            attrs, alt, [image_src, _] = image['c']
+            self.assertEqual(image_src, src)
+            self.assertEqual(attrs[0], label)
+            self.assertEqual(stringify(alt),
+                             'Figure {}. Caption {}.'.format(idx + 1, idx))
+
+
+class SectionLabelInfoTest(unittest.TestCase):
+    def test_data_number(self):
+        # pandoc 2 writes the number in a span, pandoc 3 also, or only, in
+        # `data-number`.
+        html = ('<h1 id="{0}"><span class="header-section-number">1</span> '
+                'One [sec:one]</h1>\n'
+                '<h1 data-number="2" id="{0}"><span '
+                'class="header-section-number">2</span> Two [sec:two]</h1>\n'
+                '<h2 data-number="2.1" id="{0}">Three [sec:three]</h2>\n'
+                '<h1 id="{0}" class="unnumbered">Four [sec:four]</h1>\n'
+                .format(UID))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            html_path = os.path.join(tmp_dir, 'article.html')
+            with open(html_path, 'w', encoding='utf-8') as f:
+                f.write(html)
+            _, name_to_num = LyXBlog.get_section_label_info(html_path)
+        self.assertEqual(name_to_num, {'sec:one': '1', 'sec:two': '2',
+                                       'sec:three': '2.1'})
@@ -0,0 +1,55 @@
+# Tests of the processing of the images of the posts (see images.py).
+
+import os
+import sys
+import zlib
+import struct
+import datetime
+import tempfile
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import LyXBlog
+from images import optimize_images, inline_images
+
+
+def _png(width, height):
+    # A black PNG image.
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data)))
+    rows = b''.join(b'\0' + b'\0' * width for _ in range(height))
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0,
+                                       0, 0)) +
+            chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+
+class InlineImagesTest(unittest.TestCase):
+    def test_inlined_raster_keeps_attrs(self):
+        front_matters = LyXBlog.FrontMatters(
+            {'html_file_name': 'post'},
+            {'layout': 'post', 'date': datetime.date(2018, 1, 1)})
+        with tempfile.TemporaryDirectory() as blog_dir:
+            os.makedirs(os.path.join(blog_dir, 'assets'))
+            with open(os.path.join(blog_dir, 'assets', 'fig.png'),
+                      'wb') as f:
+                f.write(_png(12, 7))
+            html_path = os.path.join(blog_dir, 'pandoc.html')
+            with open(html_path, 'w', encoding='utf-8') as f:
+                f.write('<p><img src="/assets/fig.png" alt="A figure" />'
+                        '</p>\n')
+            image_attrs = optimize_images(blog_dir, ['/assets/fig.png'])
+            inlined = inline_images(blog_dir, ['/assets/fig.png'], 10000)
+            dest_path = os.path.join(blog_dir, 'post.html')
+            LyXBlog.post_process_html(html_path, dest_path, front_matters,
+                                      image_attrs, inlined_images=inlined)
+            with open(dest_path, encoding='utf-8') as f:
+                post = f.read()
+        self.assertIn('<img src="data:image/png;base64,', post)
+        self.assertIn(' width="12"', post)
+        self.assertIn(' height="7"', post)
+        self.assertIn(' loading="lazy"', post)
+        self.assertNotIn('/assets/fig.png', post)
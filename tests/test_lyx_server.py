@@ -0,0 +1,72 @@
+# Tests of the LyXServer backend (see lyx_server.py) against FakeLyXServer.
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lyx_server import FakeLyXServer, LyXServerUnavailable, export_latex
+
+
+def _export(lyx_path, tex_path):
+    with open(lyx_path, encoding='utf-8') as f:
+        data = f.read()
+    with open(tex_path, 'w', encoding='utf-8') as f:
+        f.write('% exported\n' + data)
+
+
+@unittest.skipUnless(hasattr(os, 'mkfifo'), 'needs named pipes')
+class ExportLatexTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='lyxblog_test_')
+        self.pipe_path = os.path.join(self.dir, 'lyxpipe')
+        self.lyx_path = os.path.join(self.dir, 'article.lyx')
+        self.tex_path = os.path.join(self.dir, 'article.tex')
+        with open(self.lyx_path, 'w', encoding='utf-8') as f:
+            f.write('content\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _read_tex(self):
+        with open(self.tex_path, encoding='utf-8') as f:
+            return f.read()
+
+    def test_round_trip(self):
+        with FakeLyXServer(self.pipe_path, _export) as server:
+            self.assertTrue(export_latex(self.pipe_path, self.lyx_path,
+                                         self.tex_path))
+            # We close the document we opened.
+            self.assertEqual(server.open_paths, [])
+            self.assertIn('LYXCMD:lyxblog{}:buffer-close:'.format(os.getpid()),
+                          server.received)
+        self.assertEqual(self._read_tex(), '% exported\ncontent\n')
+
+    def test_already_open(self):
+        other_path = os.path.join(self.dir, 'other.lyx')
+        with FakeLyXServer(self.pipe_path, _export,
+                           [self.lyx_path, other_path]) as server:
+            # The open document may have unsaved changes.
+            self.assertFalse(export_latex(self.pipe_path, self.lyx_path,
+                                          self.tex_path))
+            self.assertEqual(server.open_paths, [self.lyx_path, other_path])
+        self.assertEqual(self._read_tex(), '% exported\ncontent\n')
+
+    def test_stale_lock(self):
+        # A lock file left by a dead process doesn't block the export.
+        open(self.pipe_path + '.lyxblog.lock', 'w').close()
+        with FakeLyXServer(self.pipe_path, _export):
+            export_latex(self.pipe_path, self.lyx_path, self.tex_path,
+                         timeout=5)
+        self.assertEqual(self._read_tex(), '% exported\ncontent\n')
+
+    def test_no_server(self):
+        with self.assertRaises(LyXServerUnavailable):
+            export_latex(self.pipe_path, self.lyx_path, self.tex_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+# Tests of the build-time math rendering (see math_render.py).
+
+import os
+import sys
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import math_render
+
+
+class EchoRenderer(math_render.MathRenderer):
+    # Returns the TeX it's given.
+    name = 'echo'
+
+    def render(self, latex, display):
+        return latex
+
+
+class MacrosTest(unittest.TestCase):
+    TEX = ('\\documentclass{article}\n'
+           '\\newcommand{\\R}{\\mathbb{R}}\n'
+           '\\DeclareMathOperator*{\\argmax}{arg\\,max}\n'
+           '\\newcommand{\\pair}[2]{\n'
+           '  \\left(#1, #2\\right)}\n'
+           '\\begin{document}\n'
+           '\\end{document}\n')
+
+    def test_get_macros(self):
+        self.assertEqual(math_render.get_macros(self.TEX),
+                         '\\newcommand{\\R}{\\mathbb{R}}\n'
+                         '\\newcommand{\\argmax}'
+                         '{\\operatorname*{arg\\,max}}\n'
+                         '\\newcommand{\\pair}[2]{\n'
+                         '  \\left(#1, #2\\right)}')
+
+    def test_renderer_gets_macros(self):
+        macros = math_render.get_macros(self.TEX)
+        prerenderer = math_render.MathPrerenderer(EchoRenderer(), None,
+                                                  macros)
+        prerenderer.add('x \\in \\R', False)
+        self.assertEqual(prerenderer.get_html('x \\in \\R', False),
+                         '<span class="math inline">{}\nx \\in \\R</span>'
+                         .format(macros))
+
+    def test_abstract_renderer(self):
+        with self.assertRaises(TypeError):
+            math_render.MathRenderer()
@@ -0,0 +1,105 @@
+import os
+import time
+
+try:
+    # Optional: without it, we poll the files.
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+
+DEBOUNCE_DELAY = 0.5        # seconds
+POLL_INTERVAL = 1.0         # seconds
+
+
+def _get_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+class _Waiter:
+    """
+    Waits for something to happen in the watched directories. With inotify,
+    we wake up as soon as a file is written; otherwise, we just sleep.
+    """
+    def __init__(self):
+        self.inotify = None
+        self.watched_dirs = set()
+        if inotify_simple is not None:
+            self.inotify = inotify_simple.INotify()
+            flags = inotify_simple.flags
+            self.mask = (flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE |
+                         flags.DELETE)
+
+    def set_dirs(self, dirs):
+        if self.inotify is None:
+            return
+        for dir_path in dirs - self.watched_dirs:
+            try:
+                self.inotify.add_watch(dir_path, self.mask)
+            except OSError:
+                continue
+            self.watched_dirs.add(dir_path)
+
+    def wait(self, timeout):
+        if self.inotify is None:
+            time.sleep(timeout)
+        else:
+            self.inotify.read(timeout=int(timeout * 1000))
+
+
+def watch_articles(find_articles, get_dependencies, publish):
+    """
+    Calls `publish(lyx_path)` whenever the LyX file or one of its dependencies
+    (e.g. its images) changes. Bursts of changes (e.g. LyX saving several
+    files) are merged: we wait until nothing has changed for DEBOUNCE_DELAY
+    seconds before publishing.
+
+    `find_articles()` returns the paths of the LyX files to watch, and
+    `get_dependencies(lyx_path)` returns the paths of the files the article
+    depends on.
+
+    This never returns.
+    """
+    waiter = _Waiter()
+
+    # lyx_path -> {path: stamp}
+    stamps = {}
+
+    def get_stamps(lyx_path):
+        paths = [lyx_path]
+        try:
+            paths += get_dependencies(lyx_path)
+        except Exception:           # e.g. the file is being written
+            pass
+        return {path: _get_stamp(path) for path in paths}
+
+    for lyx_path in find_articles():
+        stamps[lyx_path] = get_stamps(lyx_path)
+
+    changed = set()
+    last_change_time = None
+    while True:
+        waiter.set_dirs({os.path.dirname(path)
+                         for article_stamps in stamps.values()
+                         for path in article_stamps})
+        waiter.wait(DEBOUNCE_DELAY if changed else POLL_INTERVAL)
+
+        for lyx_path in find_articles():
+            old_stamps = stamps.get(lyx_path)
+            if (old_stamps is not None and
+                    all(_get_stamp(path) == stamp
+                        for path, stamp in old_stamps.items())):
+                continue
+            stamps[lyx_path] = get_stamps(lyx_path)
+            changed.add(lyx_path)
+            last_change_time = time.monotonic()
+
+        if (changed and
+                time.monotonic() - last_change_time >= DEBOUNCE_DELAY):
+            for lyx_path in sorted(changed):
+                publish(lyx_path)
+            changed.clear()
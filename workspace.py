@@ -0,0 +1,36 @@
+# Private temporary directories for the intermediate files of a publication
+# (the TeX file exported by LyX, the HTML file produced by pandoc, the data
+# for the filters, ...), so that several articles, even in the same directory
+# and even in the same process, can be published at the same time.
+
+import os
+
+
+# The filters run by pandoc find their data in the workspace named by this
+# environment variable, in this file (see filter.py). They import this module,
+# so it imports nothing else at startup.
+WORKSPACE_ENV_VAR = 'LYXBLOG_WORKSPACE'
+FILTER_INFO_FILE_NAME = 'lyxblog_filter_info.json'
+
+
+class Workspace:
+    """
+    Context manager which creates a temporary directory and removes it, with
+    everything in it, on exit.
+    """
+    def __init__(self, prefix='lyxblog_'):
+        import tempfile
+        self.dir = tempfile.mkdtemp(prefix=prefix)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def close(self):
+        import shutil
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()